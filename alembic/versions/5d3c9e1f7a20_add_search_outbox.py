@@ -0,0 +1,44 @@
+"""add search outbox
+
+Revision ID: 5d3c9e1f7a20
+Revises: 87a40118f601
+Create Date: 2026-10-17 21:05:41.218304
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d3c9e1f7a20'
+down_revision: Union[str, None] = '87a40118f601'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'SearchOutbox' not in tables:  # database was created by create_all
+        op.create_table(
+            'SearchOutbox',
+            sa.Column('seq', sa.Integer(), primary_key=True, autoincrement=True),
+            sa.Column('index_name', sa.String(), nullable=False),
+            sa.Column('doc_id', sa.Integer(), nullable=False),
+            sa.Column('operation', sa.String(), nullable=False),
+            sa.Column('document', sa.JSON()),
+            sa.Column('created_at', sa.Float(), nullable=False),
+            sqlite_autoincrement=True,
+        )
+    if 'SearchOutboxCursor' not in tables:
+        op.create_table(
+            'SearchOutboxCursor',
+            sa.Column('name', sa.String(), primary_key=True),
+            sa.Column('seq', sa.Integer(), nullable=False),
+        )
+
+
+def downgrade() -> None:
+    op.drop_table('SearchOutboxCursor')
+    op.drop_table('SearchOutbox')
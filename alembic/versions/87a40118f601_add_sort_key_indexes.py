@@ -0,0 +1,35 @@
+"""add sort key indexes
+
+Revision ID: 87a40118f601
+Revises: 972819934166
+Create Date: 2026-10-17 20:13:15.053960
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '87a40118f601'
+down_revision: Union[str, None] = '972819934166'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+indexes = {
+    'ix_Book_sort_key_id': ('Book', [sa.text("coalesce(title, '')"), 'id']),
+    'ix_User_sort_key_id': ('User', [sa.text("coalesce(surname, '')"), 'id']),
+}
+
+
+def upgrade() -> None:
+    # expression indexes aren't reflected, so existence is checked by database
+    for name, (table, columns) in indexes.items():
+        op.create_index(name, table, columns, if_not_exists=True)
+
+
+def downgrade() -> None:
+    for name, (table, _) in indexes.items():
+        op.drop_index(name, table_name=table)
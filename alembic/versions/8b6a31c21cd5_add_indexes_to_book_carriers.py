@@ -0,0 +1,37 @@
+"""add indexes to book carriers
+
+Revision ID: 8b6a31c21cd5
+Revises: ab7525a07f9a
+Create Date: 2026-10-17 20:09:16.267010
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8b6a31c21cd5'
+down_revision: Union[str, None] = 'ab7525a07f9a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+indexes = {
+    'ix_BookCarriers_book_id_user_id': ['book_id', 'user_id'],
+    'ix_BookCarriers_user_id_book_id': ['user_id', 'book_id'],
+    'ix_BookCarriers_return_date': ['return_date'],
+}
+
+
+def upgrade() -> None:
+    existing = [index['name'] for index in sa.inspect(op.get_bind()).get_indexes('BookCarriers')]
+    for name, columns in indexes.items():
+        if name not in existing:  # database was created by create_all
+            op.create_index(name, 'BookCarriers', columns)
+
+
+def downgrade() -> None:
+    for name in indexes:
+        op.drop_index(name, table_name='BookCarriers')
@@ -0,0 +1,36 @@
+"""add on loan counter to book
+
+Revision ID: 972819934166
+Revises: 8b6a31c21cd5
+Create Date: 2026-10-17 20:10:24.981407
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '972819934166'
+down_revision: Union[str, None] = '8b6a31c21cd5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    columns = [column['name'] for column in sa.inspect(op.get_bind()).get_columns('Book')]
+    if 'on_loan' in columns:  # database was created by create_all
+        return
+    with op.batch_alter_table('Book') as batch_op:
+        batch_op.add_column(sa.Column('on_loan', sa.Integer(), nullable=False,
+                                      server_default='0'))
+    op.execute(
+        'UPDATE "Book" SET on_loan = ('
+        'SELECT count(*) FROM "BookCarriers" WHERE "BookCarriers".book_id = "Book".id)'
+    )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('Book') as batch_op:
+        batch_op.drop_column('on_loan')
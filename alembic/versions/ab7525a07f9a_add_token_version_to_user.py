@@ -0,0 +1,32 @@
+"""add token version to user
+
+Revision ID: ab7525a07f9a
+Revises: 
+Create Date: 2026-10-17 20:02:10.446256
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'ab7525a07f9a'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    columns = [column['name'] for column in sa.inspect(op.get_bind()).get_columns('User')]
+    if 'token_version' in columns:  # database was created by create_all
+        return
+    with op.batch_alter_table('User') as batch_op:
+        batch_op.add_column(sa.Column('token_version', sa.Integer(), nullable=False,
+                                      server_default='0'))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('User') as batch_op:
+        batch_op.drop_column('token_version')
@@ -0,0 +1,63 @@
+"""add fts5 search tables
+
+Revision ID: c7f2a4b81e36
+Revises: 5d3c9e1f7a20
+Create Date: 2026-10-18 10:12:27.504117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+from config import SEARCH_BACKEND
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7f2a4b81e36'
+down_revision: Union[str, None] = '5d3c9e1f7a20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# search table -> (content table, indexed columns), see core/search/fts.py
+TABLES = {
+    'BookSearch': ('Book', ['title', 'authors', 'description']),
+    'UserSearch': ('User', ['surname', 'name', 'login', 'middlename']),
+}
+
+
+def upgrade() -> None:
+    # tables are needed only by fts5 search backend (python -m core.search.fts rebuild
+    # creates them after switching to it)
+    if SEARCH_BACKEND != 'fts5' or op.get_bind().dialect.name != 'sqlite':
+        return
+    for name, (content, columns) in TABLES.items():
+        new = ', '.join(f'new.{column}' for column in columns)
+        old = ', '.join(f'old.{column}' for column in columns)
+        columns = ', '.join(columns)
+        op.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS "{name}" USING fts5({columns}, '
+            f'content="{content}", content_rowid="id", '
+            f'tokenize="unicode61 remove_diacritics 2")')
+        op.execute(
+            f'CREATE TRIGGER IF NOT EXISTS "{name}_insert" AFTER INSERT ON "{content}" BEGIN '
+            f'INSERT INTO "{name}"(rowid, {columns}) VALUES (new.id, {new}); END')
+        op.execute(
+            f'CREATE TRIGGER IF NOT EXISTS "{name}_delete" AFTER DELETE ON "{content}" BEGIN '
+            f'INSERT INTO "{name}"("{name}", rowid, {columns}) '
+            f"VALUES ('delete', old.id, {old}); END")
+        op.execute(
+            f'CREATE TRIGGER IF NOT EXISTS "{name}_update" AFTER UPDATE OF {columns} '
+            f'ON "{content}" BEGIN '
+            f'INSERT INTO "{name}"("{name}", rowid, {columns}) '
+            f"VALUES ('delete', old.id, {old}); "
+            f'INSERT INTO "{name}"(rowid, {columns}) VALUES (new.id, {new}); END')
+        op.execute(f'INSERT INTO "{name}"("{name}") VALUES (\'rebuild\')')
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for name in TABLES:
+        for trigger in ('insert', 'delete', 'update'):
+            op.execute(f'DROP TRIGGER IF EXISTS "{name}_{trigger}"')
+        op.execute(f'DROP TABLE IF EXISTS "{name}"')
@@ -0,0 +1,32 @@
+"""add principals version
+
+Revision ID: e41b7d2c9a05
+Revises: c7f2a4b81e36
+Create Date: 2026-10-18 14:03:52.716290
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e41b7d2c9a05'
+down_revision: Union[str, None] = 'c7f2a4b81e36'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'PrincipalsVersion' not in tables:  # database was created by create_all
+        op.create_table(
+            'PrincipalsVersion',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('version', sa.Integer(), nullable=False),
+        )
+
+
+def downgrade() -> None:
+    op.drop_table('PrincipalsVersion')
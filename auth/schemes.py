@@ -55,3 +55,20 @@ class WhoamiResponseModel(pydantic.BaseModel):
     year_of_study: int
     birthdate: dt.date
     rights: Rights
+
+
+class Principal(pydantic.BaseModel):
+    """Authenticated user, which is cached between requests (no password here!).
+    In _claims_ auth mode it may be built from token only (id, rights and token version)
+    """
+    model_config = pydantic.ConfigDict(from_attributes=True, frozen=True)
+
+    id: int
+    login: typing.Optional[str] = None
+    name: typing.Optional[str] = None
+    middlename: typing.Optional[str] = None
+    surname: typing.Optional[str] = None
+    year_of_study: typing.Optional[int] = None
+    birthdate: typing.Optional[dt.date] = None
+    rights: typing.Optional[Rights] = None
+    token_version: int = 0
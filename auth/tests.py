@@ -1,22 +1,30 @@
 from main import app
 from fastapi.testclient import TestClient
 import pytest
-from core.security import get_password_hash, generate_token, create_tokens
+from core.security import (get_password_hash, generate_token, create_tokens, PasswordExecutor,
+                           get_password_hashes_async, verify_password, decode_token)
+import core.security
+from core.exceptions import ServerIsBusyException
 import datetime as dt
-from models import User, Rights
-from core.test_db import Base, engine, override_get_db
+import threading
+import asyncio
+from models import User, Rights, PrincipalsVersion
+from core.test_db import Base, engine, override_get_db, SessionLocal
 from core.db import get_db
+from auth.utils import principal_cache
+import auth.utils
 from core.search.cruds import UserCRUD
 
 client = TestClient(app)
 app.dependency_overrides[get_db] = override_get_db
-db = next(override_get_db())
+db = SessionLocal()
 
 
 @pytest.fixture()
 def test_db():
     Base.metadata.create_all(bind=engine)
     yield
+    principal_cache.clear()
     for user in db.query(User).all():
         UserCRUD().delete(user.id)
 
@@ -171,6 +179,7 @@ def test_create_users(test_db):
     user.rights = Rights.librarian
     db.add(user)
     db.commit()
+    principal_cache.invalidate(user.id)  # rights changed bypassing api
 
     resp = client.post('/auth/create', json=input_data, headers=headers)
     assert resp.status_code == 403
@@ -178,6 +187,7 @@ def test_create_users(test_db):
     user.rights = Rights.admin
     db.add(user)
     db.commit()
+    principal_cache.invalidate(user.id)
 
     resp = client.post('/auth/create', json=input_data, headers=headers)
     assert resp.status_code == 200
@@ -187,3 +197,150 @@ def test_create_users(test_db):
 
     students = db.query(User).filter(User.login.in_(logins)).all()
     assert len(students) == 2
+
+
+def test_create_users_race(test_db, monkeypatch):
+    admin = User(login='test', password=get_password_hash('pwd123qwe'), rights=Rights.admin)
+    db.add(admin)
+    db.commit()
+    tokens = create_tokens(admin.id, admin.rights, admin.token_version)
+    headers = {'Authorization': f'Bearer {tokens["access_token"]}'}
+    input_data = {'users': [
+        {'name': f'Ученик {i}', 'middlename': 'Иванович', 'surname': 'Иванов',
+         'year_of_study': 5, 'birthdate': '2014-01-01', 'rights': Rights.student.value}
+        for i in range(3)
+    ]}
+    monkeypatch.setattr(auth.utils, 'USERS_CHUNK_SIZE', 1)
+    get_max_user_id = auth.utils.get_max_user_id
+    taken = [admin.id - 1]  # ids were read before another request inserted them
+
+    async def get_taken_user_id(session):
+        return taken.pop() if taken else await get_max_user_id(session)
+
+    monkeypatch.setattr(auth.utils, 'get_max_user_id', get_taken_user_id)
+    resp = client.post('/auth/create', json=input_data, headers=headers)
+    assert resp.status_code == 200  # transaction is retried
+    logins = [user['login'] for user in resp.json()['users']]
+    assert db.query(User).filter(User.login.in_(logins)).count() == 3
+
+    taken.extend([admin.id - 1] * 3)  # conflict in the second chunk every time
+    resp = client.post('/auth/create', json=input_data, headers=headers)
+    assert resp.status_code == 422
+    assert db.query(User).count() == 4  # users of the first chunk aren't committed
+
+
+def test_password_executor_queue_limit():
+    executor = PasswordExecutor(max_workers=1, max_queue=0)
+    event = threading.Event()
+
+    async def run():
+        blocked = asyncio.ensure_future(executor.run(event.wait))
+        await asyncio.sleep(0.05)
+        with pytest.raises(ServerIsBusyException):
+            await executor.run(get_password_hash, 'pwd')  # worker is busy and queue is full
+        event.set()
+        await blocked
+        assert await executor.run(get_password_hash, 'pwd')
+
+    asyncio.run(run())
+
+
+def test_bulk_password_hashing(monkeypatch):
+    monkeypatch.setattr(core.security, 'BULK_HASHING_MIN_SIZE', 1)  # force process pool
+    passwords = [f'pwd{i}' for i in range(5)]
+    hashes = asyncio.run(get_password_hashes_async(passwords))
+
+    assert len(hashes) == len(passwords)
+    for password, hashed in zip(passwords, hashes):
+        assert verify_password(password, hashed)
+
+
+def test_principal_cache(test_db):
+    login = 'test'
+    password = 'pwd123qwe'
+    user = User(login=login, password=get_password_hash(password))
+    db.add(user)
+    db.commit()
+
+    token = generate_token(user.id, dt.datetime.now().timestamp() + 1000)
+    headers = {'Authorization': f'Bearer {token}'}
+
+    hits, misses = principal_cache.hits, principal_cache.misses
+    assert client.get('/auth/whoami', headers=headers).status_code == 200
+    assert principal_cache.misses == misses + 1
+    assert client.get('/auth/whoami', headers=headers).status_code == 200
+    assert principal_cache.hits == hits + 1
+
+    resp = client.get('/auth/whoami', headers={'Authorization': 'Bearer asd123sdafsd'})
+    assert resp.status_code == 401  # invalid token
+
+
+def test_token_version(test_db):
+    user = User(login='test', password=get_password_hash('pwd123qwe'),
+                rights=Rights.librarian)
+    db.add(user)
+    db.commit()
+
+    tokens = create_tokens(user.id, user.rights, user.token_version)
+    headers = {'Authorization': f'Bearer {tokens["access_token"]}'}
+    assert client.get('/books/debtors', headers=headers).status_code == 200
+
+    user.token_version += 1  # ex. rights were changed
+    db.add(user)
+    db.commit()
+    principal_cache.invalidate(user.id)
+    assert client.get('/books/debtors', headers=headers).status_code == 401
+
+    resp = client.post('/auth/update_token', headers={
+        'Cookie': f'refresh_token={tokens["refresh_token"]}'
+    })
+    assert resp.status_code == 401  # refresh token is revoked too
+
+
+def test_claims_auth_mode(test_db, monkeypatch):
+    monkeypatch.setattr(auth.utils, 'AUTH_MODE', 'claims')
+    user = User(login='test', password=get_password_hash('pwd123qwe'),
+                rights=Rights.librarian)
+    db.add(user)
+    db.commit()
+
+    tokens = create_tokens(user.id, user.rights, user.token_version)
+    headers = {'Authorization': f'Bearer {tokens["access_token"]}'}
+    hits, misses = principal_cache.hits, principal_cache.misses
+    assert client.get('/books/debtors', headers=headers).status_code == 200
+    assert client.get('/books/debtors', headers=headers).status_code == 200
+    # token version is loaded once
+    assert (principal_cache.hits, principal_cache.misses) == (hits + 1, misses + 1)
+
+    tokens = create_tokens(user.id, Rights.student, user.token_version)
+    headers = {'Authorization': f'Bearer {tokens["access_token"]}'}
+    assert client.get('/books/debtors', headers=headers).status_code == 403
+
+    # rights are changed by another process
+    monkeypatch.setattr(auth.utils, 'AUTH_CLAIMS_CHECK_INTERVAL', 3600)
+    user.token_version += 1
+    version = db.get(PrincipalsVersion, 1) or PrincipalsVersion(id=1, version=0)
+    version.version += 1
+    db.add_all([user, version])
+    db.commit()
+    assert client.get('/books/debtors', headers=headers).status_code == 403  # not checked yet
+    monkeypatch.setattr(auth.utils, 'AUTH_CLAIMS_CHECK_INTERVAL', 0)
+    assert client.get('/books/debtors', headers=headers).status_code == 401
+
+
+def test_token_types(test_db, monkeypatch):
+    monkeypatch.setattr(auth.utils, 'AUTH_MODE', 'claims')
+    user = User(login='test', password=get_password_hash('pwd123qwe'),
+                rights=Rights.librarian)
+    db.add(user)
+    db.commit()
+
+    tokens = create_tokens(user.id, user.rights, user.token_version)
+    assert 'rights' not in decode_token(tokens['refresh_token'])
+    for path in ('/books/debtors', '/auth/whoami'):  # refresh token isn't a bearer token
+        resp = client.get(path, headers={'Authorization': f'Bearer {tokens["refresh_token"]}'})
+        assert resp.status_code == 401
+    resp = client.post('/auth/update_token', headers={
+        'Cookie': f'refresh_token={tokens["access_token"]}'
+    })
+    assert resp.status_code == 401  # access token can't be exchanged
@@ -3,90 +3,217 @@ from typing import Annotated
 import core.security
 import models
 import jwt
-from sqlalchemy.orm import Session
+import time
+from sqlalchemy.ext.asyncio import AsyncSession
 import sqlalchemy
 from core.db import get_db
-from core.search.cruds import UserCRUD as UserSearchCRUD
+from core.cache import TTLCache
+import core.metrics
+from config import (USERS_CHUNK_SIZE, USERS_CREATE_ATTEMPTS, PRINCIPAL_CACHE_SIZE,
+                    PRINCIPAL_CACHE_TTL, AUTH_MODE, AUTH_CLAIMS_CHECK_INTERVAL)
+from . import schemes
 
 oauth2_scheme = fastapi.security.OAuth2PasswordBearer(tokenUrl='auth/login')
 
-
-async def get_current_user(
-        token:
-        Annotated[str, fastapi.Depends(oauth2_scheme)],
-        db: Annotated[Session, fastapi.Depends(get_db)]):
+# user id -> (principals version, principal)
+principal_cache = TTLCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+core.metrics.register('principal_cache', principal_cache.stats)
+principals_version = (0.0, 0)  # (time of check, version)
+
+
+async def get_principals_version(db: AsyncSession, max_age: float = 0):
+    """Counter of changes of users shared by processes of application
+    (one row, it is read instead of user unless it was read less than _max_age_ seconds ago)"""
+    global principals_version
+    checked_at, version = principals_version
+    now = time.monotonic()
+    if max_age and now - checked_at < max_age:
+        return version
+    version = await db.scalar(sqlalchemy.select(models.PrincipalsVersion.version)) or 0
+    principals_version = (now, version)
+    return version
+
+
+async def get_principal(user_id: int, db: AsyncSession, max_age: float = 0):
+    """Cached user is used while no user is changed by any process
+    (changes are checked if they weren't checked for _max_age_ seconds)"""
+    version = await get_principals_version(db, max_age)
+    cached = principal_cache.get(user_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    user = await db.scalar(
+        sqlalchemy.select(models.User).where(models.User.id == user_id))
+    if user is None:
+        return None
+    return cache_principal(user, version)
+
+
+def cache_principal(user: models.User, version: int):
+    """_version_ of principals must be read before _user_"""
+    principal = schemes.Principal.model_validate(user)
+    principal_cache.set(user.id, (version, principal))
+    return principal
+
+
+async def invalidate_principal(user_id: int, db: AsyncSession):
+    """Makes all processes load user again after commit
+    (call it in transaction changing or deleting user)"""
+    updated = await db.execute(sqlalchemy.update(models.PrincipalsVersion).values(
+        version=models.PrincipalsVersion.version + 1))
+    if not updated.rowcount:
+        db.add(models.PrincipalsVersion(id=1, version=1))
+    principal_cache.invalidate(user_id)
+
+
+def decode_token(token: str, token_type: str = core.security.ACCESS_TOKEN):
+    """Tokens issued before _typ_ claim was added are accepted only as refresh tokens"""
     try:
         data = core.security.decode_token(token)
-        user = db.query(models.User).filter(
-            models.User.id == data.get('id')).first()
-        return user
     except jwt.exceptions.ExpiredSignatureError:
         raise fastapi.exceptions.HTTPException(
             status_code=fastapi.status.HTTP_401_UNAUTHORIZED,
             detail='Token expired'
         )
+    except jwt.exceptions.InvalidTokenError:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_401_UNAUTHORIZED,
+            detail='Invalid token'
+        )
+    if data.get('typ', core.security.REFRESH_TOKEN) != token_type:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_401_UNAUTHORIZED,
+            detail='Invalid token type'
+        )
+    return data
 
 
-async def is_authenticated(request: fastapi.Request):
-    return request.headers.get('Authorization') is not None
+async def revoke_tokens(user: models.User, db: AsyncSession):
+    """Makes all already issued tokens of user invalid in all processes by new token version
+    (call it in transaction changing user)"""
+    user.token_version += 1
+    await invalidate_principal(user.id, db)
 
 
-async def create_user(user, db, max_id):
-    try:
-        name = user.get('name')
-        surname = user.get('surname')
-        middlename = user.get('middlename')
-        year_of_study = int(user.get('year_of_study'))
-        birthdate = user.get('birthdate')
-        rights = user.get('rights') or models.Rights.student
-
-        login = core.security.generate_login(max_id)
-        password = core.security.generate_random_password()
-        user_model = models.User(
-            name=name, surname=surname, middlename=middlename,
-            year_of_study=year_of_study, birthdate=birthdate,
-            login=login,
-            password=core.security.get_password_hash(password),
-            rights=rights
+def check_token(data: dict, principal: schemes.Principal):
+    if data.get('ver', 0) != principal.token_version:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_401_UNAUTHORIZED,
+            detail='Token revoked'
         )
 
-        db.add(user_model)
-        db.commit()
-
-        UserSearchCRUD().create({
-            'id': str(max_id),
-            'name': name,
-            'middlename': middlename,
-            'surname': surname,
-            'login': login,
-        })
-
-        return {
-            'name': name,
-            'middlename': middlename,
-            'surname': surname,
-            'login': login,
-            'password': password
-        }
 
-    except Exception as exc:
-        raise core.exceptions.SomethingWentWrongException(exc)
+async def get_current_user(
+        token:
+        Annotated[str, fastapi.Depends(oauth2_scheme)],
+        db: Annotated[AsyncSession, fastapi.Depends(get_db)]):
+    """Returns authenticated user checked with database (or principal cache)"""
+    return await get_token_owner(decode_token(token), db)
+
+
+async def get_token_owner(data: dict, db: AsyncSession, max_age: float = 0):
+    """Returns user of decoded token if token isn't revoked
+    (users changed less than _max_age_ seconds ago may be taken from cache)"""
+    user = await get_principal(data.get('id'), db, max_age)
+    if user is None:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_401_UNAUTHORIZED,
+            detail='User doesn\'t exist'
+        )
+    check_token(data, user)
+    return user
+
 
+async def get_token_user(
+        token:
+        Annotated[str, fastapi.Depends(oauth2_scheme)],
+        db: Annotated[AsyncSession, fastapi.Depends(get_db)]):
+    """Returns authenticated user for permission checks (id and rights only).
+    In _claims_ auth mode rights are taken from token, its version is checked
+    with cached user (see AUTH_CLAIMS_CHECK_INTERVAL),
+    in _strict_ mode it is the same as get_current_user
+    """
+    if AUTH_MODE != 'claims':
+        return await get_current_user(token, db)
+
+    data = decode_token(token)
+    await get_token_owner(data, db, AUTH_CLAIMS_CHECK_INTERVAL)
+    return schemes.Principal(
+        id=data['id'],
+        rights=data['rights'],
+        token_version=data.get('ver', 0)
+    )
 
-async def get_max_user_id(db: Session):
-    max_id = db.query(models.User, sqlalchemy.func.max(
-        models.User.id)).first()[1]
+
+async def is_authenticated(request: fastapi.Request):
+    return request.headers.get('Authorization') is not None
+
+
+async def get_max_user_id(db: AsyncSession):
+    max_id = await db.scalar(sqlalchemy.select(sqlalchemy.func.max(models.User.id)))
     if not max_id:
         max_id = 0
     max_id += 1
     return max_id
 
 
-async def create_users(users: list, db: Session):
+async def insert_users(users: list[dict], hashes: list[str], db: AsyncSession):
+    """Adds users in chunks without commit, ids (and logins) are allocated
+    in the same transaction"""
     max_id = await get_max_user_id(db)
+    user_models = []
+    for start in range(0, len(users), USERS_CHUNK_SIZE):
+        chunk = []
+        for i in range(start, min(start + USERS_CHUNK_SIZE, len(users))):
+            user = users[i]
+            chunk.append(models.User(
+                id=max_id + i,
+                name=user.get('name'),
+                surname=user.get('surname'),
+                middlename=user.get('middlename'),
+                year_of_study=int(user.get('year_of_study')),
+                birthdate=user.get('birthdate'),
+                login=core.security.generate_login(max_id + i),
+                password=hashes[i],
+                rights=user.get('rights') or models.Rights.student
+            ))
+        db.add_all(chunk)
+        await db.flush()
+        user_models += chunk
+    return user_models
+
+
+async def create_users(users: list, db: AsyncSession, attempts: int = USERS_CREATE_ATTEMPTS):
+    """Creates users in one transaction and returns their generated logins and passwords,
+    so either all users are created or none of them.
+    Passwords are hashed in parallel, transaction is retried if ids were taken
+    by another one meanwhile
+    """
+    try:
+        users = [dict(user) for user in users]
+        passwords = [core.security.generate_random_password() for _ in users]
+        hashes = await core.security.get_password_hashes_async(passwords)
+
+        for attempt in range(1, attempts + 1):
+            try:
+                user_models = await insert_users(users, hashes, db)
+                await db.commit()
+                break
+            except (sqlalchemy.exc.IntegrityError, sqlalchemy.exc.OperationalError):
+                # the same ids are inserted by another transaction
+                # (sqlite reports it as locked database)
+                await db.rollback()
+                if attempt == attempts:
+                    raise
+
+        return [{
+            'name': user.name,
+            'middlename': user.middlename,
+            'surname': user.surname,
+            'login': user.login,
+            'password': password
+        } for user, password in zip(user_models, passwords)]
 
-    result = []
-    for user in users:
-        result.append(await create_user(dict(user), db, max_id))
-        max_id += 1
-    return result
+    except core.exceptions.ServerIsBusyException:
+        raise
+    except Exception as exc:
+        raise core.exceptions.SomethingWentWrongException(exc)
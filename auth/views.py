@@ -5,9 +5,12 @@ import core.security
 import core.validators
 import core.exceptions
 from . import schemes
-from .utils import get_current_user, create_users
+from .utils import (get_current_user, get_token_user, get_token_owner, decode_token,
+                    create_users, cache_principal, get_principals_version,
+                    invalidate_principal)
 from typing import Annotated
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+import sqlalchemy
 
 
 router = fastapi.APIRouter()
@@ -22,13 +25,14 @@ async def login(
     form_data: Annotated[
         fastapi.security.OAuth2PasswordRequestForm,
         fastapi.Depends()],
-        db: Session = fastapi.Depends(get_db)
+        db: AsyncSession = fastapi.Depends(get_db)
 ):
     login = form_data.username
     password = form_data.password
-    user = db.query(models.User).filter(models.User.login == login).first()
+    version = await get_principals_version(db)
+    user = await db.scalar(sqlalchemy.select(models.User).where(models.User.login == login))
 
-    if user is None or not core.security.verify_password(
+    if user is None or not await core.security.verify_password_async(
         password, user.password
     ):
 
@@ -36,7 +40,8 @@ async def login(
             status_code=fastapi.status.HTTP_401_UNAUTHORIZED,
             detail='Incorrect password or login'
         )
-    tokens = core.security.create_tokens(user.id)
+    cache_principal(user, version)
+    tokens = core.security.create_tokens(user.id, user.rights, user.token_version)
     response.set_cookie(key='refresh_token',
                         value=tokens['refresh_token'], httponly=True)
     response.headers['Authorization'] = f'Bearer {tokens["access_token"]}'
@@ -62,9 +67,9 @@ __Note:__
 async def create_users_route(
         form_data: schemes.CreateUsersRequestModel,
         current_user: Annotated[
-            models.User, fastapi.Depends(get_current_user)
+            schemes.Principal, fastapi.Depends(get_token_user)
         ],
-        db: Session = fastapi.Depends(get_db)):
+        db: AsyncSession = fastapi.Depends(get_db)):
     if not await core.validators.is_admin(current_user):
         raise core.exceptions.NotEnoughRightsException()
 
@@ -82,12 +87,14 @@ async def create_users_route(
     description='Just send request (refresh token must be in cookies) and get new access token'
 )
 async def update_token(request: fastapi.Request, response: fastapi.Response,
-                       db: Session = fastapi.Depends(get_db)):
+                       db: AsyncSession = fastapi.Depends(get_db)):
     refresh_token = request.cookies.get('refresh_token')
 
     if core.security.is_valid_token(refresh_token):
-        current_user = await get_current_user(refresh_token, db)
-        tokens = core.security.create_tokens(current_user.id)
+        current_user = await get_token_owner(
+            decode_token(refresh_token, core.security.REFRESH_TOKEN), db)
+        tokens = core.security.create_tokens(
+            current_user.id, current_user.rights, current_user.token_version)
         response.headers['Authorization'] = f'Bearer {tokens["access_token"]}'
         return schemes.TokenResponseModel(
             access_token=tokens['access_token'],
@@ -105,7 +112,7 @@ async def update_token(request: fastapi.Request, response: fastapi.Response,
     response_model=schemes.WhoamiResponseModel,
     summary='Get information about current user')
 async def whoami(current_user:
-                 Annotated[models.User, fastapi.Depends(get_current_user)]):
+                 Annotated[schemes.Principal, fastapi.Depends(get_current_user)]):
     return schemes.WhoamiResponseModel(
         login=current_user.login,
         name=current_user.name or '*******',
@@ -122,19 +129,21 @@ async def whoami(current_user:
     description='Change user\'s password. Only __admin__ can do this! No one else!'
 )
 async def change_password(user_id: int,
-                          current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+                          current_user: Annotated[
+                              schemes.Principal, fastapi.Depends(get_token_user)],
                           form: Annotated[schemes.ChangePasswordRequestForm, fastapi.Depends()],
-                          db: Session = fastapi.Depends(get_db)):
+                          db: AsyncSession = fastapi.Depends(get_db)):
 
     if await core.validators.is_admin(current_user):
-        user = db.query(models.User).filter(models.User.id == user_id).first()
+        user = await db.scalar(sqlalchemy.select(models.User).where(models.User.id == user_id))
         if not user:
             raise core.exceptions.UserDoesNotExistException()
 
-        user.password = core.security.get_password_hash(form.new_password)
+        user.password = await core.security.get_password_hash_async(form.new_password)
         try:
             db.add(user)
-            db.commit()
+            await invalidate_principal(user.id, db)
+            await db.commit()
             return fastapi.status.HTTP_200_OK
         except Exception as exc:
             raise core.exceptions.SomethingWentWrongException(exc)
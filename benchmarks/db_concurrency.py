@@ -0,0 +1,145 @@
+"""Compares sync sessions inside async handlers (how api worked before)
+with async sessions under concurrent load.
+
+Every "request" loads a book and counts its carriers (like /books/info).
+Heartbeat task measures how long event loop was blocked.
+_--latency_ simulates network round trip of database server (ms per query).
+
+Usage: python -m benchmarks.db_concurrency --books 1000 --concurrency 50 --requests 2000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+import sqlalchemy
+import sqlalchemy.orm
+import sqlalchemy.ext.asyncio
+import models
+
+
+def book_query(book_id):
+    return sqlalchemy.select(models.Book).where(models.Book.id == book_id)
+
+
+def count_query(book_id):
+    return sqlalchemy.select(sqlalchemy.func.count()).select_from(models.BookCarriers)\
+        .where(models.BookCarriers.c.book_id == book_id)
+
+
+def make_sync_handler(url, latency):
+    engine = sqlalchemy.create_engine(url, connect_args={'check_same_thread': False})
+    SessionLocal = sqlalchemy.orm.sessionmaker(bind=engine)
+
+    async def handler(book_id):
+        with SessionLocal() as db:
+            db.scalar(book_query(book_id))
+            time.sleep(latency)
+            db.scalar(count_query(book_id))
+            time.sleep(latency)
+
+    return handler, engine.dispose
+
+
+def make_async_handler(url, latency):
+    engine = sqlalchemy.ext.asyncio.create_async_engine(
+        url.replace('sqlite://', 'sqlite+aiosqlite://'))
+    SessionLocal = sqlalchemy.ext.asyncio.async_sessionmaker(engine)
+
+    async def handler(book_id):
+        async with SessionLocal() as db:
+            await db.scalar(book_query(book_id))
+            await asyncio.sleep(latency)
+            await db.scalar(count_query(book_id))
+            await asyncio.sleep(latency)
+
+    async def dispose():
+        await engine.dispose()
+
+    return handler, dispose
+
+
+async def heartbeat(stop: asyncio.Event, lags: list, interval=0.005):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run(handler, books: int, concurrency: int, requests: int):
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(random.randint(1, books))
+    latencies = []
+
+    async def worker():
+        while not queue.empty():
+            book_id = queue.get_nowait()
+            start = time.perf_counter()
+            await handler(book_id)
+            latencies.append(time.perf_counter() - start)
+
+    stop = asyncio.Event()
+    lags = []
+    beat = asyncio.create_task(heartbeat(stop, lags))
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await beat
+
+    latencies.sort()
+    return {
+        'rps': requests / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+        'max_loop_lag_ms': max(lags, default=0) * 1000,
+        'avg_loop_lag_ms': statistics.mean(lags) * 1000 if lags else 0,
+    }
+
+
+def fill_db(url, books):
+    engine = sqlalchemy.create_engine(url)
+    models.Base.metadata.create_all(engine)
+    with sqlalchemy.orm.Session(engine) as db:
+        db.add_all([models.Book(title=f'Book {i}', authors='Author', description='',
+                                edition_date=2000, amount=10, is_private=False)
+                    for i in range(books)])
+        db.add(models.User(id=1, login='reader', password='-'))
+        db.commit()
+        db.execute(models.BookCarriers.insert(), [
+            {'book_id': random.randint(1, books), 'user_id': 1} for _ in range(books)
+        ])
+        db.commit()
+    engine.dispose()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0, help='ms per query')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        url = 'sqlite:///' + os.path.join(folder, 'bench.db')
+        fill_db(url, args.books)
+        latency = args.latency / 1000
+
+        for name, factory in (('sync session', make_sync_handler),
+                              ('async session', make_async_handler)):
+            handler, dispose = factory(url, latency)
+            result = await run(handler, args.books, args.concurrency, args.requests)
+            if asyncio.iscoroutinefunction(dispose):
+                await dispose()
+            else:
+                dispose()
+            print(f'{name:>14}: ' +
+                  ', '.join(f'{key}={value:.2f}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
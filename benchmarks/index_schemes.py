@@ -0,0 +1,71 @@
+"""Compares full and compact (only ids are stored) schemes of books' index
+on synthetic catalogue: size of index, time of indexing and search latency
+for pages of ITEMS_PER_PAGE and of SEARCH_MAX_HITS hits (like search by cursor).
+
+Usage: python -m benchmarks.index_schemes --books 50000 --queries 300
+"""
+import argparse
+import pathlib
+import random
+import statistics
+import tempfile
+import time
+import whoosh.index
+from core.search import schemes
+from core.search.cruds import SearchCRUD, BookCRUD
+from core.search.searchers import SearcherManager
+from core.search.writers import BufferedIndexWriter
+from config import SEARCH_MAX_HITS, ITEMS_PER_PAGE
+from benchmarks.search_modes import make_books, make_queries
+
+
+def folder_size(folder: pathlib.Path):
+    return sum(path.stat().st_size for path in folder.iterdir())
+
+
+def run(crud: SearchCRUD, queries: list, pagelen: int):
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        crud.search(query, 1, pagelen=pagelen)
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+    books = list(make_books(args.books, rnd))
+    queries = [word for word, _, _ in make_queries(books, args.queries, rnd)]
+    queries += [book.authors.split(', ')[0] for book in rnd.sample(books, args.queries)]
+    # empty query finds everything: every page is full
+    wide_queries = [''] * args.queries
+
+    for name, scheme in (('full', schemes.make_book_scheme(stored=True)),
+                         ('compact', schemes.make_book_scheme(stored=False))):
+        with tempfile.TemporaryDirectory() as folder:
+            folder = pathlib.Path(folder)
+            indexer = whoosh.index.create_in(folder, scheme)
+            manager = SearcherManager(indexer)
+            writer = BufferedIndexWriter(indexer, manager, batch_size=args.books)
+            started = time.perf_counter()
+            with writer.batch():
+                for book in books:
+                    writer.add(BookCRUD.to_document(book))
+            indexed = time.perf_counter() - started
+            crud = SearchCRUD(scheme, indexer, BookCRUD.FIELDS, manager, writer, mode='exact')
+            print(f'{name:>7}: {folder_size(folder) / 2 ** 20:6.1f} MB, indexed in {indexed:5.1f}s')
+            for kind, kind_queries, pagelen in (('words', queries, ITEMS_PER_PAGE),
+                                                ('wide', wide_queries, SEARCH_MAX_HITS)):
+                p50, p99 = run(crud, kind_queries, pagelen)
+                print(f'{kind:>9} x{pagelen:<5}: p50 {p50:7.2f} ms, p99 {p99:7.2f} ms')
+            manager.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Compares amounts of shards of books' index on synthetic catalogue: time of indexing
+and latency of fuzzy queries with typos and of queries counting facets of all found books.
+Shards are searched by SEARCH_SHARD_THREADS threads.
+
+Usage: python -m benchmarks.index_shards --books 50000 --queries 300 --shards 1 2 4
+"""
+import argparse
+import pathlib
+import random
+import statistics
+import tempfile
+import time
+import whoosh.index
+from core.search import schemes
+from core.search.cruds import SearchCRUD, BookCRUD
+from core.search.searchers import SearcherManager
+from core.search.shards import Shard, shard_folders
+from core.search.writers import BufferedIndexWriter
+from config import SEARCH_SHARD_THREADS
+from benchmarks.search_modes import make_books, make_queries
+
+
+def run(crud: SearchCRUD, queries: list, groupedby: dict = None):
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        crud.search(query, 1, groupedby=groupedby)
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+    books = list(make_books(args.books, rnd))
+    documents = [BookCRUD.to_document(book) for book in books]
+    typo_queries = [typo for _, typo, _ in make_queries(books, args.queries, rnd)]
+    author_queries = [book.authors.split(', ')[0] for book in rnd.sample(books, args.queries)]
+    print(f'{SEARCH_SHARD_THREADS} search threads')
+
+    for amount in args.shards:
+        with tempfile.TemporaryDirectory() as folder:
+            shards = []
+            for shard_folder in shard_folders(pathlib.Path(folder), amount):
+                shard_folder.mkdir(exist_ok=True)
+                indexer = whoosh.index.create_in(shard_folder, schemes.book_scheme)
+                manager = SearcherManager(indexer)
+                shards.append(Shard(indexer, manager,
+                                    BufferedIndexWriter(indexer, manager, batch_size=args.books)))
+            crud = SearchCRUD(schemes.book_scheme, None, BookCRUD.FIELDS, None, None,
+                              mode='fuzzy', shards=shards)
+            started = time.perf_counter()
+            crud.create_many(documents)
+            indexed = time.perf_counter() - started
+            print(f'{amount} shards: indexed in {indexed:5.1f}s')
+            for kind, queries, groupedby in (('fuzzy', typo_queries, None),
+                                             ('facets', author_queries, BookCRUD.facets())):
+                p50, p99 = run(crud, queries, groupedby)
+                print(f'{kind:>10}: p50 {p50:7.2f} ms, p99 {p99:7.2f} ms')
+            for shard in shards:
+                shard.searchers.close()
+
+
+if __name__ == '__main__':
+    main()
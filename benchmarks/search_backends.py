@@ -0,0 +1,104 @@
+"""Compares whoosh and SQLite FTS5 search backends on synthetic catalogue.
+
+Writes are measured like the application does them: one transaction per book,
+whoosh index is committed after it (immediate writer mode), FTS5 table is
+changed by triggers inside the same transaction.
+Queries are one right word of title of random book (FTS5 has no typo tolerance).
+
+Usage: python -m benchmarks.search_backends --books 20000 --writes 500 --queries 300
+"""
+import argparse
+import pathlib
+import random
+import statistics
+import tempfile
+import time
+import whoosh.index
+from core.db import create_engine
+from core.search import schemes, fts
+from core.search.cruds import SearchCRUD, BookCRUD
+from core.search.searchers import SearcherManager
+from core.search.writers import BufferedIndexWriter
+from benchmarks.search_modes import make_books, make_queries
+from models import Base
+import models
+
+
+def book_row(book):
+    return {'id': book.id, 'title': book.title, 'description': book.description,
+            'authors': book.authors, 'edition_date': book.edition_date,
+            'is_private': book.is_private, 'amount': 1}
+
+
+def load(engine, books, crud):
+    """Loads catalogue in one transaction, returns seconds"""
+    started = time.perf_counter()
+    with engine.begin() as connection, crud.batch():
+        connection.execute(models.Book.__table__.insert(), [book_row(book) for book in books])
+        for book in books:
+            crud.create(BookCRUD.to_document(book))
+    return time.perf_counter() - started
+
+
+def write(engine, books, crud):
+    """Writes books one by one, returns rows/sec"""
+    started = time.perf_counter()
+    for book in books:
+        with engine.begin() as connection:
+            connection.execute(models.Book.__table__.insert(), book_row(book))
+        crud.create(BookCRUD.to_document(book))
+    return len(books) / (time.perf_counter() - started)
+
+
+def run(crud, queries: list):
+    latencies = []
+    for query, _ in queries:
+        started = time.perf_counter()
+        crud.search(query, 1)
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=20000)
+    parser.add_argument('--writes', type=int, default=500)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+    books = list(make_books(args.books + args.writes, rnd))
+    catalogue, new_books = books[:args.books], books[args.books:]
+    queries = [(word, id_) for word, _, id_ in make_queries(catalogue, args.queries, rnd)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        folder = pathlib.Path(folder)
+        for backend in ('whoosh', 'fts5'):
+            engine = create_engine(f'sqlite:///{folder / backend}.db')
+            Base.metadata.create_all(bind=engine)
+            manager = None
+            if backend == 'whoosh':
+                (folder / backend).mkdir()
+                indexer = whoosh.index.create_in(folder / backend, schemes.book_scheme)
+                manager = SearcherManager(indexer)
+                writer = BufferedIndexWriter(indexer, manager, batch_size=args.books)
+                crud = SearchCRUD(schemes.book_scheme, indexer, BookCRUD.FIELDS, manager,
+                                  writer, mode='exact')
+            else:
+                with engine.begin() as connection:
+                    fts.install_all(connection)
+                crud = fts.BookCRUD(engine)
+
+            loaded = load(engine, catalogue, crud)
+            rate = write(engine, new_books, crud)
+            p50, p99 = run(crud, queries)
+            print(f'{backend:>6}: load {loaded:5.1f}s, writes {rate:6.0f} rows/sec, '
+                  f'search p50 {p50:6.2f} ms, p99 {p99:6.2f} ms')
+            if manager is not None:
+                manager.close()
+            engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
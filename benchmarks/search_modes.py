@@ -0,0 +1,107 @@
+"""Compares search modes (exact / fuzzy / ngram) on synthetic catalogue.
+
+Every query is one word of title of random book, typo queries have one letter changed
+(not the first one, fuzzy mode needs it). Recall is share of queries which found
+their book on the first page.
+
+Usage: python -m benchmarks.search_modes --books 50000 --queries 300
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+import types
+import whoosh.index
+from core.search import schemes
+from core.search.cruds import SearchCRUD, BookCRUD
+from core.search.searchers import SearcherManager
+from core.search.writers import BufferedIndexWriter
+
+LETTERS = 'абвгдежзиклмнопрстуфхцчшэюя'
+CONSONANTS = 'бвгджзклмнпрстфхцчш'
+VOWELS = 'аеиоуыэюя'
+
+
+def make_word(rnd: random.Random):
+    return ''.join(rnd.choice(CONSONANTS) + rnd.choice(VOWELS)
+                   for _ in range(rnd.randint(2, 5)))
+
+
+def make_books(amount: int, rnd: random.Random):
+    words = [make_word(rnd) for _ in range(amount // 2)]
+    surnames = [make_word(rnd).capitalize() for _ in range(amount // 10)]
+    for id_ in range(1, amount + 1):
+        yield types.SimpleNamespace(
+            id=id_,
+            title=' '.join(rnd.sample(words, rnd.randint(2, 5))).capitalize(),
+            description=' '.join(rnd.sample(words, 20)),
+            authors=', '.join(rnd.sample(surnames, rnd.randint(1, 2))),
+            edition_date=rnd.randint(1950, 2024),
+            is_private=False,
+        )
+
+
+def make_typo(word: str, rnd: random.Random):
+    position = rnd.randrange(1, len(word))
+    letter = rnd.choice(LETTERS.replace(word[position], ''))
+    return word[:position] + letter + word[position + 1:]
+
+
+def make_queries(books: list, amount: int, rnd: random.Random):
+    queries = []
+    for book in rnd.sample(books, amount):
+        word = max(book.title.lower().split(), key=len)
+        queries.append((word, make_typo(word, rnd), book.id))
+    return queries
+
+
+def run(crud: SearchCRUD, queries: list):
+    latencies, found = [], 0
+    for query, book_id in queries:
+        started = time.perf_counter()
+        ids = crud.search(query, 1).ids
+        latencies.append((time.perf_counter() - started) * 1000)
+        found += book_id in ids
+    latencies.sort()
+    return {
+        'p50': statistics.median(latencies),
+        'p99': latencies[int(len(latencies) * 0.99) - 1],
+        'recall': found / len(queries),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as folder:
+        indexer = whoosh.index.create_in(folder, schemes.book_scheme)
+        manager = SearcherManager(indexer)
+        writer = BufferedIndexWriter(indexer, manager, batch_size=args.books)
+        books = list(make_books(args.books, rnd))
+        started = time.perf_counter()
+        with writer.batch():
+            for book in books:
+                writer.add(BookCRUD.to_document(book))
+        print(f'{args.books} books indexed in {time.perf_counter() - started:.1f}s')
+
+        queries = make_queries(books, args.queries, rnd)
+        for mode in ('exact', 'fuzzy', 'ngram'):
+            crud = SearchCRUD(schemes.book_scheme, indexer, BookCRUD.FIELDS, manager, writer,
+                              BookCRUD.NGRAM_FIELDS, mode)
+            for kind, kind_queries in (
+                    ('right', [(word, id_) for word, _, id_ in queries]),
+                    ('typo', [(typo, id_) for _, typo, id_ in queries])):
+                result = run(crud, kind_queries)
+                print(f'{mode:>6} {kind:>6}: p50 {result["p50"]:7.2f} ms, '
+                      f'p99 {result["p99"]:7.2f} ms, recall {result["recall"]:.0%}')
+        manager.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Cache of book search results.
+
+Cached pages are never invalidated one by one: key contains generation of books' index
+(search backend) and version of Book table, which is incremented after every commit changing books.
+"""
+import sqlalchemy.event
+import sqlalchemy.orm
+import core.metrics
+from core.cache import TTLCache
+from core.search import BookCRUD as BookSearchCRUD
+from config import SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, SEARCH_FACET_CACHE_SIZE
+import models
+
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+core.metrics.register('book_search_cache', search_cache.stats)
+# facets don't depend on page, so they are cached separately for all pages of query
+facets_cache = TTLCache(SEARCH_FACET_CACHE_SIZE, SEARCH_CACHE_TTL)
+core.metrics.register('book_facets_cache', facets_cache.stats)
+
+_table_version = 0
+
+
+def get_table_version():
+    return _table_version
+
+
+def normalize_query(query: str):
+    return ' '.join((query or '').lower().split())
+
+
+def search_cache_key(query: str, edition_date: int, page: int, is_librarian: bool,
+                     facets: bool = False):
+    return (normalize_query(query), edition_date, page, is_librarian, facets,
+            BookSearchCRUD().generation(), _table_version)
+
+
+def facets_cache_key(query: str, edition_date: int, is_librarian: bool):
+    """Facets are counted by index only"""
+    return normalize_query(query), edition_date, is_librarian, BookSearchCRUD().generation()
+
+
+def _mark_changed(session: sqlalchemy.orm.Session):
+    session.info['books_changed'] = True
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_flush')
+def _after_flush(session, flush_context):
+    if any(isinstance(item, models.Book)
+           for item in (*session.new, *session.dirty, *session.deleted)):
+        _mark_changed(session)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'do_orm_execute')
+def _on_execute(state):
+    if (state.is_update or state.is_delete or state.is_insert) \
+            and any(mapper.class_ is models.Book for mapper in state.all_mappers):
+        _mark_changed(state.session)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _after_commit(session):
+    global _table_version
+    # version changes after commit, so page read before it can't be cached with new version
+    if session.info.pop('books_changed', False):
+        _table_version += 1
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('books_changed', None)
@@ -0,0 +1,36 @@
+"""Recomputes books' _on_loan_ counters from BookCarriers (repairs drift)
+
+Counters are recomputed and written by one UPDATE, so books given or returned
+meanwhile aren't overwritten with stale counts.
+
+Usage: python -m books.reconcile
+"""
+import sqlalchemy
+from sqlalchemy.orm import Session
+from core.db import SessionLocal
+import models
+
+
+def reconcile_on_loan(db: Session):
+    """Returns amount of fixed books"""
+    on_loan = (
+        sqlalchemy.select(sqlalchemy.func.count())
+        .where(models.BookCarriers.c.book_id == models.Book.id)
+        .scalar_subquery()
+    )
+    fixed = db.execute(
+        sqlalchemy.update(models.Book).where(models.Book.on_loan != on_loan)
+        .values(on_loan=on_loan).execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    return fixed
+
+
+def main():
+    with SessionLocal() as db:
+        fixed = reconcile_on_loan(db)
+    print(f'Counters fixed for {fixed} books')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ import pydantic
 import typing
 from fastapi import UploadFile
 import datetime as dt
+from users.schemes import PageResponseModel
 
 
 class BookResponseModel(pydantic.BaseModel):
@@ -13,6 +14,15 @@ class BookResponseModel(pydantic.BaseModel):
     is_private: typing.Optional[bool] = None
 
 
+class BookAvailabilityForm(pydantic.BaseModel):
+    id: int
+    in_stock: int
+
+
+class BookAvailabilityListForm(pydantic.BaseModel):
+    books: typing.List[BookAvailabilityForm]
+
+
 class BookCreateRequestForm(pydantic.BaseModel):
     title: str
     authors: str
@@ -54,6 +64,26 @@ class BookListForm(pydantic.BaseModel):
     books: typing.List[ShortBookForm]
 
 
+class AuthorFacetForm(pydantic.BaseModel):
+    author: str
+    count: int
+
+
+class EditionYearsFacetForm(pydantic.BaseModel):
+    start: int
+    end: int  # not included
+    count: int
+
+
+class BookFacetsForm(pydantic.BaseModel):
+    authors: typing.List[AuthorFacetForm]
+    edition_years: typing.List[EditionYearsFacetForm]
+
+
+class BookSearchPageForm(PageResponseModel[ShortBookForm]):
+    facets: typing.Optional[BookFacetsForm] = None
+
+
 class SearchBookForm(pydantic.BaseModel):
     title: typing.Optional[str] = None
     authors: typing.Optional[str] = None
@@ -2,14 +2,26 @@ from main import app
 from fastapi.testclient import TestClient
 import pytest
 from core.security import get_password_hash
-from models import User, Rights, Book, BookCarriers
-from core.test_db import Base, engine, override_get_db
+from models import User, Rights, Book, BookCarriers, SearchOutbox, SearchOutboxCursor
+from core.test_db import Base, engine, override_get_db, SessionLocal
 from core.db import get_db
+from auth.utils import principal_cache
 import datetime as dt
 from core.search.cruds import UserCRUD, BookCRUD
 import enum
+import time
 from PIL import Image
 from io import BytesIO
+import sqlalchemy
+from books.reconcile import reconcile_on_loan
+from core.search.reconcile import reconcile
+from core.search.outbox import OutboxDispatcher, replay
+from core.search.queue import OwnerLock
+import core.search.outbox
+from books.cache import search_cache, facets_cache, get_table_version
+from users.utils import search_ids_cache, total_count_cache
+import users.utils
+from config import MAX_ITEMS_PER_PAGE
 
 
 class MethodsEnum(enum.Enum):
@@ -20,7 +32,7 @@ class MethodsEnum(enum.Enum):
 
 
 app.dependency_overrides[get_db] = override_get_db
-db = next(override_get_db())
+db = SessionLocal()
 
 client = TestClient(app)
 
@@ -29,6 +41,10 @@ client = TestClient(app)
 def test_db():
     Base.metadata.create_all(bind=engine)
     yield
+    principal_cache.clear()
+    search_cache.clear()
+    facets_cache.clear()
+    search_ids_cache.clear()
     for user in db.query(User).all():
         UserCRUD().delete(user.id)
     for book in db.query(Book).all():
@@ -36,6 +52,12 @@ def test_db():
     Base.metadata.drop_all(bind=engine)
 
 
+def explain(query):
+    compiled = query.compile(engine, compile_kwargs={'literal_binds': True})
+    plan = db.execute(sqlalchemy.text(f'EXPLAIN QUERY PLAN {compiled}')).all()
+    return ' '.join(row[-1] for row in plan)
+
+
 def create_user(login: str, password: str, rights: Rights):
     user = User(login=login, password=get_password_hash(password),
                 rights=rights)
@@ -405,3 +427,376 @@ def test_get_user_books(test_db):
     )
     assert resp.status_code == 200
     assert len(resp.json()['debtors']) == 1
+
+
+def test_book_carriers_indexes(test_db):
+    in_stock_plan = explain(
+        sqlalchemy.select(sqlalchemy.func.count()).select_from(BookCarriers)
+        .where(BookCarriers.c.book_id == 1)
+    )
+    assert 'ix_BookCarriers_book_id_user_id' in in_stock_plan
+
+    relation_plan = explain(
+        sqlalchemy.select(BookCarriers)
+        .where(BookCarriers.c.book_id == 1)
+        .where(BookCarriers.c.user_id == 1)
+    )
+    assert 'ix_BookCarriers_book_id_user_id' in relation_plan or \
+        'ix_BookCarriers_user_id_book_id' in relation_plan
+
+    user_books_plan = explain(
+        sqlalchemy.select(Book)
+        .join(BookCarriers, BookCarriers.c.book_id == Book.id)
+        .where(BookCarriers.c.user_id == 1)
+    )
+    assert 'ix_BookCarriers_user_id_book_id' in user_books_plan
+
+    debtors_plan = explain(
+        sqlalchemy.select(BookCarriers).where(BookCarriers.c.return_date < dt.date(2024, 1, 1))
+    )
+    assert 'ix_BookCarriers_return_date' in debtors_plan
+
+
+def test_on_loan_counter(test_db):
+    book = create_book('popular book', amount=3)
+    users = [create_user(f'reader {i}', 'pwd', Rights.student) for i in range(2)]
+
+    for user in users:
+        resp = send_request(
+            '/books/give_book', MethodsEnum.post, Rights.librarian,
+            params={'user_id': user.id, 'book_id': book.id, 'return_date': str(dt.date.today())}
+        )
+        assert resp.status_code == 200
+
+    resp = send_request(f'/books/info/{book.id}', MethodsEnum.get, Rights.student)
+    assert resp.json()['in_stock'] == 1
+
+    resp = send_request(
+        '/books/remove_book_relation', MethodsEnum.delete, Rights.librarian,
+        params={'user_id': users[0].id, 'book_id': book.id}
+    )
+    assert resp.status_code == 200
+    resp = send_request(f'/books/info/{book.id}', MethodsEnum.get, Rights.student)
+    assert resp.json()['in_stock'] == 2
+
+    book.on_loan = 3  # drift
+    db.add(book)
+    db.commit()
+    assert reconcile_on_loan(db) == 1
+    db.refresh(book)
+    assert book.on_loan == 1
+    assert reconcile_on_loan(db) == 0
+
+
+def test_books_availability(test_db):
+    books = [create_book('book 1', amount=2), create_book('book 2', amount=5),
+             create_book('private book', is_private=True)]
+    user = create_user('reader', 'pwd', Rights.student)
+    resp = send_request(
+        '/books/give_book', MethodsEnum.post, Rights.librarian,
+        params={'user_id': user.id, 'book_id': books[0].id, 'return_date': str(dt.date.today())}
+    )
+    assert resp.status_code == 200
+
+    ids = [book.id for book in books] + [123123123]
+    resp = send_request('/books/availability', MethodsEnum.get, Rights.student,
+                        params={'ids': ids})
+    assert resp.status_code == 200
+    availability = {book['id']: book['in_stock'] for book in resp.json()['books']}
+    assert availability == {books[0].id: 1, books[1].id: 5}
+
+    resp = send_request('/books/availability', MethodsEnum.get, Rights.librarian,
+                        params={'ids': ids})
+    assert len(resp.json()['books']) == 3
+
+    resp = send_request('/books/availability', MethodsEnum.get, Rights.librarian,
+                        params={'ids': list(range(1000))})
+    assert resp.status_code == 422
+
+
+def test_search_by_cursor(test_db):
+    titles = ['b', 'a', 'c', 'a', 'd']
+    books = [create_book(title) for title in titles]
+    create_book('private', is_private=True)
+
+    found, cursor = [], None
+    while True:
+        params = {'size': 2, 'total': True}
+        if cursor:
+            params['cursor'] = cursor
+        resp = send_request('/books/search', MethodsEnum.post, Rights.student, params=params)
+        assert resp.status_code == 200
+        page = resp.json()
+        assert page['total'] == len(titles)
+        assert len(page['results']) <= 2
+        found += page['results']
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+
+    expected = sorted(books, key=lambda book: (book.title, book.id))
+    assert [book['id'] for book in found] == [book.id for book in expected]
+
+    hits = total_count_cache.hits
+    for _ in range(2):  # totals are cached by filters, not by sql
+        resp = send_request('/books/search', MethodsEnum.post, Rights.librarian,
+                            params={'total': True})
+        assert resp.json()['total'] == len(titles) + 1
+    assert total_count_cache.hits == hits + 1
+
+    resp = send_request('/books/search', MethodsEnum.post, Rights.student,
+                        params={'cursor': 'not a cursor'})
+    assert resp.status_code == 422
+
+    resp = send_request('/books/search', MethodsEnum.post, Rights.student,
+                        params={'size': 1000})
+    assert resp.json()['size'] == MAX_ITEMS_PER_PAGE
+    assert resp.json()['total'] is None
+
+    page_resp = send_request('/books/search/1', MethodsEnum.post, Rights.student)
+    assert page_resp.status_code == 200
+    assert page_resp.json()['total'] == len(titles)  # page numbers still work
+
+
+def test_search_by_cursor_truncated(test_db, monkeypatch):
+    monkeypatch.setattr(users.utils, 'SEARCH_MAX_HITS', 3)
+    for i in range(5):
+        create_book(f'война {i}')
+    create_book('мир')
+
+    hits = search_ids_cache.hits
+    found, cursor, truncated = [], None, []
+    while True:
+        params = {'query': 'война', 'size': 2}
+        if cursor:
+            params['cursor'] = cursor
+        page = send_request('/books/search', MethodsEnum.post, Rights.student,
+                            params=params).json()
+        found += page['results']
+        truncated.append(page['truncated'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert len(found) == 3  # only SEARCH_MAX_HITS are paged
+    assert truncated == [True, True]
+    assert search_ids_cache.hits == hits + 1  # next page doesn't search again
+
+    page = send_request('/books/search', MethodsEnum.post, Rights.student,
+                        params={'query': 'мир'}).json()
+    assert len(page['results']) == 1 and not page['truncated']
+
+
+def test_search_relevance(test_db):
+    in_description = create_book('Первая', description='Война и мир')
+    in_title = create_book('Война')
+    in_authors = create_book('Вторая', authors='Война Толстой')
+    create_book('Третья')
+
+    resp = send_request('/books/search/1', MethodsEnum.post, Rights.student,
+                        params={'query': 'Война'})
+    assert resp.status_code == 200
+    page = resp.json()
+    assert page['total'] == 3
+    ids = [book['id'] for book in page['results']]
+    assert sorted(ids) == sorted([in_title.id, in_authors.id, in_description.id])
+
+    found = BookCRUD().search('Война', 2, pagelen=2)
+    assert found.ids == ids[2:]
+    assert found.total == 3
+    assert BookCRUD().search('Война', 3, pagelen=2).ids == []
+
+
+def test_search_reconcile(test_db):
+    books = [create_book(f'Книга {i}') for i in range(12)]
+    assert reconcile('books', db) == {'missing': 0, 'stale': 0, 'orphaned': 0}
+
+    BookCRUD().delete(books[0].id)
+    BookCRUD().update(books[1].id, {'title': 'Старое название'})
+    BookCRUD().create({'id': '123123', 'title': 'Удалённая книга'})
+    db.execute(sqlalchemy.delete(Book).where(Book.id == books[2].id))
+    db.commit()
+
+    expected = {'missing': 1, 'stale': 1, 'orphaned': 2}
+    assert reconcile('books', db, repair=False) == expected
+    assert reconcile('books', db, batch_size=2) == expected
+    assert reconcile('books', db) == {'missing': 0, 'stale': 0, 'orphaned': 0}
+
+    indexed = list(BookCRUD().get_all_indices())
+    assert [doc['id'] for doc in indexed] == sorted(str(book.id) for book in books[:2] + books[3:])
+    assert BookCRUD().search('Книга', 1, pagelen=20).total == 11
+
+
+def test_search_outbox(test_db, monkeypatch):
+    book = create_book('Сказки')
+    changes = db.scalars(sqlalchemy.select(SearchOutbox).where(
+        SearchOutbox.index_name == 'books')).all()
+    assert [(change.doc_id, change.operation) for change in changes] == [(book.id, 'update')]
+    assert BookCRUD().search('Сказки', 1).ids == [book.id]
+
+    def broken_index(changes):
+        raise RuntimeError('index is broken')
+
+    monkeypatch.setattr(core.search.outbox, 'apply', broken_index)
+    resp = send_request(f'/books/edit/{book.id}', MethodsEnum.put, Rights.librarian,
+                        params={'title': 'Былины'})
+    monkeypatch.undo()
+    assert resp.status_code == 200  # row is saved with its change in outbox
+    assert 'index is broken' in core.search.outbox.last_inline_error
+    assert BookCRUD().search('Былины', 1).ids == []
+
+    dispatcher = OutboxDispatcher(session_factory=SessionLocal, batch_size=2)
+    total = db.scalar(sqlalchemy.select(sqlalchemy.func.count()).select_from(SearchOutbox))
+    assert dispatcher.dispatch_all() == total  # applied changes are applied again, it's fine
+    assert BookCRUD().search('Былины', 1).ids == [book.id]
+    assert dispatcher.dispatch_all() == 0
+    assert dispatcher.stats()['pending'] == 0
+
+    db.add(Book(title='Черновик'))
+    db.flush()
+    db.rollback()  # changes of rolled back transaction aren't kept
+    document = BookCRUD.to_document(book)
+    assert send_request(f'/books/delete/{book.id}', MethodsEnum.delete,
+                        Rights.librarian).status_code == 200
+    assert [change.operation for change in db.scalars(sqlalchemy.select(SearchOutbox).where(
+        SearchOutbox.index_name == 'books'))] == ['update', 'update', 'delete']
+
+    BookCRUD().create(document)  # index differs from rows
+    for _ in range(2):
+        replay(db, from_seq=1, names=['books'])
+        assert BookCRUD().search('Былины', 1).ids == []
+
+
+def test_single_outbox_dispatcher(test_db, monkeypatch, tmp_path):
+    def make_dispatcher():
+        return OutboxDispatcher(session_factory=SessionLocal, name='single', interval=3600,
+                                lock=OwnerLock(tmp_path / 'search_outbox.lock'))
+
+    first, second = make_dispatcher(), make_dispatcher()
+    create_book('Сказки')
+    first.start()  # running dispatcher keeps lock
+    try:
+        deadline = time.monotonic() + 5
+        while not first.lock.owned and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert first.lock.owned
+        create_book('Былины')
+        assert second.dispatch_all() == 0  # the other process only waits
+        assert not second.lock.owned
+    finally:
+        first.stop()
+    assert not first.lock.owned
+    assert second.stats()['pending'] == 0
+
+    create_book('Повести')
+    cursor = second.stats()['cursor']
+
+    def concurrent_apply(changes):  # ex. dispatcher without lock
+        with SessionLocal() as other_db:
+            other_db.execute(sqlalchemy.update(SearchOutboxCursor).values(seq=cursor + 10))
+            other_db.commit()
+
+    monkeypatch.setattr(core.search.outbox, 'apply', concurrent_apply)
+    assert second.dispatch() == 0
+    assert second.stats()['cursor'] == cursor + 10  # cursor isn't moved back
+
+
+def test_search_cache(test_db):
+    book = create_book('Пушкин. Сказки')
+    create_book('Пушкин. Черновики', is_private=True)
+
+    def search(query, rights=Rights.student):
+        resp = send_request('/books/search/1', MethodsEnum.post, rights, params={'query': query})
+        assert resp.status_code == 200
+        return [item['title'] for item in resp.json()['results']]
+
+    hits = search_cache.hits
+    assert search('Пушкин') == ['Пушкин. Сказки']
+    assert search('  пушкин ') == ['Пушкин. Сказки']  # normalized query is found in cache
+    assert search_cache.hits == hits + 1
+    assert len(search('Пушкин', Rights.librarian)) == 2  # visibility is a part of key
+
+    version = get_table_version()
+    send_request(f'/books/edit/{book.id}', MethodsEnum.put, Rights.librarian,
+                 params={'title': 'Пушкин. Стихи'})
+    assert get_table_version() > version
+    assert search('Пушкин') == ['Пушкин. Стихи']
+
+    # changes made without index are seen too
+    db.execute(sqlalchemy.update(Book).where(Book.id == book.id).values(title='Пушкин. Поэмы'))
+    db.commit()
+    assert search('Пушкин') == ['Пушкин. Поэмы']
+
+    version = get_table_version()
+    db.execute(sqlalchemy.select(Book)).all()
+    db.commit()
+    assert get_table_version() == version
+
+
+def test_search_filters_in_index(test_db):
+    public = [create_book(f'Учебник {i}', edition_date=2000 + i % 2) for i in range(12)]
+    private = [create_book(f'Учебник {i}', is_private=True) for i in range(12, 24)]
+
+    def search(rights, page=1, **params):
+        resp = send_request(f'/books/search/{page}', MethodsEnum.post, rights,
+                            params={'query': 'Учебник', **params})
+        assert resp.status_code == 200
+        return resp.json()
+
+    # private books don't take places of public ones on pages
+    first, second = search(Rights.student), search(Rights.student, page=2)
+    assert first['total'] == 12
+    assert len(first['results']) == 10
+    assert {book['id'] for book in first['results'] + second['results']} == {
+        book.id for book in public}
+
+    assert search(Rights.librarian)['total'] == 24
+    filtered = search(Rights.student, edition_date=2001)
+    assert filtered['total'] == 6
+    assert {book['edition_date'] for book in filtered['results']} == {2001}
+
+    send_request(f'/books/edit/{private[0].id}', MethodsEnum.put, Rights.librarian,
+                 params={'edition_date': 2001})
+    assert search(Rights.librarian, edition_date=2001)['total'] == 7
+    assert search(Rights.student, edition_date=2001)['total'] == 6
+
+
+def test_search_facets(test_db):
+    create_book('Сказки', authors='Пушкин А.С.', edition_date=1995)
+    create_book('Сказки народов', authors='Пушкин А.С., Гоголь Н.В.', edition_date=2005)
+    create_book('Сказки для взрослых', authors='Гоголь Н.В.', edition_date=2007)
+    create_book('Сказки тайные', authors='Лермонтов М.Ю.', edition_date=2007, is_private=True)
+    create_book('Стихи', authors='Лермонтов М.Ю.', edition_date=2007)
+
+    def search(page=1, rights=Rights.student, **params):
+        resp = send_request(f'/books/search/{page}', MethodsEnum.post, rights,
+                            params={'facets': True, **params})
+        assert resp.status_code == 200
+        return resp.json()
+
+    page = search(query='Сказки')
+    assert page['total'] == 3
+    assert page['facets'] == {
+        'authors': [{'author': 'Гоголь Н.В.', 'count': 2}, {'author': 'Пушкин А.С.', 'count': 2}],
+        'edition_years': [{'start': 1990, 'end': 2000, 'count': 1},
+                          {'start': 2000, 'end': 2010, 'count': 2}],
+    }
+    hits = facets_cache.hits
+    assert search(page=2, query='сказки')['facets'] == page['facets']
+    assert facets_cache.hits == hits + 1
+
+    librarian_facets = search(query='Сказки', rights=Rights.librarian)['facets']
+    assert {'author': 'Лермонтов М.Ю.', 'count': 1} in librarian_facets['authors']
+
+    everything = search()  # facets for empty query are counted for all books
+    assert everything['total'] == 4
+    assert sum(item['count'] for item in everything['facets']['edition_years']) == 4
+    filtered = search(edition_date=2007)
+    assert filtered['total'] == 2
+    assert {book['edition_date'] for book in filtered['results']} == {2007}
+    assert filtered['facets']['edition_years'] == [{'start': 2000, 'end': 2010, 'count': 2}]
+    assert search(query='Сказки', edition_date=2007)['facets']['authors'] == [
+        {'author': 'Гоголь Н.В.', 'count': 1}]
+
+    resp = send_request('/books/search/1', MethodsEnum.post, Rights.student,
+                        params={'query': 'Сказки'})
+    assert resp.json()['facets'] is None
@@ -4,11 +4,11 @@ import os
 import uuid
 from . import schemes
 from aiocsv import AsyncReader, AsyncWriter
+from config import SEARCH_FACET_AUTHORS
 from fastapi import UploadFile
 from typing import List, Union
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from models import Book
-from core.search.cruds import BookCRUD as BookSearchCRUD
 
 
 async def generate_filename(path, ext):
@@ -47,6 +47,19 @@ def converter_book_scheme(book):
     )
 
 
+def converter_facets(groups: dict):
+    """Converts facets counted by search engine: top authors and not empty ranges of years"""
+    authors = sorted(groups['authors'].items(), key=lambda item: (-item[1], item[0]))
+    return schemes.BookFacetsForm(
+        authors=[schemes.AuthorFacetForm(author=author, count=count)
+                 for author, count in authors[:SEARCH_FACET_AUTHORS]],
+        edition_years=[schemes.EditionYearsFacetForm(start=years[0], end=years[1], count=count)
+                       for years, count in sorted(groups['edition_years'].items(),
+                                                  key=lambda item: item[0] or (0, 0))
+                       if years is not None]
+    )
+
+
 async def remove_book_image(filename):
     path = STATIC_PATH / 'images' / filename
     if os.path.exists(path):
@@ -55,6 +68,7 @@ async def remove_book_image(filename):
 
 async def handle_csv(file: UploadFile, handle_func, **kwargs):
     path = STATIC_PATH / 'temp'
+    os.makedirs(path, exist_ok=True)
     filename = await generate_filename(path, '.csv')
     path = path / filename
     await save_file(file, path)
@@ -64,14 +78,12 @@ async def handle_csv(file: UploadFile, handle_func, **kwargs):
             await reader.__anext__()
 
             async for line in reader:
-                if kwargs.get('max_id'):
-                    kwargs['max_id'] += 1
                 await handle_func(line, **kwargs)
     finally:
         os.remove(path)
 
 
-async def handle_books(line: list, db: Session, images: List[Union[UploadFile, None]]):
+async def handle_books(line: list, db: AsyncSession, images: List[Union[UploadFile, None]]):
     title, authors, desc, amount, edition, image_filename = line
     book = Book(
         title=title,
@@ -87,18 +99,12 @@ async def handle_books(line: list, db: Session, images: List[Union[UploadFile, N
             filename = await save_image(image[0])
             book.image = filename
     db.add(book)
-    db.commit()
-
-    BookSearchCRUD().create({
-        'id': str(book.id),
-        'title': book.title,
-        'description': book.description,
-        'authors': book.authors
-    })
+    await db.commit()
 
 
 async def write_to_csv(query, func, header, **kwargs):
     path = STATIC_PATH / 'temp'
+    os.makedirs(path, exist_ok=True)
     filename = await generate_filename(path, '.csv')
     path = path / filename
 
@@ -5,15 +5,20 @@ import core.exceptions
 import core.validators
 from . import schemes as book_schemes
 from typing import Annotated, Optional, List
-from auth.utils import get_current_user
-from sqlalchemy.orm import Session
-from .utils import (save_image, delete_image, converter_book_scheme,
+from auth.utils import get_token_user
+from auth.schemes import Principal
+from sqlalchemy.ext.asyncio import AsyncSession
+import sqlalchemy
+from .utils import (save_image, delete_image, converter_book_scheme, converter_facets,
                     handle_books, remove_book_image, handle_csv, write_to_csv, book_write_func,
                     remove_file)
-from config import STATIC_PATH
-from users.utils import paginate
+from config import STATIC_PATH, AVAILABILITY_MAX_IDS, MAX_ITEMS_PER_PAGE, SEARCH_MAX_HITS
+from users.utils import (paginate, keyset_paginate, fetch_in_order, search_ids,
+                         normalize_query)
+from .cache import (search_cache, search_cache_key, facets_cache, facets_cache_key,
+                    get_table_version)
 import os
-from core.search.cruds import BookCRUD as BookSearchCRUD
+from core.search import BookCRUD as BookSearchCRUD
 import datetime as dt
 
 router = fastapi.APIRouter()
@@ -29,27 +34,53 @@ router = fastapi.APIRouter()
 - only authenticated user can get public (not private) book
     ''')
 async def get_book(book_id: int,
-                   current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
-                   db: Session = fastapi.Depends(get_db)):
-    book = db.query(models.Book).filter(models.Book.id == book_id).first()
+                   current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
+                   db: AsyncSession = fastapi.Depends(get_db)):
+    book = await db.scalar(sqlalchemy.select(models.Book).where(models.Book.id == book_id))
     if not book or (book.is_private and not await core.validators.is_librarian(current_user)):
         raise core.exceptions.BookDoesNotExistException()
 
-    in_stock = (
-        book.amount -
-        db.query(models.BookCarriers).filter(models.BookCarriers.c.book_id == book_id).count()
-    )
-
     return book_schemes.BookResponseModel(
         title=book.title,
         authors=book.authors,
         description=book.description,
         edition_date=book.edition_date,
-        in_stock=in_stock,
+        in_stock=book.amount - book.on_loan,
         is_private=book.is_private,
     )
 
 
+@router.get(
+    '/availability',
+    response_model=book_schemes.BookAvailabilityListForm,
+    description=f'''
+## Get amount of books in stock for list of books
+**Params:**
+- _ids_ parameter is list of book ids (max {AVAILABILITY_MAX_IDS}), ex. _?ids=1&ids=2_
+
+**Note:** books, which don't exist or aren't available for you (private), are skipped
+    ''')
+async def get_books_availability(
+        current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
+        ids: List[int] = fastapi.Query(),
+        db: AsyncSession = fastapi.Depends(get_db)):
+    if len(ids) > AVAILABILITY_MAX_IDS:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f'Too many ids (max {AVAILABILITY_MAX_IDS})'
+        )
+
+    query = sqlalchemy.select(models.Book.id, models.Book.amount, models.Book.on_loan)\
+        .where(models.Book.id.in_(ids))
+    if not await core.validators.is_librarian(current_user):
+        query = query.where(models.Book.is_private == False)  # noqa
+
+    return book_schemes.BookAvailabilityListForm(books=[
+        book_schemes.BookAvailabilityForm(id=book_id, in_stock=amount - on_loan)
+        for book_id, amount, on_loan in await db.execute(query)
+    ])
+
+
 @router.get(
     '/media/{book_id}',
     response_class=fastapi.responses.FileResponse,
@@ -60,10 +91,10 @@ async def get_book(book_id: int,
 '''
 )
 async def get_book_image(book_id: int,
-                         current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
-                         db: Session = fastapi.Depends(get_db)
+                         current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
+                         db: AsyncSession = fastapi.Depends(get_db)
                          ):
-    book = db.query(models.Book).filter(models.Book.id == book_id).first()
+    book = await db.scalar(sqlalchemy.select(models.Book).where(models.Book.id == book_id))
 
     if not book or (book.is_private and not await core.validators.is_librarian(current_user)):
         raise core.exceptions.BookDoesNotExistException()
@@ -97,11 +128,11 @@ async def get_book_image(book_id: int,
 - _edition_date_ parameter is an integer (ex. 2022), which is year when book was published
 - _amount_ parameter is integer, which describes amount of books of this type in library
     ''')
-async def create_book(current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+async def create_book(current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
                       form: Annotated[book_schemes.BookCreateRequestForm, fastapi.Depends()],
                       image: Optional[fastapi.UploadFile] = fastapi.File(
                           None, media_type='image/webp'),
-                      db: Session = fastapi.Depends(get_db),
+                      db: AsyncSession = fastapi.Depends(get_db),
                       ):
     if await core.validators.is_librarian(current_user):
         book = models.Book(
@@ -118,14 +149,7 @@ async def create_book(current_user: Annotated[models.User, fastapi.Depends(get_c
             book.image = filename
 
         db.add(book)
-        db.commit()
-
-        BookSearchCRUD().create({
-            'id': str(book.id),
-            'title': book.title,
-            'description': book.description,
-            'authors': book.authors
-        })
+        await db.commit()
 
         return book_schemes.ShortBookForm(
             id=book.id,
@@ -146,13 +170,13 @@ async def create_book(current_user: Annotated[models.User, fastapi.Depends(get_c
 - _amount_ parameter is integer, which describes amount of books of this type in library
 ''')
 async def edit_book(book_id: int,
-                    current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+                    current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
                     form: Annotated[book_schemes.BookEditRequestForm, fastapi.Depends()],
                     image: Optional[fastapi.UploadFile] = fastapi.File(
                         None, media_type='image/webp'),
-                    db: Session = fastapi.Depends(get_db)):
+                    db: AsyncSession = fastapi.Depends(get_db)):
     if await core.validators.is_librarian(current_user):
-        book = db.query(models.Book).filter(models.Book.id == book_id).first()
+        book = await db.scalar(sqlalchemy.select(models.Book).where(models.Book.id == book_id))
         if book is None:
             raise core.exceptions.BookDoesNotExistException()
 
@@ -169,14 +193,8 @@ async def edit_book(book_id: int,
         book.is_private = form.is_private or book.is_private
         book.edition_date = form.edition_date or book.edition_date
 
-        BookSearchCRUD().update(book.id, {
-            'title': book.title,
-            'description': book.description,
-            'authors': book.authors
-        })
-
         db.add(book)
-        db.commit()
+        await db.commit()
         return fastapi.status.HTTP_200_OK
     raise core.exceptions.NotEnoughRightsException()
 
@@ -188,23 +206,23 @@ async def edit_book(book_id: int,
 **Note:** you **can't** delete book if users, who have not returned book of this type, exists
     ''')
 async def delete_book(book_id: int,
-                      current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
-                      db: Session = fastapi.Depends(get_db)):
+                      current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
+                      db: AsyncSession = fastapi.Depends(get_db)):
     if await core.validators.is_librarian(current_user):
-        query = db.query(models.Book).filter(models.Book.id == book_id)
-        book = query.first()
+        book = await db.scalar(sqlalchemy.select(models.Book).where(models.Book.id == book_id))
         if book is None:
             raise core.exceptions.BookDoesNotExistException()
-        if len(book.owners) != 0:
+        has_owners = await db.scalar(sqlalchemy.select(sqlalchemy.exists().where(
+            models.BookCarriers.c.book_id == book_id)))
+        if has_owners:
             raise fastapi.exceptions.HTTPException(
                 status_code=fastapi.status.HTTP_422_UNPROCESSABLE_ENTITY,
                 detail='Book has owners!'
             )
         if book.image:
             await remove_book_image(book.image)
-        BookSearchCRUD().delete(book.id)
-        query.delete()
-        db.commit()
+        await db.delete(book)  # not by query: search outbox gets change from session
+        await db.commit()
 
         return fastapi.status.HTTP_200_OK
 
@@ -219,13 +237,15 @@ async def delete_book(book_id: int,
 - set return date, when user must return book. Otherwise librarian can find this user in debtors.
  Librarian can change return date...
     ''')
-async def give_user_book(current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+async def give_user_book(current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
                          form: Annotated[book_schemes.GiveReturnBookForm, fastapi.Depends()],
-                         db: Session = fastapi.Depends(get_db)
+                         db: AsyncSession = fastapi.Depends(get_db)
                          ):
     if await core.validators.is_librarian(current_user):
-        user = db.query(models.User).filter(models.User.id == form.user_id).first()
-        book = db.query(models.Book).filter(models.Book.id == form.book_id).first()
+        user = await db.scalar(
+            sqlalchemy.select(models.User).where(models.User.id == form.user_id))
+        book = await db.scalar(
+            sqlalchemy.select(models.Book).where(models.Book.id == form.book_id))
 
         if not user:
             raise core.exceptions.UserDoesNotExistException()
@@ -233,8 +253,12 @@ async def give_user_book(current_user: Annotated[models.User, fastapi.Depends(ge
             raise core.exceptions.BookDoesNotExistException()
         query = models.BookCarriers.insert().values(
             book_id=book.id, user_id=user.id, return_date=form.return_date)
-        db.execute(query)
-        db.commit()
+        await db.execute(query)
+        await db.execute(
+            sqlalchemy.update(models.Book).where(models.Book.id == book.id)
+            .values(on_loan=models.Book.on_loan + 1)
+        )
+        await db.commit()
         return fastapi.status.HTTP_200_OK
 
     raise core.exceptions.NotEnoughRightsException()
@@ -247,26 +271,28 @@ async def give_user_book(current_user: Annotated[models.User, fastapi.Depends(ge
 - _return_date_ field can be only in this format: _"{year}-{month}-{day}"_ (ex. 2000-12-30)
     ''')
 async def change_return_date(
-        current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+        current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
         user_id: int,
         book_id: int,
         form: Annotated[book_schemes.ChangeReturnDateForm, fastapi.Depends()],
-        db: Session = fastapi.Depends(get_db)):
+        db: AsyncSession = fastapi.Depends(get_db)):
     if await core.validators.is_librarian(current_user):
-        relation = db.query(models.BookCarriers)\
-            .filter(models.BookCarriers.c.book_id == book_id)\
-            .filter(models.BookCarriers.c.user_id == user_id).first()
+        relation = (await db.execute(
+            sqlalchemy.select(models.BookCarriers)
+            .where(models.BookCarriers.c.book_id == book_id)
+            .where(models.BookCarriers.c.user_id == user_id)
+        )).first()
         if not relation:
             raise fastapi.exceptions.HTTPException(
                 status_code=fastapi.status.HTTP_404_NOT_FOUND,
                 detail='Relationship doesn\'t exist!'
             )
         query = models.BookCarriers.update().where(
-            models.BookCarriers.c.book_id == book_id and
+            models.BookCarriers.c.book_id == book_id,
             models.BookCarriers.c.user_id == user_id
         ).values(return_date=form.return_date)
-        db.execute(query)
-        db.commit()
+        await db.execute(query)
+        await db.commit()
         return fastapi.status.HTTP_200_OK
 
     raise core.exceptions.NotEnoughRightsException()
@@ -280,26 +306,32 @@ I.e. user returns book to the library
     '''
 )
 async def remove_book_relation(
-    current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+    current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
     user_id: int,
-    book_id,
-    db: Session = fastapi.Depends(get_db)
+    book_id: int,
+    db: AsyncSession = fastapi.Depends(get_db)
 ):
     if await core.validators.is_librarian(current_user):
-        relation = db.query(models.BookCarriers)\
-            .filter(models.BookCarriers.c.book_id == book_id)\
-            .filter(models.BookCarriers.c.user_id == user_id).first()
+        relation = (await db.execute(
+            sqlalchemy.select(models.BookCarriers)
+            .where(models.BookCarriers.c.book_id == book_id)
+            .where(models.BookCarriers.c.user_id == user_id)
+        )).first()
         if not relation:
             raise fastapi.exceptions.HTTPException(
                 status_code=fastapi.status.HTTP_404_NOT_FOUND,
                 detail='Relationship doesn\'t exist!'
             )
         query = models.BookCarriers.delete().where(
-            models.BookCarriers.c.book_id == book_id and
+            models.BookCarriers.c.book_id == book_id,
             models.BookCarriers.c.user_id == user_id
         )
-        db.execute(query)
-        db.commit()
+        deleted = (await db.execute(query)).rowcount
+        await db.execute(
+            sqlalchemy.update(models.Book).where(models.Book.id == book_id)
+            .values(on_loan=models.Book.on_loan - deleted)
+        )
+        await db.commit()
         return fastapi.status.HTTP_200_OK
 
     raise core.exceptions.NotEnoughRightsException()
@@ -312,15 +344,20 @@ async def remove_book_relation(
 ## Get info about books, which user has
     '''
 )
-async def get_user_books(current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+async def get_user_books(current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
                          user_id: int,
-                         db: Session = fastapi.Depends(get_db)):
+                         db: AsyncSession = fastapi.Depends(get_db)):
     if await core.validators.is_librarian(current_user) or user_id == current_user.id:
-        user = db.query(models.User).filter(models.User.id == user_id).first()
+        user = await db.scalar(sqlalchemy.select(models.User).where(models.User.id == user_id))
         if not user:
             raise core.exceptions.UserDoesNotExistException()
+        books = await db.scalars(
+            sqlalchemy.select(models.Book)
+            .join(models.BookCarriers, models.BookCarriers.c.book_id == models.Book.id)
+            .where(models.BookCarriers.c.user_id == user_id)
+        )
         result = book_schemes.BookListForm(books=[])
-        for book in user.books:
+        for book in books:
             result.books.append(book_schemes.ShortBookForm(
                 id=book.id,
                 title=book.title,
@@ -340,15 +377,17 @@ async def get_user_books(current_user: Annotated[models.User, fastapi.Depends(ge
     '''
 )
 async def get_book_return_date(
-    current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+    current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
     user_id: int,
     book_id: int,
-    db: Session = fastapi.Depends(get_db)
+    db: AsyncSession = fastapi.Depends(get_db)
 ):
     if current_user.id == user_id or await core.validators.is_librarian(current_user):
-        relation = db.query(models.BookCarriers)\
-            .filter(models.BookCarriers.c.book_id == book_id)\
-            .filter(models.BookCarriers.c.user_id == user_id).first()
+        relation = (await db.execute(
+            sqlalchemy.select(models.BookCarriers)
+            .where(models.BookCarriers.c.book_id == book_id)
+            .where(models.BookCarriers.c.user_id == user_id)
+        )).first()
         if not relation:
             raise fastapi.exceptions.HTTPException(
                 status_code=fastapi.status.HTTP_404_NOT_FOUND,
@@ -363,31 +402,104 @@ async def get_book_return_date(
     '/search/{page}',
     description='''
 ## Searches through indexed values and returns results by page
+Found books are sorted by relevance (matches in title weigh more than in authors and description)
 * You can set optional filter for _edition_date_ to filter books
 * Empty _query_ parameter makes you get all books
-    '''
+* set _facets_ to get top authors and amounts of books by ranges of edition years
+(counted for all found books)
+    ''',
+    response_model=book_schemes.BookSearchPageForm
 )
-async def search_book(current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+async def search_book(current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
                       page: int,
                       query: str = None,
                       edition_date: Optional[int] = None,
-                      db: Session = fastapi.Depends(get_db)
+                      facets: bool = False,
+                      db: AsyncSession = fastapi.Depends(get_db)
                       ):
-    ids = []
+    is_librarian = await core.validators.is_librarian(current_user)
+    cache_key = search_cache_key(query, edition_date, page, is_librarian, facets)
+    result = search_cache.get(cache_key)
+    if result is not None:
+        return result
+
+    facets_form = None
+    if facets:
+        facets_key = facets_cache_key(query, edition_date, is_librarian)
+        facets_form = facets_cache.get(facets_key)
+    groupedby = BookSearchCRUD.facets() if facets and facets_form is None else None
+    search_filter = BookSearchCRUD.filter(edition_date, with_private=is_librarian)
+
+    book_query = sqlalchemy.select(models.Book)
+    if not is_librarian:
+        book_query = book_query.where(models.Book.is_private == False)  # noqa
+    if edition_date:  # the same filter as in index, so page and facets count the same books
+        book_query = book_query.where(models.Book.edition_date == edition_date)
+    if not query:
+        page_form = await paginate(page, book_query, converter_book_scheme, db)
+        total, books = page_form.total, page_form.results
+        if groupedby:
+            found = BookSearchCRUD().search(query, 1, pagelen=1, filter=search_filter,
+                                            groupedby=groupedby)
+    else:
+        found = BookSearchCRUD().search(query, page, filter=search_filter, groupedby=groupedby)
+        books = await fetch_in_order(book_query, models.Book, found.ids, db)
+        total, books = found.total, list(map(converter_book_scheme, books))
+
+    if groupedby:
+        facets_form = converter_facets(found.groups)
+        facets_cache.set(facets_key, facets_form)
+    result = book_schemes.BookSearchPageForm(
+        total=total,
+        page=page,
+        results=books,
+        facets=facets_form
+    )
+    search_cache.set(cache_key, result)
+    return result
 
-    if query:
-        ids = list(map(lambda item: int(item['id']), BookSearchCRUD().search(query, page)))
-    book_query = db.query(models.Book)
-    if ids:
-        book_query = book_query.filter(models.Book.id.in_(ids))
-        if edition_date:
-            book_query = book_query.filter(models.Book.edition_date == edition_date)
-    elif not ids and query:
-        book_query = book_query.filter(False)
-    if not await core.validators.is_librarian(current_user):
-        book_query = book_query.filter(models.Book.is_private == False)  # noqa
 
-    return paginate(page, book_query, converter_book_scheme)
+@router.post(
+    '/search',
+    description=f'''
+## Searches through indexed values and returns results by cursor
+Books are sorted by title. To get next page send _next_cursor_ from previous page as _cursor_
+* You can set optional filter for _edition_date_ to filter books
+* Empty _query_ parameter makes you get all books
+* _size_ is amount of books on page (max {MAX_ITEMS_PER_PAGE})
+* set _total_ to get total amount of found books (it may be cached for a while)
+* with _query_ only the best {SEARCH_MAX_HITS} found books are paged, _truncated_ is true
+if more books were found (refine query to see them)
+    '''
+)
+async def search_book_by_cursor(
+        current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
+        query: str = None,
+        edition_date: Optional[int] = None,
+        cursor: str = None,
+        size: Optional[int] = fastapi.Query(None, ge=1),
+        total: bool = False,
+        db: AsyncSession = fastapi.Depends(get_db)
+):
+    is_librarian = await core.validators.is_librarian(current_user)
+    book_query = sqlalchemy.select(models.Book)
+    truncated = False
+    key = (edition_date, is_librarian, get_table_version())
+    if query:
+        crud = BookSearchCRUD()
+        ids, truncated = search_ids(
+            crud, query, filter=BookSearchCRUD.filter(edition_date, with_private=is_librarian),
+            key=key)
+        key += (normalize_query(query), crud.generation())
+        book_query = book_query.where(models.Book.id.in_(ids))
+    if edition_date:
+        book_query = book_query.where(models.Book.edition_date == edition_date)
+    if not is_librarian:
+        book_query = book_query.where(models.Book.is_private == False)  # noqa
+
+    return await keyset_paginate(book_query, models.Book, converter_book_scheme, db,
+                                 cursor=cursor, size=size, with_total=total, truncated=truncated,
+                                 total_key=key)
 
 
 @router.post(
@@ -409,13 +521,14 @@ _delimiter = ";"_ <br>
 - if you don't load images **do not** send empty value
     ''')
 async def load_books(csv_file: fastapi.UploadFile,
-                     current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+                     current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
                      images: List[fastapi.UploadFile] = fastapi.File(None, media_type='image/png'),
-                     db: Session = fastapi.Depends(get_db)):
+                     db: AsyncSession = fastapi.Depends(get_db)):
     if not isinstance(images, list):
         images = []
     if await core.validators.is_librarian(current_user):
         try:
+            # books are indexed from search outbox after every commit
             await handle_csv(file=csv_file, handle_func=handle_books, db=db, images=images)
             return fastapi.status.HTTP_200_OK
         except Exception as exc:
@@ -436,16 +549,16 @@ async def load_books(csv_file: fastapi.UploadFile,
 | ...   | ...     | ...         | ...    | ...                 | ...              |
     ''')
 async def get_books_csv(
-    current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+    current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
     background_tasks: fastapi.BackgroundTasks,
-    db: Session = fastapi.Depends(get_db),
+    db: AsyncSession = fastapi.Depends(get_db),
 ):
     """ Out file format:
     ___
     Title | Authors | Description | Amount | Edition date (year) | image (filename)
     """
     if await core.validators.is_librarian(current_user):
-        books = db.query(models.Book).all()
+        books = await db.scalars(sqlalchemy.select(models.Book))
         header = ['Title',  'Authors', 'Description', 'Amount', 'Edition date', 'image']
         try:
             path = await write_to_csv(books, book_write_func, header)
@@ -467,19 +580,20 @@ async def get_books_csv(
 - _return_date_ param can be filled by your date. Default date is today
 ''')
 async def get_debtors(
-    current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+    current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
     return_date: dt.date = None,
-    db: Session = fastapi.Depends(get_db)
+    db: AsyncSession = fastapi.Depends(get_db)
 ):
     if return_date is None:
         return_date = dt.date.today()
 
     if await core.validators.is_librarian(current_user):
-        query_result = db.query(models.BookCarriers, models.User, models.Book)\
-            .filter(models.BookCarriers.c.return_date < return_date)\
-            .filter(models.BookCarriers.c.user_id == models.User.id)\
-            .filter(models.BookCarriers.c.book_id == models.Book.id)\
-            .all()
+        query_result = await db.execute(
+            sqlalchemy.select(models.BookCarriers, models.User, models.Book)
+            .where(models.BookCarriers.c.return_date < return_date)
+            .where(models.BookCarriers.c.user_id == models.User.id)
+            .where(models.BookCarriers.c.book_id == models.Book.id)
+        )
 
         temp = {}
         for _, book_id, user_id, date, user, book in query_result:
@@ -4,7 +4,18 @@ import pathlib
 
 load_dotenv()
 
+
+def choice(name: str, default: str, choices: tuple):
+    """Value of environment variable which must be one of _choices_"""
+    value = os.environ.get(name, default=default)
+    if value not in choices:
+        raise ValueError(f'{name} must be one of {", ".join(choices)}, not {value!r}')
+    return value
+
+
 SQLALCHEMY_DATABASE_URL = os.environ.get('DB_URL', default='sqlite:///./app.db')
+ASYNC_SQLALCHEMY_DATABASE_URL = os.environ.get(
+    'ASYNC_DB_URL', default=SQLALCHEMY_DATABASE_URL.replace('sqlite://', 'sqlite+aiosqlite://', 1))
 PASSWORD_LENGTH = int(os.environ.get('PASSWORD_LENGTH', default=8))
 SECRET_KEY = os.environ.get('SECRET_KEY', default='NOT SECRET!')
 REFRESH_TOKEN_EXPIRES = int(os.environ.get('REFRESH_TOKEN_EXPIRE_DAYS',
@@ -16,3 +27,61 @@ STATIC_PATH = pathlib.Path(__file__).resolve().parent / os.environ.get('STATIC_P
                                                                        default='static')
 SEARCHER_PATH = pathlib.Path(__file__).resolve().parent / os.environ.get('SEARCHER_PATH',
                                                                          default='static')
+PASSWORD_HASHING_WORKERS = int(os.environ.get('PASSWORD_HASHING_WORKERS',
+                                              default=os.cpu_count() or 1))
+PASSWORD_HASHING_QUEUE_SIZE = int(os.environ.get('PASSWORD_HASHING_QUEUE_SIZE', default=100))
+BULK_HASHING_PROCESSES = int(os.environ.get('BULK_HASHING_PROCESSES', default=os.cpu_count() or 1))
+BULK_HASHING_MIN_SIZE = int(os.environ.get('BULK_HASHING_MIN_SIZE', default=16))
+USERS_CHUNK_SIZE = int(os.environ.get('USERS_CHUNK_SIZE', default=500))
+USERS_CREATE_ATTEMPTS = int(os.environ.get('USERS_CREATE_ATTEMPTS', default=3))
+PRINCIPAL_CACHE_SIZE = int(os.environ.get('PRINCIPAL_CACHE_SIZE', default=1024))
+PRINCIPAL_CACHE_TTL = int(os.environ.get('PRINCIPAL_CACHE_TTL', default=60))
+AUTH_MODE = os.environ.get('AUTH_MODE', default='strict')  # strict / claims
+# seconds between checks of changed users in claims auth mode
+AUTH_CLAIMS_CHECK_INTERVAL = float(os.environ.get('AUTH_CLAIMS_CHECK_INTERVAL', default=1))
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', default=5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', default=10))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', default=3600))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', default=30))
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', default=256 * 1024 * 1024))
+SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', default=-64000))  # < 0 means KiB
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', default=5000))  # ms
+AVAILABILITY_MAX_IDS = int(os.environ.get('AVAILABILITY_MAX_IDS', default=100))
+MAX_ITEMS_PER_PAGE = int(os.environ.get('MAX_ITEMS_PER_PAGE', default=100))
+TOTAL_COUNT_CACHE_TTL = int(os.environ.get('TOTAL_COUNT_CACHE_TTL', default=30))
+SEARCH_MAX_HITS = int(os.environ.get('SEARCH_MAX_HITS', default=1000))
+SEARCHER_CHECK_INTERVAL = float(os.environ.get('SEARCHER_CHECK_INTERVAL', default=1))  # seconds
+# background / immediate / buffered / shared (one process of several commits changes of all)
+SEARCH_WRITER_MODE = choice('SEARCH_WRITER_MODE', 'background',
+                            ('background', 'immediate', 'buffered', 'shared'))
+SEARCH_WRITER_BATCH_SIZE = int(os.environ.get('SEARCH_WRITER_BATCH_SIZE', default=500))
+SEARCH_WRITER_FLUSH_INTERVAL = float(os.environ.get('SEARCH_WRITER_FLUSH_INTERVAL',
+                                                    default=2))  # seconds
+# seconds before next try when index is locked by another writer
+SEARCH_WRITER_RETRY_DELAY = float(os.environ.get('SEARCH_WRITER_RETRY_DELAY', default=0.5))
+# queue of changes in shared mode
+SEARCH_QUEUE_PATH = SEARCHER_PATH / os.environ.get('SEARCH_QUEUE_PATH', default='index_queue.db')
+# seconds between checks of queue (and of lock of index by process which doesn't own it)
+SEARCH_QUEUE_POLL_INTERVAL = float(os.environ.get('SEARCH_QUEUE_POLL_INTERVAL', default=0.2))
+# seconds between checks of search outbox by dispatcher
+SEARCH_OUTBOX_INTERVAL = float(os.environ.get('SEARCH_OUTBOX_INTERVAL', default=1))
+# seconds while applied changes are kept in search outbox (for replay)
+SEARCH_OUTBOX_RETENTION = int(os.environ.get('SEARCH_OUTBOX_RETENTION', default=7 * 24 * 3600))
+SEARCH_RECONCILE_INTERVAL = int(os.environ.get('SEARCH_RECONCILE_INTERVAL', default=0))  # 0 - off
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', default=1024))
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', default=60))
+SEARCH_FACET_AUTHORS = int(os.environ.get('SEARCH_FACET_AUTHORS', default=10))  # top authors
+SEARCH_FACET_YEARS_FROM = int(os.environ.get('SEARCH_FACET_YEARS_FROM', default=1900))
+SEARCH_FACET_YEARS_GAP = int(os.environ.get('SEARCH_FACET_YEARS_GAP', default=10))
+SEARCH_FACET_CACHE_SIZE = int(os.environ.get('SEARCH_FACET_CACHE_SIZE', default=256))
+SEARCH_MODES = ('exact', 'fuzzy', 'ngram')
+SEARCH_MODE = choice('SEARCH_MODE', 'fuzzy', SEARCH_MODES)
+# part of word's 2- and 3-letter grams which must be found in ngram search mode
+SEARCH_NGRAM_MIN_MATCH = float(os.environ.get('SEARCH_NGRAM_MIN_MATCH', default=0.5))
+SEARCH_BACKEND = choice('SEARCH_BACKEND', 'whoosh', ('whoosh', 'fts5'))  # fts5 is sqlite only
+# full / compact: all fields or only ids are stored in search indexes
+SEARCH_SCHEME = choice('SEARCH_SCHEME', 'full', ('full', 'compact'))
+# shards of books' index for new index and reindex (existing index keeps its amount until reindex)
+SEARCH_BOOK_SHARDS = int(os.environ.get('SEARCH_BOOK_SHARDS', default=1))
+# threads searching shards in parallel
+SEARCH_SHARD_THREADS = int(os.environ.get('SEARCH_SHARD_THREADS', default=os.cpu_count() or 1))
@@ -1,18 +1,71 @@
 import sqlalchemy
-from config import SQLALCHEMY_DATABASE_URL
+import sqlalchemy.orm
+import sqlalchemy.pool
+import sqlalchemy.ext.asyncio
+from config import (SQLALCHEMY_DATABASE_URL, ASYNC_SQLALCHEMY_DATABASE_URL, DB_POOL_SIZE,
+                    DB_MAX_OVERFLOW, DB_POOL_RECYCLE, DB_POOL_TIMEOUT, SQLITE_MMAP_SIZE,
+                    SQLITE_CACHE_SIZE, SQLITE_BUSY_TIMEOUT)
 from models import Base
 
-engine = sqlalchemy.create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={'check_same_thread': False}
-)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers work while somebody writes, busy_timeout makes writers
+    wait for lock instead of failing with "database is locked"
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+    cursor.execute(f'PRAGMA cache_size={SQLITE_CACHE_SIZE}')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}')
+    cursor.close()
+
+
+def is_sqlite(url: str):
+    return sqlalchemy.engine.make_url(url).get_backend_name() == 'sqlite'
+
+
+def get_engine_options(url: str, poolclass):
+    options = {}
+    if is_sqlite(url):
+        if sqlalchemy.engine.make_url(url).database in (None, '', ':memory:'):
+            return options
+        options['poolclass'] = poolclass
+    options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                   pool_recycle=DB_POOL_RECYCLE, pool_timeout=DB_POOL_TIMEOUT)
+    return options
+
+
+def create_engine(url: str):
+    options = get_engine_options(url, sqlalchemy.pool.QueuePool)
+    if is_sqlite(url):
+        options['connect_args'] = {'check_same_thread': False}
+    engine = sqlalchemy.create_engine(url, **options)
+    if is_sqlite(url):
+        sqlalchemy.event.listen(engine, 'connect', set_sqlite_pragmas)
+    return engine
+
+
+def create_async_engine(url: str):
+    engine = sqlalchemy.ext.asyncio.create_async_engine(
+        url, **get_engine_options(url, sqlalchemy.pool.AsyncAdaptedQueuePool))
+    if is_sqlite(url):
+        sqlalchemy.event.listen(engine.sync_engine, 'connect', set_sqlite_pragmas)
+    return engine
+
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL)
 
 Base.metadata.create_all(bind=engine)
 
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL)
+
+# sync sessions are only for scripts (createsuperuser, etc), api uses async sessions
+SessionLocal = sqlalchemy.orm.sessionmaker(autoflush=False, bind=engine)
+AsyncSessionLocal = sqlalchemy.ext.asyncio.async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False)
+
 
-def get_db():
-    SessionLocal = sqlalchemy.orm.sessionmaker(autoflush=False, bind=engine)
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
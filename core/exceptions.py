@@ -27,3 +27,10 @@ class BookDoesNotExistException(fastapi.exceptions.HTTPException):
         status_code = fastapi.status.HTTP_404_NOT_FOUND
         detail = 'Book doesn\'t exist!'
         super().__init__(status_code, detail)
+
+
+class ServerIsBusyException(fastapi.exceptions.HTTPException):
+    def __init__(self) -> None:
+        status_code = fastapi.status.HTTP_503_SERVICE_UNAVAILABLE
+        detail = 'Server is busy. Try again later'
+        super().__init__(status_code, detail)
@@ -0,0 +1,10 @@
+_collectors = {}
+
+
+def register(name: str, collector):
+    """Registers function, which returns dict with metrics of some component"""
+    _collectors[name] = collector
+
+
+def collect():
+    return {name: collector() for name, collector in _collectors.items()}
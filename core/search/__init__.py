@@ -0,0 +1,9 @@
+"""CRUDs of search backend chosen by SEARCH_BACKEND"""
+from config import SEARCH_BACKEND
+
+if SEARCH_BACKEND == 'fts5':
+    from .fts import BookCRUD, UserCRUD
+else:
+    from .cruds import BookCRUD, UserCRUD
+
+__all__ = ['BookCRUD', 'UserCRUD']
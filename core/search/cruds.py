@@ -1,66 +1,304 @@
 from . import indexers
 from . import schemes
+from . import searchers
+from . import shards as sharding
+from . import writers
+import collections
+import contextlib
+import datetime as dt
+import heapq
+import math
 import whoosh.index
+import whoosh.matching
 import whoosh.qparser
 import whoosh.query
-from config import ITEMS_PER_PAGE
+import whoosh.sorting
+from config import (ITEMS_PER_PAGE, SEARCH_MAX_HITS, SEARCH_FACET_YEARS_FROM,
+                    SEARCH_FACET_YEARS_GAP, SEARCH_MODE, SEARCH_MODES, SEARCH_NGRAM_MIN_MATCH)
+
+SearchResult = collections.namedtuple('SearchResult', ['ids', 'total', 'groups'],
+                                      defaults=[None])
+
+
+class RankedFuzzyTerm(whoosh.query.FuzzyTerm):
+    """FuzzyTerm which scores its matches and keeps field boost
+    (whoosh drops the boost when fuzzy term expands to exactly one word)"""
+    def __init__(self, fieldname, text, boost=1.0, maxdist=1, prefixlength=1):
+        super().__init__(fieldname, text, boost, maxdist, prefixlength, constantscore=False)
+
+    def matcher(self, searcher, context=None):
+        words = [word for word in self._btexts(searcher.reader()) if word]
+        if len(words) == 1:
+            return whoosh.query.Term(self.field(), words[0], boost=self.boost).matcher(
+                searcher, context)
+        return super().matcher(searcher, context)
+
+
+class NgramsQuery(whoosh.query.Query):
+    """Matches documents having at least _minmatch_ of _grams_ in field,
+    score is a share of found grams (whoosh's Or ignores its minmatch)"""
+    def __init__(self, fieldname: str, grams: list[str], minmatch: int, boost: float = 1.0):
+        self.fieldname = fieldname
+        self.grams = grams
+        self.minmatch = minmatch
+        self.boost = boost
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.fieldname!r}, {self.grams!r}, {self.minmatch})'
+
+    def __eq__(self, other):
+        return (self.__class__ is other.__class__ and self.fieldname == other.fieldname
+                and self.grams == other.grams and self.minmatch == other.minmatch
+                and self.boost == other.boost)
+
+    def __hash__(self):
+        return hash((self.fieldname, tuple(self.grams), self.minmatch, self.boost))
+
+    def field(self):
+        return self.fieldname
+
+    def estimate_size(self, ixreader):
+        return min(ixreader.doc_frequency(self.fieldname, gram) for gram in self.grams)
+
+    def matcher(self, searcher, context=None):
+        reader = searcher.reader()
+        counts = collections.Counter()
+        for gram in self.grams:
+            if (self.fieldname, gram) in reader:
+                counts.update(reader.postings(self.fieldname, gram).all_ids())
+        ids = sorted(docnum for docnum, count in counts.items() if count >= self.minmatch)
+        if not ids:
+            return whoosh.matching.NullMatcher()
+        return whoosh.matching.ListMatcher(
+            ids, weights=[self.boost * counts[docnum] / len(self.grams) for docnum in ids])
 
 
 class SearchCRUD:
-    def __init__(self, scheme, indexer: whoosh.index.FileIndex, fields: list[str]):
-        self.indexer = indexer
+    def __init__(self, scheme, indexer: whoosh.index.FileIndex, fields: dict[str, float],
+                 searcher_manager: searchers.SearcherManager,
+                 writer: writers.BufferedIndexWriter,
+                 ngram_fields: dict[str, float] = None, mode: str = SEARCH_MODE,
+                 shards: list[sharding.Shard] = None):
+        """_fields_ and _ngram_fields_ are searchable fields with their boosts,
+        _mode_ is how words of query are matched:
+        * exact - only the same words
+        * fuzzy - words with one typo (compared with all words of index)
+        * ngram - words sharing most of 2- and 3-letter grams
+          (ordinary lookups of _ngram_fields_)
+        Index split by id is given by _shards_ instead of _indexer_, _searcher_manager_
+        and _writer_ (they are taken from the first shard then)
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f'unknown search mode {mode!r}')
+        self.shards = shards or [sharding.Shard(indexer, searcher_manager, writer)]
+        self.indexer, self.searchers, self.writer = self.shards[0]
         self.scheme = scheme
         self.fields = fields
+        self.ngram_fields = ngram_fields or {}
+        self.mode = mode
+
+    def parse(self, query: str):
+        """One query through all fields, each term may be found in any field"""
+        if self.mode == 'ngram':
+            return self.parse_ngrams(query)
+        termclass = RankedFuzzyTerm if self.mode == 'fuzzy' else whoosh.query.Term
+        parser = whoosh.qparser.MultifieldParser(
+            list(self.fields), self.scheme, fieldboosts=self.fields, termclass=termclass)
+        return parser.parse(query)
+
+    def parse_ngrams(self, query: str):
+        """Every word must be found exactly or by _SEARCH_NGRAM_MIN_MATCH_ of its grams"""
+        words = []
+        for word in query.split():
+            variants = [
+                whoosh.query.Term(name, text, boost=boost)
+                for name, boost in self.fields.items()
+                for text in self.scheme[name].process_text(word, mode='query')
+            ]
+            for name, boost in self.ngram_fields.items():
+                grams = list(dict.fromkeys(self.scheme[name].process_text(word, mode='query')))
+                if grams:
+                    variants.append(NgramsQuery(
+                        name, grams, max(1, math.ceil(len(grams) * SEARCH_NGRAM_MIN_MATCH)),
+                        boost))
+            if variants:
+                words.append(whoosh.query.Or(variants))
+        return whoosh.query.And(words) if words else whoosh.query.NullQuery
+
+    def writer_of(self, id_):
+        """Writer of shard containing document _id_"""
+        if len(self.shards) == 1:
+            return self.writer
+        return self.shards[sharding.shard_number(id_, len(self.shards))].writer
 
     def create(self, data: dict):
-        writer = self.indexer.writer()
-        writer.add_document(**data)
-        writer.commit()
+        self.writer_of(data['id']).add(data)
 
-    def search(self, query: str, page: int):
-        results = []
-        with self.indexer.searcher() as searcher:
-            for field in self.fields:
-                qp = whoosh.qparser.QueryParser(
-                    field, self.scheme, termclass=whoosh.query.FuzzyTerm)
-                q = qp.parse(query)
+    def create_many(self, items: list[dict]):
+        with self.batch():
+            for data in items:
+                self.create(data)
 
-                results += list(map(lambda item: dict(item),
-                                searcher.search_page(q, page, pagelen=ITEMS_PER_PAGE)))
+    @contextlib.contextmanager
+    def batch(self):
+        """Context for bulk operations: changes are committed to index together at exit"""
+        with contextlib.ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.writer.batch())
+            yield
 
-        return results
+    def wait(self, timeout: float = None):
+        """Waits until changes made before are committed, returns False on timeout"""
+        return all([shard.writer.wait(timeout) for shard in self.shards])
+
+    def generation(self):
+        """Changes after every commit to index"""
+        return tuple(shard.searchers.generation() for shard in self.shards)
+
+    @contextlib.contextmanager
+    def searcher_of_shards(self):
+        """Searchers of all shards, they are used together as one snapshot"""
+        with contextlib.ExitStack() as stack:
+            yield [stack.enter_context(shard.searchers.searcher()) for shard in self.shards]
+
+    def search(self, query: str, page: int, pagelen: int = ITEMS_PER_PAGE,
+               filter: whoosh.query.Query = None, groupedby: dict = None):
+        """Returns ids of found documents on _page_ (ordered by score) and total amount,
+        _filter_ is applied before scoring.
+        Amounts of all found documents by facets of _groupedby_ are counted in the same pass,
+        empty _query_ finds all documents"""
+        parsed = self.parse(query) if query else whoosh.query.Every()
+
+        def search_shard(searcher):
+            results = searcher.search(parsed, limit=page * pagelen, filter=filter,
+                                      groupedby=groupedby, maptype=whoosh.sorting.Count)
+            groups = {name: results.groups(name) for name in groupedby} if groupedby else None
+            return results.top_n, len(results), groups
+
+        with self.searcher_of_shards() as shard_searchers:
+            found = sharding.fan_out(search_shard, shard_searchers)
+            hits = sharding.merge_hits([top_n for top_n, _, _ in found], page * pagelen)
+            # stored fields are read only for hits of the page
+            ids = [int(shard_searchers[shard].stored_fields(docnum)['id'])
+                   for shard, docnum in hits[(page - 1) * pagelen:]]
+        groups = sharding.merge_groups([groups for _, _, groups in found]) if groupedby else None
+        return SearchResult(ids=ids, total=sum(total for _, total, _ in found), groups=groups)
+
+    def search_ids(self, query: str, limit: int = SEARCH_MAX_HITS,
+                   filter: whoosh.query.Query = None):
+        """Returns ids of all found documents (not more than _limit_)"""
+        parsed = self.parse(query)
+
+        def search_shard(searcher):
+            return searcher.search(parsed, limit=limit, filter=filter).top_n
+
+        with self.searcher_of_shards() as shard_searchers:
+            hits = sharding.merge_hits(sharding.fan_out(search_shard, shard_searchers), limit)
+            return [int(shard_searchers[shard].stored_fields(docnum)['id'])
+                    for shard, docnum in hits]
 
     def update(self, id_: int, data: dict):
-        writer = self.indexer.writer()
-        writer.update_document(id=str(id_), **data)
-        writer.commit()
+        self.writer_of(id_).update({'id': str(id_), **data})
 
     def delete(self, id_: int):
-        writer = self.indexer.writer()
-        writer.delete_by_term('id', str(id_))
-        writer.commit()
+        self.writer_of(id_).delete(str(id_))
 
     def get_all_indices(self):
-        with self.indexer.searcher() as searcher:
-            return list(searcher.documents())
+        """Yields stored documents sorted by id as string ("1", "10", "2"...)
+        one by one, every shard is read from one snapshot"""
+        return heapq.merge(*(self.shard_indices(shard.indexer) for shard in self.shards),
+                           key=lambda document: document['id'])
+
+    @staticmethod
+    def shard_indices(indexer: whoosh.index.FileIndex):
+        with indexer.searcher() as searcher:
+            reader = searcher.reader()
+            for id_ in reader.lexicon('id'):
+                postings = reader.postings('id', id_)  # deleted documents are skipped
+                if postings.is_active():
+                    yield reader.stored_fields(postings.id())
 
 
 class BookCRUD(SearchCRUD):
-    def __init__(self):
-        fields = [
-            'title',
-            'description',
-            'authors'
-        ]
-        super().__init__(schemes.book_scheme, indexers.book_indexer, fields)
+    FIELDS = {
+        'title': 3.0,
+        'authors': 2.0,
+        'description': 1.0,
+    }
+    NGRAM_FIELDS = {
+        'title_ngram': 3.0,
+        'authors_ngram': 2.0,
+    }
+
+    def __init__(self, mode: str = SEARCH_MODE):
+        shards = [sharding.Shard(*shard) for shard in zip(
+            indexers.book_indexers, searchers.book_searchers, writers.book_writers)]
+        super().__init__(schemes.book_scheme, None, self.FIELDS, None, None,
+                         self.NGRAM_FIELDS, mode, shards)
+
+    @staticmethod
+    def to_document(book):
+        return {
+            'id': str(book.id),
+            'title': book.title,
+            'description': book.description,
+            'authors': book.authors,
+            'edition_date': book.edition_date,
+            'is_private': book.is_private,
+            'author': book.authors,
+            'title_ngram': book.title,
+            'authors_ngram': book.authors,
+        }
+
+    @staticmethod
+    def facets():
+        """Facets for _groupedby_ parameter of search: authors and ranges of edition years"""
+        return {
+            'authors': whoosh.sorting.FieldFacet('author', allow_overlap=True),
+            'edition_years': whoosh.sorting.RangeFacet(
+                'edition_date', SEARCH_FACET_YEARS_FROM, dt.date.today().year + 1,
+                SEARCH_FACET_YEARS_GAP),
+        }
+
+    @staticmethod
+    def filter(edition_date: int = None, with_private: bool = False):
+        """Query for _filter_ parameter of search"""
+        terms = []
+        if edition_date:
+            terms.append(whoosh.query.Term('edition_date', edition_date))
+        if not with_private:
+            # documents indexed before is_private was added have no value of it
+            terms.append(whoosh.query.Not(whoosh.query.Term('is_private', True)))
+        return whoosh.query.And(terms) if terms else None
 
 
 class UserCRUD(SearchCRUD):
-    def __init__(self):
-        fields = [
-            'name',
-            'middlename',
-            'surname',
-            'login'
-        ]
-        super().__init__(indexers.schemes.user_scheme, indexers.user_indexer, fields)
+    FIELDS = {
+        'surname': 3.0,
+        'name': 2.0,
+        'login': 2.0,
+        'middlename': 1.0,
+    }
+    NGRAM_FIELDS = {
+        'surname_ngram': 3.0,
+        'name_ngram': 2.0,
+        'middlename_ngram': 1.0,
+    }
+
+    def __init__(self, mode: str = SEARCH_MODE):
+        super().__init__(indexers.schemes.user_scheme, indexers.user_indexer, self.FIELDS,
+                         searchers.user_searchers, writers.user_writer,
+                         self.NGRAM_FIELDS, mode)
+
+    @staticmethod
+    def to_document(user):
+        return {
+            'id': str(user.id),
+            'name': user.name,
+            'middlename': user.middlename,
+            'surname': user.surname,
+            'login': user.login,
+            'name_ngram': user.name,
+            'middlename_ngram': user.middlename,
+            'surname_ngram': user.surname,
+        }
@@ -0,0 +1,224 @@
+"""Search backend based on SQLite FTS5.
+
+Search tables use Book and User as external content and are filled by triggers,
+so they are changed in the same transaction as rows and CRUD writes do nothing.
+Words of query are matched by prefix (there is no typo tolerance).
+Tables and triggers are created by migration (alembic upgrade head) with fts5 backend,
+rebuild creates missing ones and fills search tables again.
+
+Usage: python -m core.search.fts rebuild | drop
+"""
+import argparse
+import collections
+import contextlib
+import datetime as dt
+import re
+import sqlalchemy
+from config import (ITEMS_PER_PAGE, SEARCH_MAX_HITS, SEARCH_FACET_YEARS_FROM,
+                    SEARCH_FACET_YEARS_GAP)
+from core.db import engine as default_engine
+from .cruds import SearchResult, BookCRUD as WhooshBookCRUD, UserCRUD as WhooshUserCRUD
+import models
+
+FtsTable = collections.namedtuple('FtsTable', ['name', 'model', 'columns'])
+
+BOOK_TABLE = FtsTable('BookSearch', models.Book, ['title', 'authors', 'description'])
+USER_TABLE = FtsTable('UserSearch', models.User, ['surname', 'name', 'login', 'middlename'])
+TABLES = [BOOK_TABLE, USER_TABLE]
+
+
+def trigger_names(table: FtsTable):
+    return [f'{table.name}_insert', f'{table.name}_delete', f'{table.name}_update']
+
+
+def install(connection: sqlalchemy.Connection, table: FtsTable):
+    """Creates search table and triggers if they don't exist,
+    search table is rebuilt if content could be changed without triggers"""
+    content = table.model.__tablename__
+    columns = ', '.join(table.columns)
+    new = ', '.join(f'new.{column}' for column in table.columns)
+    old = ', '.join(f'old.{column}' for column in table.columns)
+    existing = set(connection.exec_driver_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger'").scalars())
+    if set(trigger_names(table)) <= existing:
+        return
+
+    insert, delete, update = trigger_names(table)
+    connection.exec_driver_sql(
+        f'CREATE VIRTUAL TABLE IF NOT EXISTS "{table.name}" USING fts5({columns}, '
+        f'content="{content}", content_rowid="id", tokenize="unicode61 remove_diacritics 2")')
+    connection.exec_driver_sql(
+        f'CREATE TRIGGER IF NOT EXISTS "{insert}" AFTER INSERT ON "{content}" BEGIN '
+        f'INSERT INTO "{table.name}"(rowid, {columns}) VALUES (new.id, {new}); END')
+    connection.exec_driver_sql(
+        f'CREATE TRIGGER IF NOT EXISTS "{delete}" AFTER DELETE ON "{content}" BEGIN '
+        f'INSERT INTO "{table.name}"("{table.name}", rowid, {columns}) '
+        f"VALUES ('delete', old.id, {old}); END")
+    connection.exec_driver_sql(
+        f'CREATE TRIGGER IF NOT EXISTS "{update}" AFTER UPDATE OF {columns} ON "{content}" BEGIN '
+        f'INSERT INTO "{table.name}"("{table.name}", rowid, {columns}) '
+        f"VALUES ('delete', old.id, {old}); "
+        f'INSERT INTO "{table.name}"(rowid, {columns}) VALUES (new.id, {new}); END')
+    rebuild(connection, table)
+
+
+def rebuild(connection: sqlalchemy.Connection, table: FtsTable):
+    connection.exec_driver_sql(f'INSERT INTO "{table.name}"("{table.name}") VALUES (\'rebuild\')')
+
+
+def drop(connection: sqlalchemy.Connection, table: FtsTable):
+    for trigger in trigger_names(table):
+        connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS "{trigger}"')
+    connection.exec_driver_sql(f'DROP TABLE IF EXISTS "{table.name}"')
+
+
+def install_all(connection: sqlalchemy.Connection):
+    for table in TABLES:
+        install(connection, table)
+
+
+def to_match_query(query: str):
+    """Every word of query must be found as prefix of some word"""
+    words = re.findall(r'\w+', query.lower())
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+class FtsCRUD:
+    """The same interface as whoosh based SearchCRUD"""
+
+    def __init__(self, table: FtsTable, fields: dict[str, float],
+                 engine: sqlalchemy.Engine = None):
+        self.table = table
+        self.fields = fields
+        self.engine = engine or default_engine
+        self.model = table.model
+        self.fts = sqlalchemy.table(table.name, sqlalchemy.column('rowid'))
+
+    def create(self, data: dict):
+        """Search table is changed by triggers"""
+
+    def create_many(self, items: list[dict]):
+        """Search table is changed by triggers"""
+
+    def update(self, id_: int, data: dict):
+        """Search table is changed by triggers"""
+
+    def delete(self, id_: int):
+        """Search table is changed by triggers"""
+
+    def batch(self):
+        return contextlib.nullcontext(self)
+
+    def wait(self, timeout: float = None):
+        return True
+
+    def generation(self):
+        """Search table is always in sync with rows"""
+        return 0
+
+    def found_query(self, columns, query: str, filter: list = None):
+        statement = sqlalchemy.select(*columns)
+        if query:
+            weights = ', '.join(str(self.fields[column]) for column in self.table.columns)
+            statement = statement\
+                .join(self.fts, self.fts.c.rowid == self.model.id)\
+                .where(sqlalchemy.text(f'"{self.table.name}" MATCH :match')
+                       .bindparams(match=to_match_query(query)))\
+                .order_by(sqlalchemy.text(f'bm25("{self.table.name}", {weights})'))
+        else:
+            statement = statement.select_from(self.model).order_by(self.model.id)
+        return statement.where(*(filter or []))
+
+    def search(self, query: str, page: int, pagelen: int = ITEMS_PER_PAGE,
+               filter: list = None, groupedby: dict = None):
+        """Returns ids of found documents on _page_ (ordered by rank) and total amount,
+        _filter_ is list of sql conditions"""
+        if query and not to_match_query(query):
+            return SearchResult(ids=[], total=0, groups=self.count_groups([], groupedby))
+        found = self.found_query([self.model.id], query, filter)
+        with self.engine.connect() as connection:
+            ids = list(connection.scalars(found.limit(pagelen).offset((page - 1) * pagelen)))
+            total = connection.scalar(
+                sqlalchemy.select(sqlalchemy.func.count()).select_from(found.subquery()))
+            groups = None
+            if groupedby:
+                rows = connection.execute(
+                    self.found_query(self.group_columns(), query, filter)).all()
+                groups = self.count_groups(rows, groupedby)
+        return SearchResult(ids=ids, total=total, groups=groups)
+
+    def search_ids(self, query: str, limit: int = SEARCH_MAX_HITS, filter: list = None):
+        if not to_match_query(query):
+            return []
+        with self.engine.connect() as connection:
+            return list(connection.scalars(
+                self.found_query([self.model.id], query, filter).limit(limit)))
+
+    def group_columns(self):
+        return []
+
+    def count_groups(self, rows, groupedby: dict):
+        return None
+
+
+class BookCRUD(FtsCRUD):
+    to_document = staticmethod(WhooshBookCRUD.to_document)
+
+    def __init__(self, engine: sqlalchemy.Engine = None):
+        super().__init__(BOOK_TABLE, WhooshBookCRUD.FIELDS, engine)
+
+    @staticmethod
+    def filter(edition_date: int = None, with_private: bool = False):
+        conditions = []
+        if edition_date:
+            conditions.append(models.Book.edition_date == edition_date)
+        if not with_private:
+            conditions.append(models.Book.is_private == False)  # noqa
+        return conditions
+
+    @staticmethod
+    def facets():
+        return {'authors': None, 'edition_years': None}
+
+    def group_columns(self):
+        return [models.Book.authors, models.Book.edition_date]
+
+    def count_groups(self, rows, groupedby: dict):
+        """Counts facets like whoosh does: every author and ranges of edition years"""
+        if not groupedby:
+            return None
+        authors, years = collections.Counter(), collections.Counter()
+        end = dt.date.today().year + 1
+        for book_authors, edition_date in rows:
+            authors.update({author.strip() for author in (book_authors or '').split(',')
+                            if author.strip()})
+            if edition_date is not None and SEARCH_FACET_YEARS_FROM <= edition_date < end:
+                start = edition_date - (edition_date - SEARCH_FACET_YEARS_FROM) \
+                    % SEARCH_FACET_YEARS_GAP
+                years[(start, start + SEARCH_FACET_YEARS_GAP)] += 1
+        return {'authors': dict(authors), 'edition_years': dict(years)}
+
+
+class UserCRUD(FtsCRUD):
+    to_document = staticmethod(WhooshUserCRUD.to_document)
+
+    def __init__(self, engine: sqlalchemy.Engine = None):
+        super().__init__(USER_TABLE, WhooshUserCRUD.FIELDS, engine)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['rebuild', 'drop'])
+    args = parser.parse_args()
+    with default_engine.begin() as connection:
+        for table in TABLES:
+            if args.action == 'drop':
+                drop(connection, table)
+            else:
+                install(connection, table)
+                rebuild(connection, table)
+    print('Done')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,84 @@
+import contextlib
 import os
+import uuid
+import whoosh.fields
 import whoosh.index
-from config import SEARCHER_PATH
+from config import SEARCHER_PATH, SEARCH_BOOK_SHARDS
 from . import schemes
+from . import shards as sharding
+try:
+    import fcntl
+except ImportError:  # windows: several processes of application aren't supported
+    fcntl = None
 
 
-if not os.path.exists(SEARCHER_PATH):
-    os.mkdir(SEARCHER_PATH)
+os.makedirs(SEARCHER_PATH, exist_ok=True)
 
 book_folder = SEARCHER_PATH / 'books'
 user_folder = SEARCHER_PATH / 'users'
 
-if not os.path.exists(book_folder):
-    os.mkdir(book_folder)
-    ix = whoosh.index.create_in(book_folder, schemes.book_scheme)
 
-if not os.path.exists(user_folder):
-    os.mkdir(user_folder)
-    ix = whoosh.index.create_in(user_folder, schemes.user_scheme)
+def upgrade_schema(indexer: whoosh.index.FileIndex, scheme: whoosh.fields.Schema):
+    """Adds fields of _scheme_ missing in index created by older version
+    (existing documents get values after reindex or reconcile)"""
+    missing = [name for name in scheme.names() if name not in indexer.schema]
+    if missing:
+        writer = indexer.writer()
+        for name in missing:
+            writer.add_field(name, scheme[name])
+        writer.commit()
+    return indexer
 
 
-book_indexer = whoosh.index.open_dir(book_folder)
-user_indexer = whoosh.index.open_dir(user_folder)
+def open_index(folder, scheme: whoosh.fields.Schema):
+    if not whoosh.index.exists_in(folder):
+        os.makedirs(folder, exist_ok=True)
+        whoosh.index.create_in(folder, scheme)
+    return upgrade_schema(whoosh.index.open_dir(folder), scheme)
+
+
+def open_shards(folder, scheme: whoosh.fields.Schema, shards: int):
+    """Returns indexes of all shards, new index is created with _shards_ ones"""
+    if os.path.exists(folder):
+        shards = sharding.existing_shards(folder)
+    return [open_index(shard_folder, scheme)
+            for shard_folder in sharding.shard_folders(folder, shards)]
+
+
+def use_link(folder):
+    """Moves index built before reindex was used into a folder next to _folder_
+    and puts symlink on its place, so reindex swaps index with one rename
+    (index mustn't be used by anybody meanwhile)"""
+    if os.path.isdir(folder) and not os.path.islink(folder):
+        target = folder.with_name(f'{folder.name}-{uuid.uuid4().hex}')
+        os.rename(folder, target)
+        os.symlink(target.name, folder)
+
+
+def use_index(folder, lock: sharding.ShardsLock):
+    """Holds _lock_ of index in _folder_ while this process uses it,
+    the first process using index moves it under symlink"""
+    if lock.acquire():
+        use_link(folder)
+    lock.share()
+
+
+@contextlib.contextmanager
+def init_lock():
+    """Workers of application are started together, only one of them creates indexes"""
+    if fcntl is None:
+        yield
+        return
+    with open(SEARCHER_PATH / 'init.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+book_shards_lock = sharding.ShardsLock(SEARCHER_PATH / 'books.shards.lock')
+user_shards_lock = sharding.ShardsLock(SEARCHER_PATH / 'users.shards.lock')
+
+with init_lock():
+    use_index(book_folder, book_shards_lock)
+    use_index(user_folder, user_shards_lock)
+    book_indexers = open_shards(book_folder, schemes.book_scheme, SEARCH_BOOK_SHARDS)
+    user_indexer = open_index(user_folder, schemes.user_scheme)
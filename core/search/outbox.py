@@ -0,0 +1,294 @@
+"""Outbox of search index changes
+
+Every flush which changes searchable fields of books and users (or deletes them)
+writes documents into SearchOutbox table in the same transaction, so committed rows
+always have their changes in outbox. After commit changes are applied to indexes
+at once, or by dispatcher thread if it is started (see OutboxDispatcher.start);
+dispatcher remembers the last applied change in SearchOutboxCursor, so changes lost
+by failed index write or crashed process are applied by it later.
+Only one process of application dispatches changes at a time (the one holding lock
+file next to indexes), so changes are applied in order of seq.
+Applying a change again gives the same result, changes can be replayed from any seq
+(while they are kept, see SEARCH_OUTBOX_RETENTION).
+
+Usage: python -m core.search.outbox [--from SEQ] [books] [users]
+"""
+import argparse
+import threading
+import time
+import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.orm
+from config import (SEARCH_BACKEND, SEARCH_WRITER_BATCH_SIZE, SEARCH_OUTBOX_INTERVAL,
+                    SEARCH_OUTBOX_RETENTION, SEARCHER_PATH)
+from core.db import SessionLocal
+from core.search import BookCRUD, UserCRUD
+from core.search.queue import OwnerLock
+from models import SearchOutbox, SearchOutboxCursor
+import core.metrics
+import models
+
+UPDATE, DELETE = 'update', 'delete'
+
+# model -> (index, search crud, columns of document)
+INDEXES = {
+    models.Book: ('books', BookCRUD, {'title', 'authors', 'description', 'edition_date',
+                                      'is_private'}),
+    models.User: ('users', UserCRUD, {'login', 'name', 'middlename', 'surname'}),
+}
+CRUDS = {name: crud for name, crud, _ in INDEXES.values()}
+
+last_inline_error = None
+
+
+def is_changed(item, columns: set):
+    state = sqlalchemy.inspect(item)
+    return any(state.attrs[column].history.has_changes() for column in columns)
+
+
+def collect_changes(session: sqlalchemy.orm.Session):
+    now = time.time()
+    changes = []
+    for item in (*session.new, *session.dirty):
+        if type(item) in INDEXES:
+            name, crud, columns = INDEXES[type(item)]
+            if item in session.new or is_changed(item, columns):
+                changes.append({'index_name': name, 'doc_id': item.id, 'operation': UPDATE,
+                                'document': crud.to_document(item), 'created_at': now})
+    for item in session.deleted:
+        if type(item) in INDEXES:
+            changes.append({'index_name': INDEXES[type(item)][0], 'doc_id': item.id,
+                            'operation': DELETE, 'document': None, 'created_at': now})
+    return changes
+
+
+def _after_flush(session, flush_context):
+    changes = collect_changes(session)
+    if changes:
+        session.connection().execute(SearchOutbox.__table__.insert(), changes)
+        session.info.setdefault('search_outbox', []).extend(changes)
+
+
+def _after_commit(session):
+    global last_inline_error
+    changes = session.info.pop('search_outbox', None)
+    if not changes:
+        return
+    if dispatcher.running:
+        dispatcher.wake()
+        return
+    try:
+        apply(changes)
+    except Exception as exc:
+        # rows are committed anyway, dispatcher or replay applies their changes
+        last_inline_error = repr(exc)
+
+
+def _after_rollback(session):
+    session.info.pop('search_outbox', None)
+
+
+# FTS5 tables are changed by triggers
+if SEARCH_BACKEND != 'fts5':
+    sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_flush', _after_flush)
+    sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_commit', _after_commit)
+    sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_rollback', _after_rollback)
+
+
+def apply(changes: list[dict], wait_timeout: float = 60):
+    """Applies changes to indexes and waits until they are committed"""
+    by_index = {}
+    for change in changes:
+        by_index.setdefault(change['index_name'], []).append(change)
+    for name, index_changes in by_index.items():
+        crud = CRUDS[name]()
+        with crud.batch():
+            for change in index_changes:
+                if change['operation'] == DELETE:
+                    crud.delete(change['doc_id'])
+                else:
+                    crud.update(change['doc_id'], change['document'])
+        if not crud.wait(wait_timeout):
+            raise TimeoutError(f'changes of {name} index are not committed')
+
+
+def as_dict(change: SearchOutbox):
+    return {'index_name': change.index_name, 'doc_id': change.doc_id,
+            'operation': change.operation, 'document': change.document}
+
+
+def last_seq(db: sqlalchemy.orm.Session):
+    return db.scalar(sqlalchemy.select(sqlalchemy.func.max(SearchOutbox.seq))) or 0
+
+
+def read_changes(db: sqlalchemy.orm.Session, after: int, limit: int, names=None):
+    query = sqlalchemy.select(SearchOutbox).where(SearchOutbox.seq > after)
+    if names:
+        query = query.where(SearchOutbox.index_name.in_(names))
+    return db.scalars(query.order_by(SearchOutbox.seq).limit(limit)).all()
+
+
+def replay(db: sqlalchemy.orm.Session, from_seq: int = 1, names=None,
+           batch_size: int = SEARCH_WRITER_BATCH_SIZE):
+    """Applies changes from _from_seq_ again (cursor of dispatcher isn't changed),
+    returns amount of applied changes"""
+    count, after = 0, from_seq - 1
+    while changes := read_changes(db, after, batch_size, names):
+        apply([as_dict(change) for change in changes])
+        count += len(changes)
+        after = changes[-1].seq
+    return count
+
+
+class OutboxDispatcher:
+    """Applies changes of outbox in batches after its cursor.
+    With _lock_ only the process owning it dispatches changes (running dispatcher keeps
+    it until stop), dispatchers of other processes wait for it"""
+
+    def __init__(self, session_factory=SessionLocal, name: str = 'search',
+                 batch_size: int = SEARCH_WRITER_BATCH_SIZE,
+                 interval: float = SEARCH_OUTBOX_INTERVAL,
+                 retention: int = SEARCH_OUTBOX_RETENTION,
+                 lock: OwnerLock = None):
+        self.session_factory = session_factory
+        self.name = name
+        self.lock = lock
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retention = retention
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._worker = None
+        self.dispatched = 0
+        self.errors = 0
+        self.last_error = None
+
+    @property
+    def running(self):
+        return self._worker is not None
+
+    def cursor(self, db: sqlalchemy.orm.Session):
+        cursor = db.get(SearchOutboxCursor, self.name)
+        if cursor is None:
+            cursor = SearchOutboxCursor(name=self.name, seq=0)
+            db.add(cursor)
+            db.flush()
+        return cursor
+
+    def dispatch(self):
+        """Applies one batch of changes, returns amount of them
+        (0 if another process dispatches changes now)"""
+        if self.lock is not None and not self.lock.acquire():
+            return 0
+        try:
+            return self._dispatch()
+        finally:
+            if self.lock is not None and not self.running:
+                self.lock.release()
+
+    def _dispatch(self):
+        with self.session_factory() as db:
+            seq = self.cursor(db).seq
+            changes = read_changes(db, seq, self.batch_size)
+            if not changes:
+                return 0
+            apply([as_dict(change) for change in changes])
+            # cursor is never moved back, even if another dispatcher has moved it meanwhile
+            moved = db.execute(
+                sqlalchemy.update(SearchOutboxCursor)
+                .where(SearchOutboxCursor.name == self.name, SearchOutboxCursor.seq == seq)
+                .values(seq=changes[-1].seq)).rowcount
+            if not moved:
+                db.rollback()
+                return 0
+            db.execute(sqlalchemy.delete(SearchOutbox).where(
+                SearchOutbox.seq <= changes[-1].seq,
+                SearchOutbox.created_at < time.time() - self.retention))
+            db.commit()
+        self.dispatched += len(changes)
+        return len(changes)
+
+    def dispatch_all(self):
+        count = 0
+        while amount := self.dispatch():
+            count += amount
+        return count
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                self.dispatch_all()
+            except Exception as exc:
+                self.errors += 1
+                self.last_error = repr(exc)
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self):
+        if self._worker is None:
+            self._stopping.clear()
+            self._worker = threading.Thread(target=self._work, name='outbox-dispatcher',
+                                            daemon=True)
+            self._worker.start()
+
+    def stop(self):
+        """Stops worker thread and applies the rest of changes"""
+        worker, self._worker = self._worker, None
+        if worker is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            worker.join()
+            try:
+                self.dispatch_all()
+            except Exception as exc:
+                self.errors += 1
+                self.last_error = repr(exc)
+
+    def stats(self):
+        with self.session_factory() as db:
+            seq = self.cursor(db).seq
+            pending, oldest = db.execute(sqlalchemy.select(
+                sqlalchemy.func.count(), sqlalchemy.func.min(SearchOutbox.created_at))
+                .where(SearchOutbox.seq > seq)).one()
+        return {
+            'running': self.running,
+            'owner': self.lock.owned if self.lock is not None else None,
+            'cursor': seq,
+            'pending': pending,
+            'lag': time.time() - oldest if oldest is not None else 0.0,
+            'dispatched': self.dispatched,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'last_inline_error': last_inline_error,
+        }
+
+
+dispatcher = OutboxDispatcher(
+    lock=OwnerLock(SEARCHER_PATH / 'search_outbox.lock') if OwnerLock.supported else None)
+
+core.metrics.register('search_outbox', dispatcher.stats)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('indexes', nargs='*',
+                        help=f'some of {", ".join(CRUDS)} for replay (all by default)')
+    parser.add_argument('--from', dest='from_seq', type=int,
+                        help='replay changes from this seq (by default pending ones are applied)')
+    args = parser.parse_args()
+    unknown = set(args.indexes) - set(CRUDS)
+    if unknown:
+        parser.error(f'unknown indexes: {", ".join(unknown)}')
+
+    if args.from_seq is None:
+        print(f'{dispatcher.dispatch_all()} changes applied')
+    else:
+        with SessionLocal() as db:
+            print(f'{replay(db, args.from_seq, args.indexes)} changes applied')
+
+
+if __name__ == '__main__':
+    main()
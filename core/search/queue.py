@@ -0,0 +1,112 @@
+"""Queue of index changes shared by processes of application (SEARCH_WRITER_MODE=shared)
+
+Every process puts changes into SQLite database next to indexes, only the process
+holding lock file of index (the owner) commits them. Lock is released when owner
+stops or dies, then another process takes it and continues from the same row.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+
+class IndexQueue:
+    """Changes of one index in order they were made"""
+
+    def __init__(self, path: os.PathLike, name: str):
+        self.path = path
+        self.name = name
+        self._local = threading.local()  # sqlite connection can't be shared by threads
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'index_name TEXT NOT NULL, doc_id TEXT NOT NULL, operation TEXT NOT NULL, '
+                'document TEXT, created_at REAL NOT NULL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_changes_index_seq ON changes (index_name, seq)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def put(self, changes: list[tuple]):
+        """Adds (id, operation, document) changes, returns seq of the last one"""
+        now = time.time()
+        with self._connection() as connection:
+            connection.executemany(
+                'INSERT INTO changes (index_name, doc_id, operation, document, created_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(self.name, id_, operation, json.dumps(document) if document else None, now)
+                 for id_, operation, document in changes])
+            return connection.execute('SELECT max(seq) FROM changes').fetchone()[0]
+
+    def take(self, limit: int):
+        """Returns the oldest changes as (seq, id, operation, document)"""
+        rows = self._connection().execute(
+            'SELECT seq, doc_id, operation, document FROM changes WHERE index_name = ? '
+            'ORDER BY seq LIMIT ?', (self.name, limit)).fetchall()
+        return [(seq, id_, operation, json.loads(document) if document else None)
+                for seq, id_, operation, document in rows]
+
+    def remove(self, last_seq: int):
+        """Removes applied changes up to _last_seq_"""
+        with self._connection() as connection:
+            connection.execute('DELETE FROM changes WHERE index_name = ? AND seq <= ?',
+                               (self.name, last_seq))
+
+    def contains(self, last_seq: int):
+        """True if some changes up to _last_seq_ aren't applied yet"""
+        return self._connection().execute(
+            'SELECT EXISTS (SELECT 1 FROM changes WHERE index_name = ? AND seq <= ?)',
+            (self.name, last_seq)).fetchone()[0] == 1
+
+    def stats(self):
+        size, oldest = self._connection().execute(
+            'SELECT count(*), min(created_at) FROM changes WHERE index_name = ?',
+            (self.name,)).fetchone()
+        return {'queued': size, 'lag': time.time() - oldest if oldest is not None else 0.0}
+
+
+class OwnerLock:
+    """Lock file which is held by one process at a time (flock is released when process dies)"""
+
+    supported = fcntl is not None
+
+    def __init__(self, path: os.PathLike):
+        if fcntl is None:
+            raise RuntimeError('shared writer mode needs flock, it is not supported on Windows')
+        self.path = path
+        self._file = None
+
+    @property
+    def owned(self):
+        return self._file is not None
+
+    def acquire(self):
+        """Returns False at once if lock is held by another process"""
+        if self._file is not None:
+            return True
+        file = open(self.path, 'a')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return False
+        self._file = file
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
@@ -0,0 +1,126 @@
+"""Compares search indexes with database and repairs them
+
+Ids are read from both sides sorted as strings ("1", "10", "2"...) and merged,
+so memory doesn't depend on amount of rows. Found problems:
+* missing - row isn't indexed
+* stale - indexed document differs from row (only stored fields are compared,
+  so it isn't found in indexes with compact scheme)
+* orphaned - document of deleted row
+
+Usage: python -m core.search.reconcile [books] [users] [--dry-run]
+"""
+import argparse
+import asyncio
+import time
+import sqlalchemy
+from sqlalchemy.orm import Session
+from core.db import SessionLocal
+from config import SEARCH_WRITER_BATCH_SIZE
+from .reindex import INDEXES
+import core.metrics
+
+MISSING, STALE, ORPHANED = 'missing', 'stale', 'orphaned'
+
+last_run = {}
+
+
+def stream_rows(db: Session, model, to_document, chunk_size: int):
+    """Yields documents of rows sorted by id as string"""
+    query = sqlalchemy.select(model)\
+        .order_by(sqlalchemy.cast(model.id, sqlalchemy.String))\
+        .execution_options(yield_per=chunk_size)
+    for item in db.scalars(query):
+        yield to_document(item)
+
+
+def find_problems(expected, indexed, stored_fields: set):
+    """Merges two sequences of documents sorted by id,
+    yields (problem, id, expected document).
+    Documents are compared by _stored_fields_ (others can't be read from index)"""
+    # index is read first: row deleted after that is reported as orphaned
+    # and row created after that is missing (both are right)
+    document = next(indexed, None)
+    row = next(expected, None)
+    while row is not None or document is not None:
+        if document is None or (row is not None and row['id'] < document['id']):
+            yield MISSING, row['id'], row
+            row = next(expected, None)
+        elif row is None or document['id'] < row['id']:
+            yield ORPHANED, document['id'], None
+            document = next(indexed, None)
+        else:
+            if {key: value for key, value in row.items()
+                    if value is not None and key in stored_fields} != document:
+                yield STALE, row['id'], row
+            row = next(expected, None)
+            document = next(indexed, None)
+
+
+def reconcile(name: str, db: Session, repair: bool = True,
+              batch_size: int = SEARCH_WRITER_BATCH_SIZE, chunk_size: int = 1000):
+    """Checks index _name_ (books / users), returns amount of found problems"""
+    model, crud_class = INDEXES[name]
+    crud = crud_class()
+    report = dict.fromkeys((MISSING, STALE, ORPHANED), 0)
+    fixes = []
+
+    def apply_fixes():
+        with crud.batch():
+            for problem, id_, document in fixes:
+                if problem == ORPHANED:
+                    crud.delete(id_)
+                else:
+                    # update instead of create: document may be indexed meanwhile
+                    crud.update(id_, document)
+        fixes.clear()
+
+    indexed = crud.get_all_indices()
+    expected = stream_rows(db, model, crud.to_document, chunk_size)
+    # fields stored by index itself: it may be built with another scheme before reindex
+    stored_fields = set(crud.indexer.schema.stored_names())
+    for problem, id_, document in find_problems(expected, indexed, stored_fields):
+        report[problem] += 1
+        if repair:
+            fixes.append((problem, id_, document))
+            if len(fixes) >= batch_size:
+                apply_fixes()
+    if fixes:
+        apply_fixes()
+    return report
+
+
+def reconcile_all(names=None, repair: bool = True):
+    with SessionLocal() as db:
+        reports = {name: reconcile(name, db, repair) for name in names or INDEXES}
+    last_run.update(finished_at=time.time(), reports=reports, error=None)
+    return reports
+
+
+async def reconcile_periodically(interval: float):
+    """Background task for application lifespan"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(reconcile_all)
+        except Exception as exc:
+            last_run.update(finished_at=time.time(), error=repr(exc))
+
+
+core.metrics.register('search_reconcile', lambda: dict(last_run))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('indexes', nargs='*', help=f'some of {", ".join(INDEXES)} (all by default)')
+    parser.add_argument('--dry-run', action='store_true', help='only report problems')
+    args = parser.parse_args()
+    unknown = set(args.indexes) - set(INDEXES)
+    if unknown:
+        parser.error(f'unknown indexes: {", ".join(unknown)}')
+
+    for name, report in reconcile_all(args.indexes, repair=not args.dry_run).items():
+        print(f'{name}: ' + ', '.join(f'{problem} {count}' for problem, count in report.items()))
+
+
+if __name__ == '__main__':
+    main()
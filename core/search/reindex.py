@@ -0,0 +1,155 @@
+"""Rebuilds search indexes from database
+
+Index is built into a fresh folder next to the live one, then the live path
+(a symlink, see indexers.use_link) is switched to it with one atomic rename,
+so the application never sees a half-built index.
+Changes made through the application while index is being built are replayed
+from search outbox after the switch.
+Books' index is built with SEARCH_BOOK_SHARDS shards (or --shards), amount of shards
+can be changed only while application is stopped (processes of application route
+documents by amount of shards they have opened).
+
+Usage: python -m core.search.reindex [books] [users] --procs 4 --chunk 1000 --shards 4
+"""
+import argparse
+import os
+import pathlib
+import shutil
+import time
+import uuid
+import sqlalchemy
+import whoosh.index
+from sqlalchemy.orm import Session
+from core.db import SessionLocal
+from config import SEARCHER_PATH, SEARCH_BOOK_SHARDS
+from .cruds import BookCRUD, UserCRUD
+from . import indexers
+from . import outbox
+from . import shards as sharding
+from . import writers
+import models
+
+INDEXES = {
+    'books': (models.Book, BookCRUD),
+    'users': (models.User, UserCRUD),
+}
+
+
+def stream_documents(db: Session, model, to_document, chunk_size: int):
+    """Yields documents of all rows without loading whole table into memory"""
+    query = sqlalchemy.select(model).order_by(model.id).execution_options(yield_per=chunk_size)
+    for item in db.scalars(query):
+        yield to_document(item)
+
+
+def build_index(folder: pathlib.Path, scheme, documents, procs: int, limitmb: int,
+                shards: int = 1):
+    """Returns amount of written documents, every document goes to shard of its id
+    (_procs_ are shared by writers of shards)"""
+    os.makedirs(folder)
+    writers = []
+    count = 0
+    try:
+        for shard_folder in sharding.shard_folders(folder, shards):
+            os.makedirs(shard_folder, exist_ok=True)
+            indexer = whoosh.index.create_in(shard_folder, scheme)
+            writers.append(indexer.writer(procs=max(1, procs // shards), limitmb=limitmb))
+        for document in documents:
+            writers[sharding.shard_number(document['id'], shards)].add_document(**document)
+            count += 1
+    except Exception:
+        for writer in writers:
+            writer.cancel()
+        raise
+    for writer in writers:
+        writer.commit()
+    return count
+
+
+def swap_index(link: pathlib.Path, folder: pathlib.Path):
+    """Points _link_ to _folder_ and removes folder of previous index"""
+    previous = pathlib.Path(os.path.realpath(link)) if link.is_symlink() else None
+    temp_link = link.with_name(f'.{link.name}.{uuid.uuid4().hex}')
+    os.symlink(folder.name, temp_link)
+    os.replace(temp_link, link)
+
+    if previous is not None and previous != folder:
+        shutil.rmtree(previous, ignore_errors=True)
+
+
+def reindex(name: str, db: Session, base_path: pathlib.Path = SEARCHER_PATH,
+            procs: int = os.cpu_count() or 1, chunk_size: int = 1000, limitmb: int = 128,
+            shards: int = None):
+    """Rebuilds index _name_ (books / users), returns amount of indexed documents.
+    Books' index gets _shards_ (SEARCH_BOOK_SHARDS by default), users' one isn't split.
+    RuntimeError is raised if amount of shards is changed while index is used by application"""
+    model, crud = INDEXES[name]
+    if name != 'books':
+        shards = 1
+    elif shards is None:
+        shards = SEARCH_BOOK_SHARDS
+    lock = sharding.ShardsLock(base_path / f'{name}.shards.lock')
+    link = base_path / name
+    if os.path.exists(link) and sharding.existing_shards(link) != shards:
+        if not lock.acquire():
+            raise RuntimeError(f'{name} index is used by application, stop it '
+                               'to change amount of shards')
+    if os.path.isdir(link) and not os.path.islink(link):
+        # index built before reindex was used, it's moved when nobody uses it
+        if not lock.acquire():
+            raise RuntimeError(f'{name} index is used by application, restart it '
+                               'to move index under symlink')
+        indexers.use_link(link)
+    folder = base_path / f'{name}-{uuid.uuid4().hex}'
+    documents = stream_documents(db, model, crud.to_document, chunk_size)
+    try:
+        try:
+            count = build_index(folder, crud().scheme, documents, procs, limitmb, shards)
+        except Exception:
+            shutil.rmtree(folder, ignore_errors=True)
+            raise
+        swap_index(link, folder)
+    finally:
+        lock.release()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('indexes', nargs='*', help=f'some of {", ".join(INDEXES)} (all by default)')
+    parser.add_argument('--procs', type=int, default=os.cpu_count() or 1,
+                        help='processes writing index')
+    parser.add_argument('--chunk', type=int, default=1000, help='rows loaded from db at once')
+    parser.add_argument('--limitmb', type=int, default=128, help='memory of every writer process')
+    parser.add_argument('--shards', type=int, default=SEARCH_BOOK_SHARDS,
+                        help="shards of books' index")
+    args = parser.parse_args()
+    unknown = set(args.indexes) - set(INDEXES)
+    if unknown:
+        parser.error(f'unknown indexes: {", ".join(unknown)}')
+
+    with SessionLocal() as db:
+        for name in args.indexes or INDEXES:
+            started = time.perf_counter()
+            since = outbox.last_seq(db)
+            shards = sharding.existing_shards(SEARCHER_PATH / name)
+            rebalanced = name == 'books' and shards != args.shards
+            if rebalanced:
+                indexers.book_shards_lock.release()  # shards aren't used by this process
+            try:
+                count = reindex(name, db, procs=args.procs, chunk_size=args.chunk,
+                                limitmb=args.limitmb, shards=args.shards)
+            except RuntimeError as exc:
+                parser.exit(1, f'{exc}\n')
+            elapsed = time.perf_counter() - started
+            if rebalanced:
+                writers.reopen_book_shards()  # changes are replayed into new shards
+            replayed = outbox.replay(db, since + 1, [name])
+            print(f'{name}: {count} documents in {elapsed:.1f}s '
+                  f'({count / elapsed:.0f} rows/sec), {replayed} changes replayed')
+            if rebalanced:
+                print(f'{name}: {shards} -> {args.shards} shards')
+
+
+if __name__ == '__main__':
+    main()
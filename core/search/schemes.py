@@ -1,17 +1,43 @@
 import whoosh.fields
+from config import SEARCH_SCHEME
 
 
-user_scheme = whoosh.fields.Schema(
-    id=whoosh.fields.ID(unique=True, stored=True),
-    name=whoosh.fields.TEXT(stored=True),
-    middlename=whoosh.fields.TEXT(stored=True),
-    surname=whoosh.fields.TEXT(stored=True),
-    login=whoosh.fields.TEXT(stored=True)
-)
-
-book_scheme = whoosh.fields.Schema(
-    id=whoosh.fields.ID(unique=True, stored=True),
-    title=whoosh.fields.TEXT(stored=True),
-    description=whoosh.fields.TEXT(stored=True),
-    authors=whoosh.fields.TEXT(stored=True)
-)
+def ngram_field():
+    """Words split into 2- and 3-letter grams: query words with typos still share
+    most of their grams with right ones (see ngram search mode)"""
+    return whoosh.fields.NGRAMWORDS(minsize=2, maxsize=3)
+
+
+def make_user_scheme(stored: bool = True):
+    """Only id is stored if not _stored_: results are loaded from database anyway"""
+    return whoosh.fields.Schema(
+        id=whoosh.fields.ID(unique=True, stored=True),
+        name=whoosh.fields.TEXT(stored=stored),
+        middlename=whoosh.fields.TEXT(stored=stored),
+        surname=whoosh.fields.TEXT(stored=stored),
+        login=whoosh.fields.TEXT(stored=stored),
+        name_ngram=ngram_field(),
+        middlename_ngram=ngram_field(),
+        surname_ngram=ngram_field()
+    )
+
+
+def make_book_scheme(stored: bool = True):
+    """Only id is stored if not _stored_: results are loaded from database anyway"""
+    return whoosh.fields.Schema(
+        id=whoosh.fields.ID(unique=True, stored=True),
+        title=whoosh.fields.TEXT(stored=stored),
+        description=whoosh.fields.TEXT(stored=stored),
+        authors=whoosh.fields.TEXT(stored=stored),
+        edition_date=whoosh.fields.NUMERIC(stored=stored),
+        is_private=whoosh.fields.BOOLEAN(stored=stored),
+        # every author separately (for facets), vectors let count authors only of found books
+        author=whoosh.fields.KEYWORD(commas=True, vector=True, stored=stored),
+        title_ngram=ngram_field(),
+        authors_ngram=ngram_field()
+    )
+
+
+# full / compact (see SEARCH_SCHEME), existing indexes get it after reindex
+user_scheme = make_user_scheme(stored=SEARCH_SCHEME != 'compact')
+book_scheme = make_book_scheme(stored=SEARCH_SCHEME != 'compact')
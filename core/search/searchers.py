@@ -0,0 +1,113 @@
+import contextlib
+import os
+import threading
+import time
+import whoosh.index
+import core.metrics
+from config import SEARCHER_CHECK_INTERVAL
+from . import indexers
+
+
+class SearcherManager:
+    """Keeps one searcher of index shared between requests.
+
+    Searcher is reopened only when index generation changes: at once after commits
+    made by this process (see _invalidate_) and not more often than
+    every _check_interval_ seconds for commits made by other processes
+    or when index folder is swapped by reindex.
+    Replaced searcher is closed when the last request using it releases it.
+    """
+
+    def __init__(self, indexer: whoosh.index.FileIndex,
+                 check_interval: float = SEARCHER_CHECK_INTERVAL):
+        self.indexer = indexer
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._searcher = None
+        self._users = {}  # searcher -> amount of requests using it
+        self._stale = True
+        self._checked_at = 0.0
+        self._folder = None  # real path of index folder used by searcher
+        self.refreshes = 0
+
+    def _real_folder(self):
+        return os.path.realpath(self.indexer.storage.folder)
+
+    def _is_outdated(self):
+        if self._stale:
+            return True
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        return self._real_folder() != self._folder or not self._searcher.up_to_date()
+
+    def _refresh(self):
+        old = self._searcher
+        self._stale = False
+        self._checked_at = time.monotonic()
+        folder = self._real_folder()
+        swapped = folder != self._folder
+        self._folder = folder
+        if old is not None and not swapped and old.up_to_date():
+            return
+        if old is not None and not swapped and not self._users[old]:
+            # nobody uses old searcher, so unchanged segments can be reused
+            del self._users[old]
+            self._searcher = old.refresh()
+        else:
+            if old is not None and not self._users[old]:
+                del self._users[old]
+                old.close()
+            self._searcher = self.indexer.searcher()
+        self._users.setdefault(self._searcher, 0)
+        self.refreshes += 1
+
+    @contextlib.contextmanager
+    def searcher(self):
+        with self._lock:
+            if self._searcher is None or self._is_outdated():
+                self._refresh()
+            searcher = self._searcher
+            self._users[searcher] += 1
+        try:
+            yield searcher
+        finally:
+            with self._lock:
+                self._users[searcher] -= 1
+                if searcher is not self._searcher and not self._users[searcher]:
+                    del self._users[searcher]
+                    searcher.close()
+
+    def generation(self):
+        """Generation of index which is searched now"""
+        with self.searcher() as searcher:
+            return searcher.ixreader.generation()
+
+    def invalidate(self):
+        """Makes next request reopen searcher (call it after commit to index)"""
+        self._stale = True
+
+    def close(self):
+        with self._lock:
+            for searcher in self._users:
+                searcher.close()
+            self._users.clear()
+            self._searcher = None
+            self._folder = None
+            self._stale = True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'generation': self._searcher.ixreader.generation() if self._searcher else None,
+                'refreshes': self.refreshes,
+                'open_searchers': len(self._users),
+            }
+
+
+book_searchers = [SearcherManager(indexer) for indexer in indexers.book_indexers]  # by shards
+user_searchers = SearcherManager(indexers.user_indexer)
+
+core.metrics.register('book_searchers', lambda: [manager.stats() for manager in book_searchers])
+core.metrics.register('user_searcher', user_searchers.stats)
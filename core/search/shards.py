@@ -0,0 +1,103 @@
+"""Index split into shards by id (see SEARCH_BOOK_SHARDS)
+
+Folder of index contains the index itself or folders shard-0 ... shard-N;
+document with id goes to shard id % N. Queries are run on all shards in
+thread pool, their hits are merged by score.
+Amount of shards is changed only by reindex while no process of application
+uses the index (see ShardsLock).
+"""
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import os
+from config import SEARCH_SHARD_THREADS
+try:
+    import fcntl
+except ImportError:  # windows: several processes of application aren't supported
+    fcntl = None
+
+Shard = collections.namedtuple('Shard', ['indexer', 'searchers', 'writer'])
+
+_pool = None
+
+
+def shard_number(id_, shards: int):
+    return int(id_) % shards
+
+
+def shard_folders(folder: os.PathLike, shards: int):
+    if shards == 1:
+        return [folder]
+    return [folder / f'shard-{number}' for number in range(shards)]
+
+
+def existing_shards(folder: os.PathLike):
+    """Amount of shards of index in _folder_ (it may differ from the configured one
+    until reindex)"""
+    names = [name for name in os.listdir(folder) if name.startswith('shard-')]
+    return len(names) or 1
+
+
+class ShardsLock:
+    """Lock file of index: processes of application hold it shared while
+    they route documents to shards, reindex needs it exclusively to change amount
+    of shards or to move index under symlink (without flock it doesn't lock anything)"""
+
+    def __init__(self, path: os.PathLike):
+        self.path = path
+        self._file = None
+
+    def _lock(self, operation: int):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        try:
+            fcntl.flock(self._file, operation)
+        except BlockingIOError:
+            self.release()
+            return False
+        return True
+
+    def share(self):
+        """Waits while amount of shards is being changed"""
+        if fcntl is not None:
+            self._lock(fcntl.LOCK_SH)
+
+    def acquire(self):
+        """Returns False at once if some process uses shards"""
+        return fcntl is None or self._lock(fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def fan_out(function, items: list):
+    """Calls _function_ for all _items_ in thread pool, returns results in the same order"""
+    global _pool
+    if len(items) == 1:
+        return [function(items[0])]
+    if _pool is None:
+        _pool = concurrent.futures.ThreadPoolExecutor(SEARCH_SHARD_THREADS,
+                                                      thread_name_prefix='shard-search')
+    return list(_pool.map(function, items))
+
+
+def merge_hits(hits_of_shards: list, limit: int):
+    """Merges lists of (score, docnum) sorted by score of every shard,
+    returns the best _limit_ of (shard, docnum). Hits of equal score keep order of shards"""
+    hits = heapq.merge(*([(-score, shard, position, docnum)
+                          for position, (score, docnum) in enumerate(hits)]
+                         for shard, hits in enumerate(hits_of_shards)))
+    return [(shard, docnum) for _, shard, _, docnum in itertools.islice(hits, limit)]
+
+
+def merge_groups(groups_of_shards: list):
+    """Sums amounts of documents by facets"""
+    groups = {}
+    for shard_groups in groups_of_shards:
+        for name, counts in shard_groups.items():
+            groups.setdefault(name, collections.Counter()).update(counts)
+    return {name: dict(counts) for name, counts in groups.items()}
@@ -0,0 +1,499 @@
+import atexit
+import collections
+import contextlib
+import contextvars
+import threading
+import time
+import whoosh.index
+import core.metrics
+from config import (SEARCH_WRITER_MODE, SEARCH_WRITER_BATCH_SIZE, SEARCH_WRITER_FLUSH_INTERVAL,
+                    SEARCH_WRITER_RETRY_DELAY, SEARCHER_PATH, SEARCH_QUEUE_PATH,
+                    SEARCH_QUEUE_POLL_INTERVAL, SEARCH_BOOK_SHARDS)
+from . import indexers
+from . import schemes
+from . import searchers
+from .queue import IndexQueue, OwnerLock
+
+ADD, UPDATE, DELETE = 'add', 'update', 'delete'
+
+
+def merge(pending: collections.OrderedDict, id_: str, operation: str, document: dict = None):
+    """Puts change of document into _pending_ changes, only the last state of it is kept"""
+    previous, _ = pending.pop(id_, (None, None))
+    if operation == DELETE and previous == ADD:
+        pass  # document never got to index
+    elif operation == ADD and previous == DELETE:
+        pending[id_] = (UPDATE, document)  # id is used again
+    elif operation == UPDATE and previous == ADD:
+        pending[id_] = (ADD, document)
+    else:
+        pending[id_] = (operation, document)
+
+
+class BufferedIndexWriter:
+    """Groups changes of index and commits them with one writer.
+
+    In _background_ mode changes are committed by worker thread (see start),
+    so requests don't wait for index; without running worker they are committed
+    at once like in _immediate_ mode (if there is no active batch).
+    In _buffered_ mode they are kept until _batch_size_ documents are changed
+    or _flush_interval_ seconds passed (failed commit is tried again after _retry_delay_).
+    Changes of one document are merged, so only the last state of it is written.
+    Changes made inside batch are kept by the batch itself (see batch).
+    """
+
+    def __init__(self, indexer: whoosh.index.FileIndex,
+                 searcher_manager: searchers.SearcherManager,
+                 mode: str = SEARCH_WRITER_MODE,
+                 batch_size: int = SEARCH_WRITER_BATCH_SIZE,
+                 flush_interval: float = SEARCH_WRITER_FLUSH_INTERVAL,
+                 retry_delay: float = SEARCH_WRITER_RETRY_DELAY):
+        self.indexer = indexer
+        self.searchers = searcher_manager
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()  # one commit at a time, changes are queued meanwhile
+        self._pending = collections.OrderedDict()  # id -> (operation, document)
+        self._queued_at = None  # time of the oldest pending change
+        self._flushing = False
+        # changes of active batch of this thread (or asyncio task)
+        self._batch = contextvars.ContextVar('index_batch', default=None)
+        self._timer = None
+        self._worker = None
+        self._stopping = False
+        self.flushes = 0
+        self.retries = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_lag = 0.0
+
+    def _put(self, id_: str, operation: str, document: dict = None):
+        batch = self._batch.get()
+        if batch is None:
+            self._enqueue([(id_, (operation, document))])
+            return
+        merge(batch, id_, operation, document)
+        if len(batch) >= self.batch_size:
+            changes = list(batch.items())
+            batch.clear()
+            self._enqueue(changes)
+
+    def _enqueue(self, changes: list):
+        """Adds (id, (operation, document)) changes to pending ones"""
+        with self._lock:
+            if self._queued_at is None:
+                self._queued_at = time.monotonic()
+            for id_, (operation, document) in changes:
+                merge(self._pending, id_, operation, document)
+            flush_now = self._schedule()
+        # commit isn't made under _lock: commit takes _flush_lock first
+        if flush_now:
+            self.flush()
+
+    def _schedule(self):
+        """Returns True if changes must be committed now"""
+        if self._worker is not None:
+            self._changed.notify_all()
+        elif len(self._pending) >= self.batch_size:
+            return True
+        elif self.mode != 'buffered':
+            return True
+        elif self._timer is None:
+            self._start_timer(self.flush_interval)
+        return False
+
+    def _start_timer(self, delay: float):
+        self._timer = threading.Timer(delay, self._flush_by_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush_by_timer(self):
+        """Flush of _buffered_ mode, failed one is tried again after _retry_delay_"""
+        try:
+            self.flush()
+        except whoosh.index.LockError:
+            self.retries += 1
+        except Exception as exc:
+            self.errors += 1
+            self.last_error = repr(exc)
+        else:
+            return
+        with self._lock:
+            if self._timer is None and self._pending:
+                self._start_timer(self.retry_delay)
+
+    def add(self, document: dict):
+        self._put(document['id'], ADD, document)
+
+    def update(self, document: dict):
+        self._put(document['id'], UPDATE, document)
+
+    def delete(self, id_: str):
+        self._put(id_, DELETE)
+
+    def flush(self):
+        """Commits pending changes. If commit fails (ex. index is locked by another
+        writer, whoosh.index.LockError) changes are kept for the next try and error
+        is raised, so wait doesn't report them as committed"""
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._pending:
+                    return
+                changes, queued_at = self._pending, self._queued_at
+                self._pending, self._queued_at = collections.OrderedDict(), None
+                self._flushing = True
+            try:
+                self._write(changes)
+            except Exception:
+                with self._lock:
+                    # changes made meanwhile are newer
+                    for id_, (operation, document) in self._pending.items():
+                        merge(changes, id_, operation, document)
+                    self._pending, self._queued_at = changes, queued_at
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = False
+                    self._changed.notify_all()
+            self.flushes += 1
+            self.last_lag = time.monotonic() - queued_at
+        self.searchers.invalidate()
+
+    def _write(self, changes: collections.OrderedDict):
+        writer = self.indexer.writer()
+        try:
+            for id_, (operation, document) in changes.items():
+                if operation == ADD:
+                    writer.add_document(**document)
+                elif operation == UPDATE:
+                    writer.update_document(**document)
+                else:
+                    writer.delete_by_term('id', id_)
+        except Exception:
+            writer.cancel()
+            raise
+        writer.commit()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._changed.wait_for(lambda: self._stopping or self._pending)
+                if self._stopping:
+                    return
+            try:
+                self.flush()
+                continue
+            except whoosh.index.LockError:
+                self.retries += 1
+            except Exception as exc:
+                self.errors += 1
+                self.last_error = repr(exc)
+            with self._lock:
+                self._changed.wait_for(lambda: self._stopping, self.retry_delay)
+
+    def start(self):
+        """Starts worker thread of _background_ mode"""
+        with self._lock:
+            if self.mode != 'background' or self._worker is not None:
+                return
+            self._stopping = False
+            self._worker = threading.Thread(target=self._work, name='index-writer', daemon=True)
+            self._worker.start()
+
+    def stop(self):
+        """Stops worker thread and commits the rest of changes"""
+        with self._lock:
+            worker, self._worker = self._worker, None
+            self._stopping = True
+            self._changed.notify_all()
+        if worker is not None:
+            worker.join()
+        self.flush()
+
+    def wait(self, timeout: float = None):
+        """Waits until all changes made before are committed (ex. in tests),
+        returns False on timeout"""
+        with self._lock:
+            if self._worker is not None:
+                return self._changed.wait_for(
+                    lambda: not self._pending and not self._flushing, timeout)
+        self.flush()
+        return True
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Changes made inside by this thread (or asyncio task) are committed together
+        at exit (or by parts of _batch_size_), changes of others aren't held back"""
+        if self._batch.get() is not None:  # nested batch is a part of outer one
+            yield self
+            return
+        batch = collections.OrderedDict()
+        token = self._batch.set(batch)
+        try:
+            yield self
+        finally:
+            self._batch.reset(token)
+            if batch:
+                self._enqueue(list(batch.items()))
+
+    def lag(self):
+        """Seconds since the oldest change which isn't committed yet"""
+        queued_at = self._queued_at
+        return time.monotonic() - queued_at if queued_at is not None else 0.0
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'running': self._worker is not None,
+            'pending': len(self._pending),
+            'lag': self.lag(),
+            'last_lag': self.last_lag,
+            'flushes': self.flushes,
+            'retries': self.retries,
+            'errors': self.errors,
+            'last_error': self.last_error,
+        }
+
+
+class SharedIndexWriter:
+    """Writer for several processes of application (ex. uvicorn --workers 4).
+
+    Changes are put into shared queue, worker thread of the process owning
+    lock of index commits changes of all processes with its _writer_,
+    other processes only wait for the lock (searching works everywhere).
+    Without running worker changes are committed at once if lock is free.
+    """
+
+    def __init__(self, queue: IndexQueue, writer: BufferedIndexWriter, lock: OwnerLock,
+                 batch_size: int = SEARCH_WRITER_BATCH_SIZE,
+                 poll_interval: float = SEARCH_QUEUE_POLL_INTERVAL,
+                 retry_delay: float = SEARCH_WRITER_RETRY_DELAY):
+        self.queue = queue
+        self.writer = writer
+        self.lock = lock
+        self.mode = 'shared'
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # changes of active batch of this thread (or asyncio task)
+        self._batch = contextvars.ContextVar('shared_index_batch', default=None)
+        self._last_seq = 0  # the last change put by this process
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._worker = None
+        self.applied = 0
+        self.retries = 0
+        self.errors = 0
+        self.last_error = None
+
+    def _put(self, id_: str, operation: str, document: dict = None):
+        batch = self._batch.get()
+        if batch is None:
+            self._send([(id_, operation, document)])
+        else:
+            batch.append((id_, operation, document))
+
+    def _send(self, changes: list):
+        if not changes:
+            return
+        seq = self.queue.put(changes)
+        with self._lock:
+            self._last_seq = max(self._last_seq, seq)
+        if self._worker is not None:
+            self._wakeup.set()
+        else:
+            self.flush()
+
+    def add(self, document: dict):
+        self._put(document['id'], ADD, document)
+
+    def update(self, document: dict):
+        self._put(document['id'], UPDATE, document)
+
+    def delete(self, id_: str):
+        self._put(id_, DELETE)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Changes made inside by this thread (or asyncio task) are put into queue
+        together at exit"""
+        if self._batch.get() is not None:  # nested batch is a part of outer one
+            yield self
+            return
+        batch = []
+        token = self._batch.set(batch)
+        try:
+            yield self
+        finally:
+            self._batch.reset(token)
+            self._send(batch)
+
+    def flush(self):
+        """Commits queued changes of all processes if this process owns
+        (or can take) lock of index, returns False if it is owned by another one"""
+        with self._flush_lock:
+            if not self.lock.acquire():
+                return False
+            try:
+                while True:
+                    changes = self.queue.take(self.batch_size)
+                    if not changes:
+                        return True
+                    # if commit fails (ex. index is locked by reindex) error is raised
+                    # and changes stay in queue for the next try
+                    with self.writer.batch():
+                        for _, id_, operation, document in changes:
+                            if operation == DELETE:
+                                self.writer.delete(id_)
+                            else:
+                                # change may be applied again after crash of owner
+                                self.writer.update(document)
+                    self.queue.remove(changes[-1][0])
+                    self.applied += len(changes)
+            finally:
+                if self._worker is None:
+                    self.lock.release()
+
+    def _work(self):
+        while not self._stopping.is_set():
+            delay = self.poll_interval
+            try:
+                self.flush()
+            except whoosh.index.LockError:
+                self.retries += 1
+                delay = self.retry_delay
+            except Exception as exc:
+                self.errors += 1
+                self.last_error = repr(exc)
+                delay = self.retry_delay
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+        self.lock.release()
+
+    def start(self):
+        """Starts worker thread which takes lock of index when it's free
+        and then commits changes until stop"""
+        with self._lock:
+            if self._worker is not None:
+                return
+            self._stopping.clear()
+            self._worker = threading.Thread(target=self._work, name='shared-index-writer',
+                                            daemon=True)
+            self._worker.start()
+
+    def stop(self):
+        """Stops worker thread and releases lock of index
+        (changes left in queue are committed by the next owner)"""
+        with self._lock:
+            worker, self._worker = self._worker, None
+        if worker is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            worker.join()
+        self.flush()
+
+    def wait(self, timeout: float = None):
+        """Waits until all changes put by this process are committed (by any process),
+        returns False on timeout"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self.queue.contains(self._last_seq):
+            if self._worker is None and self.flush():
+                continue
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll_interval / 4)
+        return True
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'running': self._worker is not None,
+            'owner': self.lock.owned,
+            **self.queue.stats(),
+            'applied': self.applied,
+            'retries': self.retries,
+            'errors': self.errors,
+            'last_error': self.last_error,
+        }
+
+
+def shared_writer(name: str, indexer: whoosh.index.FileIndex,
+                  searcher_manager: searchers.SearcherManager):
+    return SharedIndexWriter(IndexQueue(SEARCH_QUEUE_PATH, name),
+                             BufferedIndexWriter(indexer, searcher_manager, mode='immediate'),
+                             OwnerLock(SEARCHER_PATH / f'{name}.lock'))
+
+
+def make_writer(name: str, indexer: whoosh.index.FileIndex,
+                searcher_manager: searchers.SearcherManager):
+    if SEARCH_WRITER_MODE == 'shared':
+        return shared_writer(name, indexer, searcher_manager)
+    return BufferedIndexWriter(indexer, searcher_manager)
+
+
+def open_book_writers():
+    """Shards are written independently (each one has its own lock)"""
+    return [
+        make_writer('books' if len(indexers.book_indexers) == 1 else f'books-{number}',
+                    indexer, searcher_manager)
+        for number, (indexer, searcher_manager)
+        in enumerate(zip(indexers.book_indexers, searchers.book_searchers))
+    ]
+
+
+book_writers = open_book_writers()
+user_writer = make_writer('users', indexers.user_indexer, searchers.user_searchers)
+
+core.metrics.register('book_writers', lambda: [writer.stats() for writer in book_writers])
+core.metrics.register('user_writer', user_writer.stats)
+
+
+def all_writers():
+    return [*book_writers, user_writer]
+
+
+def start_all():
+    for writer in all_writers():
+        writer.start()
+
+
+def stop_all():
+    for writer in all_writers():
+        writer.stop()
+
+
+def wait_all(timeout: float = None):
+    """Waits until indexes contain all changes made before"""
+    return all([writer.wait(timeout) for writer in all_writers()])
+
+
+def flush_all():
+    for writer in all_writers():
+        writer.flush()
+
+
+def reopen_book_shards():
+    """Opens books' index again after reindex has changed amount of its shards
+    (lists of indexers, searchers and writers are changed in place)"""
+    for writer in book_writers:
+        writer.stop()
+    for searcher_manager in searchers.book_searchers:
+        searcher_manager.close()
+    indexers.book_shards_lock.share()
+    indexers.book_indexers[:] = indexers.open_shards(indexers.book_folder, schemes.book_scheme,
+                                                     SEARCH_BOOK_SHARDS)
+    searchers.book_searchers[:] = [searchers.SearcherManager(indexer)
+                                   for indexer in indexers.book_indexers]
+    book_writers[:] = open_book_writers()
+
+
+atexit.register(flush_all)
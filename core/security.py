@@ -1,12 +1,65 @@
 from passlib.context import CryptContext
 import secrets
 from config import (PASSWORD_LENGTH, SECRET_KEY, REFRESH_TOKEN_EXPIRES,
-                    ACCESS_TOKEN_EXPIRES)
+                    ACCESS_TOKEN_EXPIRES, PASSWORD_HASHING_WORKERS,
+                    PASSWORD_HASHING_QUEUE_SIZE, BULK_HASHING_PROCESSES,
+                    BULK_HASHING_MIN_SIZE)
+import core.exceptions
+import concurrent.futures
+import multiprocessing
+import atexit
+import time
+import threading
+import asyncio
 import datetime as dt
 import jwt
 
 pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
 ALGORITHM = 'HS256'
+ACCESS_TOKEN, REFRESH_TOKEN = 'access', 'refresh'  # values of _typ_ claim
+
+
+class PasswordExecutor:
+    """Thread pool for bcrypt work, so hashing doesn't block the event loop.
+
+    At most _max_workers_ jobs run at once and at most _max_queue_ jobs wait for
+    a free worker, all jobs above the limit are rejected with 503
+    """
+
+    def __init__(self, max_workers: int, max_queue: int):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='password')
+        self._limit = max_workers + max_queue
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    async def run(self, func, *args):
+        with self._lock:
+            if self._pending >= self._limit:
+                raise core.exceptions.ServerIsBusyException()
+            self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+
+password_executor = PasswordExecutor(PASSWORD_HASHING_WORKERS, PASSWORD_HASHING_QUEUE_SIZE)
+_bulk_executor = None
+
+
+def get_bulk_executor():
+    """Process pool for hashing lots of passwords at once (bcrypt is cpu bound)"""
+    global _bulk_executor
+    if _bulk_executor is None:
+        _bulk_executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=BULK_HASHING_PROCESSES,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+        atexit.register(_bulk_executor.shutdown)
+    return _bulk_executor
 
 
 def generate_random_password():
@@ -21,25 +74,65 @@ def verify_password(pwd, hashed_pwd):
     return pwd_context.verify(pwd, hashed_pwd)
 
 
+async def get_password_hash_async(password):
+    return await password_executor.run(get_password_hash, password)
+
+
+async def verify_password_async(pwd, hashed_pwd):
+    return await password_executor.run(verify_password, pwd, hashed_pwd)
+
+
+def get_password_hashes(passwords):
+    return [get_password_hash(password) for password in passwords]
+
+
+async def get_password_hashes_async(passwords: list):
+    """Hashes passwords keeping their order.
+    Small lists go to the password executor, big ones are split between processes
+    """
+    if len(passwords) < BULK_HASHING_MIN_SIZE:
+        return await asyncio.gather(*[get_password_hash_async(pwd) for pwd in passwords])
+
+    size = -(-len(passwords) // BULK_HASHING_PROCESSES)
+    loop = asyncio.get_running_loop()
+    chunks = await asyncio.gather(*[
+        loop.run_in_executor(get_bulk_executor(), get_password_hashes, passwords[i:i + size])
+        for i in range(0, len(passwords), size)
+    ])
+    return [hashed for chunk in chunks for hashed in chunk]
+
+
 def generate_login(id_):
     return 'sch' + dt.datetime.utcnow().strftime('%Y') + str(id_)
 
 
-def generate_token(user_id, exp):
-    return jwt.encode({
+def generate_token(user_id, exp, rights=None, version=0, token_type=ACCESS_TOKEN):
+    """Token has its type (_typ_), user's rights and version of user's tokens (_ver_),
+    tokens with old version are not valid.
+    Refresh tokens have no rights: they are only exchanged for access tokens
+    """
+    data = {
         'id': user_id,
-        'exp': exp
-    }, algorithm=ALGORITHM, key=SECRET_KEY)
+        'exp': exp,
+        'iat': time.time(),
+        'ver': version,
+        'typ': token_type,
+    }
+    if token_type == ACCESS_TOKEN:
+        data['rights'] = rights.value if rights else None
+    return jwt.encode(data, algorithm=ALGORITHM, key=SECRET_KEY)
 
 
-def create_tokens(user_id):
+def create_tokens(user_id, rights=None, version=0):
     access_token = generate_token(
         user_id,
-        dt.datetime.utcnow() + dt.timedelta(minutes=ACCESS_TOKEN_EXPIRES)
+        dt.datetime.utcnow() + dt.timedelta(minutes=ACCESS_TOKEN_EXPIRES),
+        rights, version
     )
     refresh_token = generate_token(
         user_id,
-        dt.datetime.utcnow() + dt.timedelta(days=REFRESH_TOKEN_EXPIRES)
+        dt.datetime.utcnow() + dt.timedelta(days=REFRESH_TOKEN_EXPIRES),
+        version=version, token_type=REFRESH_TOKEN
     )
 
     return {
@@ -1,18 +1,19 @@
-import sqlalchemy
+import sqlalchemy.orm
+import sqlalchemy.ext.asyncio
 from models import Base
+from core.db import create_engine, create_async_engine
 
-engine = sqlalchemy.create_engine(
-    'sqlite:///./test.db', connect_args={'check_same_thread': False}
-)
+engine = create_engine('sqlite:///./test.db')
 
 Base.metadata.create_all(bind=engine)
 
+async_engine = create_async_engine('sqlite+aiosqlite:///./test.db')
+
 SessionLocal = sqlalchemy.orm.sessionmaker(autoflush=False, bind=engine)
+AsyncSessionLocal = sqlalchemy.ext.asyncio.async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False)
 
 
-def override_get_db():
-    try:
-        db = SessionLocal()
+async def override_get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -0,0 +1,538 @@
+import asyncio
+import os
+import pathlib
+import subprocess
+import sys
+import threading
+import time
+import pytest
+import sqlalchemy
+import whoosh.fields
+import whoosh.index
+from core.test_db import Base, engine, async_engine, SessionLocal
+from core.search.schemes import user_scheme, book_scheme, make_book_scheme
+import core.search.schemes
+from core.search.searchers import SearcherManager
+from core.search.cruds import SearchCRUD, BookCRUD, UserCRUD
+from core.search.writers import BufferedIndexWriter
+from core.search.queue import IndexQueue
+from core.search.reindex import reindex
+from core.search.indexers import upgrade_schema, use_index
+from core.search import fts
+from core.search.shards import Shard, ShardsLock, existing_shards
+import models
+from config import SQLITE_BUSY_TIMEOUT, SQLITE_CACHE_SIZE
+
+
+@pytest.fixture()
+def test_db():
+    Base.metadata.create_all(bind=engine)
+    yield
+    with SessionLocal() as db:  # rows are indexed through search outbox
+        for user in db.query(models.User).all():
+            UserCRUD().delete(user.id)
+        for book in db.query(models.Book).all():
+            BookCRUD().delete(book.id)
+    Base.metadata.drop_all(bind=engine)
+
+
+def test_sqlite_pragmas():
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+        assert connection.exec_driver_sql('PRAGMA synchronous').scalar() == 1  # NORMAL
+        assert connection.exec_driver_sql('PRAGMA busy_timeout').scalar() == SQLITE_BUSY_TIMEOUT
+        assert connection.exec_driver_sql('PRAGMA cache_size').scalar() == SQLITE_CACHE_SIZE
+
+    async def get_async_pragmas():
+        async with async_engine.connect() as connection:
+            return [
+                await connection.scalar(sqlalchemy.text('PRAGMA journal_mode')),
+                await connection.scalar(sqlalchemy.text('PRAGMA busy_timeout')),
+            ]
+
+    assert asyncio.run(get_async_pragmas()) == ['wal', SQLITE_BUSY_TIMEOUT]
+
+
+def test_read_while_writing(test_db):
+    with engine.connect() as writer, engine.connect() as reader:
+        writer.exec_driver_sql('BEGIN IMMEDIATE')
+        writer.exec_driver_sql("INSERT INTO User (login, password) VALUES ('writer', '-')")
+        # reader sees last committed state and isn't blocked by writer
+        assert reader.exec_driver_sql(
+            "SELECT count(*) FROM User WHERE login = 'writer'").scalar() == 0
+        writer.rollback()
+
+
+def test_shared_searcher(tmp_path):
+    indexer = whoosh.index.create_in(tmp_path, user_scheme)
+    manager = SearcherManager(indexer, check_interval=0)
+
+    def add_user(id_):
+        writer = indexer.writer()
+        writer.add_document(id=str(id_), login=f'user{id_}')
+        writer.commit()
+
+    add_user(1)
+    with manager.searcher() as first:
+        assert first.doc_count() == 1
+    with manager.searcher() as second:
+        assert second is first  # nothing changed, searcher is reused
+    assert manager.refreshes == 1
+
+    with manager.searcher() as in_use:
+        add_user(2)  # commit from "other process", noticed by generation check
+        with manager.searcher() as fresh:
+            assert fresh is not in_use
+            assert fresh.doc_count() == 2
+        assert not in_use.is_closed  # still used by request
+        assert in_use.doc_count() == 1
+    assert in_use.is_closed
+    assert manager.stats()['open_searchers'] == 1
+
+    manager.check_interval = 3600
+    add_user(3)
+    with manager.searcher() as searcher:
+        assert searcher.doc_count() == 2  # generation isn't checked yet
+    manager.invalidate()
+    with manager.searcher() as searcher:
+        assert searcher.doc_count() == 3
+    manager.close()
+
+
+def test_search_field_boosts(tmp_path):
+    indexer = whoosh.index.create_in(tmp_path, book_scheme)
+    manager = SearcherManager(indexer)
+    crud = SearchCRUD(book_scheme, indexer, {'title': 3.0, 'authors': 2.0, 'description': 1.0},
+                      manager, BufferedIndexWriter(indexer, manager))
+    # word is found once in different fields of the same length
+    books = [
+        ('анна каренина', 'лев толстой', 'война жизнь'),
+        ('война мир', 'лев толстой', 'про жизнь'),
+        ('анна каренина', 'война толстой', 'про жизнь'),
+        ('анна каренина', 'лев толстой', 'про жизнь'),
+    ]
+    crud.create_many([
+        {'id': str(id_), 'title': title, 'authors': authors, 'description': description}
+        for id_, (title, authors, description) in enumerate(books, start=1)
+    ])
+
+    found = crud.search('война', 1)
+    assert found.ids == [2, 3, 1]
+    assert found.total == 3
+    assert crud.search('воина', 1).ids == [2, 3, 1]  # fuzzy terms keep boosts
+    crud.searchers.close()
+
+
+def test_batched_index_writer(tmp_path):
+    indexer = whoosh.index.create_in(tmp_path, user_scheme)
+    manager = SearcherManager(indexer, check_interval=3600)
+    writer = BufferedIndexWriter(indexer, manager, mode='immediate', batch_size=3)
+
+    def logins():
+        with manager.searcher() as searcher:
+            return sorted(doc['login'] for doc in searcher.documents())
+
+    writer.add({'id': '1', 'login': 'first'})
+    assert logins() == ['first']  # immediate mode commits at once
+
+    with writer.batch():
+        writer.add({'id': '2', 'login': 'second'})
+        writer.update({'id': '2', 'login': 'changed'})
+        writer.add({'id': '3', 'login': 'removed'})
+        writer.delete('3')
+        writer.delete('1')
+        writer.add({'id': '1', 'login': 'reused'})
+        assert logins() == ['first']
+    assert logins() == ['changed', 'reused']
+    assert writer.flushes == 2
+
+    with writer.batch():
+        for id_ in range(10, 17):
+            writer.add({'id': str(id_), 'login': f'user{id_}'})
+        assert writer.flushes == 4  # flushed by parts of batch_size
+    assert writer.flushes == 5
+
+    writer = BufferedIndexWriter(indexer, manager, mode='buffered', batch_size=100,
+                                 flush_interval=0.1)
+    writer.delete('1')
+    assert writer.stats()['pending'] == 1
+    time.sleep(0.5)
+    assert writer.stats()['pending'] == 0
+    assert writer.flushes == 1
+    assert 'reused' not in logins()
+
+    writer = BufferedIndexWriter(indexer, manager, mode='buffered', batch_size=100,
+                                 flush_interval=0.05, retry_delay=0.05)
+    write = writer._write
+    failures = [whoosh.index.LockError(), OSError('disk is full')]
+
+    def locked_write(changes):
+        if failures:
+            raise failures.pop(0)
+        write(changes)
+
+    writer._write = locked_write
+    writer.add({'id': '20', 'login': 'retried'})
+    time.sleep(0.5)
+    assert writer.stats()['pending'] == 0  # failed flushes are retried by timer
+    assert (writer.retries, writer.errors, writer.flushes) == (1, 1, 1)
+    assert 'retried' in logins()
+    manager.close()
+
+
+def test_background_index_writer(tmp_path, monkeypatch):
+    indexer = whoosh.index.create_in(tmp_path, user_scheme)
+    manager = SearcherManager(indexer, check_interval=3600)
+    writer = BufferedIndexWriter(indexer, manager, mode='background', retry_delay=0.05)
+
+    def logins():
+        with manager.searcher() as searcher:
+            return sorted(doc['login'] for doc in searcher.documents())
+
+    writer.add({'id': '1', 'login': 'inline'})
+    assert logins() == ['inline']  # without worker changes are committed at once
+
+    writer.start()
+    other_writer = indexer.writer()  # index is locked, ex. by another process
+    writer.update({'id': '1', 'login': 'first'})
+    writer.add({'id': '2', 'login': 'second'})
+    writer.update({'id': '2', 'login': 'changed'})
+    time.sleep(0.3)
+    stats = writer.stats()
+    assert stats['running'] and stats['pending'] == 2
+    assert stats['retries'] > 0 and stats['lag'] > 0
+    assert not writer.wait(timeout=0.1)
+    assert logins() == ['inline']
+
+    other_writer.cancel()
+    assert writer.wait(timeout=5)
+    assert logins() == ['changed', 'first']
+    assert writer.stats()['lag'] == 0 and writer.last_lag > 0.3
+
+    with writer.batch():  # batch of one request doesn't hold back changes of others
+        writer.add({'id': '3', 'login': 'batched'})
+        other = threading.Thread(target=lambda: writer.update({'id': '4', 'login': 'other'}))
+        other.start()
+        other.join()
+        assert writer.wait(timeout=5)
+        assert logins() == ['changed', 'first', 'other']
+    assert writer.wait(timeout=5)
+    assert 'batched' in logins()
+
+    def broken_write(changes):
+        raise OSError('disk is full')
+
+    monkeypatch.setattr(writer, '_write', broken_write)
+    writer.update({'id': '4', 'login': 'lost?'})
+    assert not writer.wait(timeout=0.3)  # failed changes aren't reported as committed
+    assert writer.stats()['pending'] == 1 and 'disk is full' in writer.last_error
+    monkeypatch.undo()
+    assert writer.wait(timeout=5)  # and are committed by the next try
+    assert 'lost?' in logins()
+
+    writer.delete('1')
+    writer.stop()  # the rest is committed at stop
+    assert logins() == ['batched', 'changed', 'lost?']
+    assert not writer.stats()['running']
+    manager.close()
+
+
+SHARED_WRITER_PROCESS = '''
+import sys
+import whoosh.query
+import core.search.writers as writers
+from core.search.searchers import book_searchers
+
+process = sys.argv[1]
+writers.start_all()
+for i in range(30):
+    writers.book_writers[0].add({'id': f'{process}-{i}', 'title': f'book {process}'})
+    writers.book_writers[0].update({'id': f'{process}-last', 'title': f'version {i}'})
+assert writers.wait_all(timeout=60)
+with book_searchers[0].searcher() as searcher:  # every process reads index itself
+    assert len(searcher.search(whoosh.query.Prefix('id', f'{process}-'), limit=None)) == 31
+writers.stop_all()
+'''
+
+
+def test_shared_index_writer(tmp_path):
+    env = dict(os.environ, SEARCHER_PATH=str(tmp_path), SEARCH_WRITER_MODE='shared',
+               SEARCHER_CHECK_INTERVAL='0', SEARCH_QUEUE_POLL_INTERVAL='0.05')
+    processes = [subprocess.Popen([sys.executable, '-c', SHARED_WRITER_PROCESS, str(number)],
+                                  env=env,
+                                  cwd=pathlib.Path(__file__).resolve().parent.parent,
+                                  stderr=subprocess.PIPE)
+                 for number in range(4)]
+    for process in processes:
+        _, errors = process.communicate(timeout=120)
+        assert process.returncode == 0, errors.decode()
+
+    with whoosh.index.open_dir(tmp_path / 'books').searcher() as searcher:
+        documents = {doc['id']: doc['title'] for doc in searcher.documents()}
+    assert len(documents) == 4 * 31  # no lost or duplicated documents
+    for number in range(4):
+        assert documents[f'{number}-last'] == 'version 29'
+    assert IndexQueue(tmp_path / 'index_queue.db', 'books').stats()['queued'] == 0
+
+
+def test_reindex(test_db, tmp_path):
+    with SessionLocal() as db:
+        db.add_all([models.Book(title=f'book {i}', amount=1) for i in range(50)])
+        db.commit()
+
+        legacy = tmp_path / 'books'
+        legacy.mkdir()
+        whoosh.index.create_in(legacy, book_scheme)
+        manager = SearcherManager(whoosh.index.open_dir(legacy), check_interval=0)
+        with manager.searcher() as searcher:
+            assert searcher.doc_count() == 0
+
+        lock = ShardsLock(tmp_path / 'books.shards.lock')  # index is used by application
+        lock.share()
+        try:
+            with pytest.raises(RuntimeError):
+                reindex('books', db, base_path=tmp_path, procs=1)
+            assert not legacy.is_symlink()
+        finally:
+            lock.release()
+
+        assert reindex('books', db, base_path=tmp_path, procs=2, chunk_size=7) == 50
+        assert legacy.is_symlink()
+        with manager.searcher() as searcher:  # live index handle sees swapped folder
+            assert searcher.doc_count() == 50
+            assert {doc['title'] for doc in searcher.documents()} == {
+                f'book {i}' for i in range(50)}
+
+        db.add(models.Book(title='one more', amount=1))
+        db.commit()
+        first_folder = legacy.resolve()
+        assert reindex('books', db, base_path=tmp_path, procs=1) == 51
+        assert not first_folder.exists()
+        assert {path.name for path in tmp_path.iterdir() if path.suffix != '.lock'} == {
+            'books', legacy.resolve().name}
+        with manager.searcher() as searcher:
+            assert searcher.doc_count() == 51
+        manager.close()
+
+
+def test_use_index(tmp_path):
+    folder = tmp_path / 'users'
+    folder.mkdir()
+    whoosh.index.create_in(folder, user_scheme)
+    first, second = (ShardsLock(tmp_path / 'users.shards.lock') for _ in range(2))
+    use_index(folder, first)  # the first process moves index under symlink
+    assert folder.is_symlink() and whoosh.index.exists_in(folder)
+    moved = folder.resolve()
+    use_index(folder, second)
+    assert folder.resolve() == moved
+    assert not ShardsLock(tmp_path / 'users.shards.lock').acquire()  # index is used
+    first.release()
+    second.release()
+
+
+def test_compact_scheme(test_db, tmp_path, monkeypatch):
+    def folder_size(folder):
+        return sum(path.stat().st_size for path in folder.resolve().iterdir())
+
+    with SessionLocal() as db:
+        db.add_all([models.Book(title=f'книга {i}', authors=f'Автор {i % 3}', amount=1,
+                                description='длинное описание ' * 50, edition_date=2000 + i,
+                                is_private=False) for i in range(50)])
+        db.commit()
+        reindex('books', db, base_path=tmp_path, procs=1)
+        full_size = folder_size(tmp_path / 'books')
+
+        # scheme is changed by reindex
+        monkeypatch.setattr(core.search.schemes, 'book_scheme', make_book_scheme(stored=False))
+        reindex('books', db, base_path=tmp_path, procs=1)
+    indexer = whoosh.index.open_dir(tmp_path / 'books')
+    assert indexer.schema.stored_names() == ['id']
+    assert folder_size(tmp_path / 'books') < full_size
+
+    manager = SearcherManager(indexer)
+    crud = SearchCRUD(indexer.schema, indexer, {'title': 3.0, 'authors': 2.0}, manager,
+                      BufferedIndexWriter(indexer, manager), mode='exact')
+    found = crud.search('автор', 1, filter=whoosh.query.NumericRange('edition_date', 2010, 2019),
+                        groupedby={'authors': whoosh.sorting.FieldFacet('author',
+                                                                        allow_overlap=True)})
+    assert found.total == 10
+    assert found.groups['authors'] == {'Автор 0': 3, 'Автор 1': 4, 'Автор 2': 3}
+    manager.close()
+
+
+def test_sharded_index(test_db, tmp_path):
+    def make_crud(folders):
+        shards = []
+        for folder in folders:
+            folder.mkdir()
+            indexer = whoosh.index.create_in(folder, book_scheme)
+            manager = SearcherManager(indexer)
+            shards.append(Shard(indexer, manager, BufferedIndexWriter(indexer, manager)))
+        return SearchCRUD(book_scheme, None, {'title': 3.0, 'authors': 2.0}, None, None,
+                          mode='exact', shards=shards)
+
+    sharded = make_crud([tmp_path / f'shard-{number}' for number in range(3)])
+    single = make_crud([tmp_path / 'single'])
+    documents = [{'id': str(id_), 'title': f'книга {"том " * (id_ % 4)}{id_}',
+                  'authors': f'Автор {id_ % 2}', 'author': f'Автор {id_ % 2}'}
+                 for id_ in range(1, 31)]
+    for crud in (sharded, single):
+        crud.create_many(documents)
+        crud.update(5, {'title': 'другая', 'authors': 'Автор 1', 'author': 'Автор 1'})
+        crud.delete(6)
+        assert crud.wait(timeout=10)
+
+    for number, shard in enumerate(sharded.shards):  # documents are routed by id
+        with shard.searchers.searcher() as searcher:
+            assert {int(doc['id']) % 3 for doc in searcher.documents()} == {number}
+    assert [doc['id'] for doc in sharded.get_all_indices()] == sorted(
+        str(id_) for id_ in range(1, 31) if id_ != 6)
+
+    facets = {'authors': whoosh.sorting.FieldFacet('author', allow_overlap=True)}
+    found = sharded.search('книга', 1, pagelen=10, groupedby=facets)
+    assert found.total == 28
+    assert found.groups == {'authors': {'Автор 0': 14, 'Автор 1': 14}}
+    pages = found.ids + sharded.search('книга', 2, pagelen=10).ids + sharded.search(
+        'книга', 3, pagelen=10).ids
+    assert sorted(pages) == sorted(single.search_ids('книга')) == sorted(
+        sharded.search_ids('книга'))
+    assert pages == sharded.search_ids('книга')  # pages are parts of one order
+    assert sharded.search('другая', 1).ids == [5]
+    assert sharded.search('том', 1).total == single.search('том', 1).total == 21
+    assert len(sharded.generation()) == 3
+    for crud in (sharded, single):
+        for shard in crud.shards:
+            shard.searchers.close()
+
+    with SessionLocal() as db:  # amount of shards is changed by reindex
+        db.add_all([models.Book(title=f'book {i}', amount=1) for i in range(20)])
+        db.commit()
+        assert reindex('books', db, base_path=tmp_path, procs=2, shards=3) == 20
+        assert existing_shards(tmp_path / 'books') == 3
+        for number in range(3):
+            with whoosh.index.open_dir(tmp_path / 'books' / f'shard-{number}').searcher() as s:
+                assert {int(doc['id']) % 3 for doc in s.documents()} == {number}
+        assert reindex('books', db, base_path=tmp_path, procs=1, shards=1) == 20
+        assert existing_shards(tmp_path / 'books') == 1
+        with whoosh.index.open_dir(tmp_path / 'books').searcher() as searcher:
+            assert searcher.doc_count() == 20
+
+    lock = ShardsLock(tmp_path / 'books.shards.lock')  # index is used by application
+    lock.share()
+    try:
+        with SessionLocal() as db:
+            with pytest.raises(RuntimeError):
+                reindex('books', db, base_path=tmp_path, procs=1, shards=2)
+            assert existing_shards(tmp_path / 'books') == 1
+            assert reindex('books', db, base_path=tmp_path, procs=1, shards=1) == 20
+    finally:
+        lock.release()
+    with SessionLocal() as db:
+        assert reindex('books', db, base_path=tmp_path, procs=1, shards=2) == 20
+        assert existing_shards(tmp_path / 'books') == 2
+
+
+def test_upgrade_index_schema(tmp_path):
+    old_scheme = whoosh.fields.Schema(id=whoosh.fields.ID(unique=True, stored=True),
+                                      title=whoosh.fields.TEXT(stored=True))
+    indexer = whoosh.index.create_in(tmp_path, old_scheme)
+    writer = indexer.writer()
+    writer.add_document(id='1', title='old')
+    writer.commit()
+
+    indexer = upgrade_schema(whoosh.index.open_dir(tmp_path), book_scheme)
+    assert set(indexer.schema.names()) == set(book_scheme.names())
+    writer = indexer.writer()
+    writer.add_document(id='2', title='new', edition_date=2024, is_private=True)
+    writer.commit()
+    with indexer.searcher() as searcher:
+        hits = searcher.search(whoosh.query.Term('is_private', True))
+        assert [hit['id'] for hit in hits] == ['2']
+        assert searcher.doc_count() == 2
+        # old document is found by students before reindex
+        hits = searcher.search(whoosh.query.Every(), filter=BookCRUD.filter())
+        assert [hit['id'] for hit in hits] == ['1']
+
+
+def test_search_modes(tmp_path):
+    indexer = whoosh.index.create_in(tmp_path, book_scheme)
+    manager = SearcherManager(indexer)
+    writer = BufferedIndexWriter(indexer, manager)
+    books = [('Капитанская дочка', 'Пушкин'), ('Мёртвые души', 'Гоголь'),
+             ('Капитан Сорвиголова', 'Буссенар')]
+    with writer.batch():
+        for id_, (title, authors) in enumerate(books, start=1):
+            writer.add({'id': str(id_), 'title': title, 'authors': authors, 'author': authors,
+                        'title_ngram': title, 'authors_ngram': authors})
+
+    def search(mode, query):
+        crud = SearchCRUD(book_scheme, indexer, {'title': 3.0, 'authors': 2.0}, manager, writer,
+                          {'title_ngram': 3.0, 'authors_ngram': 2.0}, mode)
+        return crud.search(query, 1).ids
+
+    assert search('exact', 'пушкин') == [1]
+    assert search('exact', 'пушкен') == []
+    assert search('fuzzy', 'пушкен') == [1]
+    assert search('ngram', 'пушкен') == [1]
+    assert search('ngram', 'капитанская дочко') == [1]  # every word must be found
+    assert search('ngram', 'гаголь') == [2]
+    assert search('ngram', 'капитан')[0] == 3  # exact word is better
+    assert search('ngram', 'зуммер') == []
+    with pytest.raises(ValueError):
+        search('ngrams', 'пушкин')  # typo in mode isn't taken for exact search
+
+    env = dict(os.environ, SEARCH_MODE='ngrams')
+    process = subprocess.run([sys.executable, '-c', 'import config'], env=env,
+                             cwd=pathlib.Path(__file__).resolve().parent.parent,
+                             capture_output=True)
+    assert process.returncode != 0 and b'SEARCH_MODE must be one of' in process.stderr
+    manager.close()
+
+
+def test_fts_backend(test_db):
+    with engine.begin() as connection:
+        fts.install_all(connection)
+    crud = fts.BookCRUD(engine)
+    with SessionLocal() as db:
+        books = [models.Book(title='Капитанская дочка', authors='Пушкин', edition_date=1836,
+                             is_private=False),
+                 models.Book(title='Пиковая дама', authors='Пушкин', description='капитан',
+                             edition_date=1834, is_private=True),
+                 models.Book(title='Капитан Сорвиголова', authors='Буссенар, Другой',
+                             edition_date=1901, is_private=False)]
+        db.add_all(books)
+        db.commit()
+        ids = crud.search('капитан', 1, filter=crud.filter(with_private=True)).ids
+        assert ids[-1] == books[1].id  # title is more important than description
+        assert set(ids) == {book.id for book in books}
+        assert crud.search('капит', 1, filter=crud.filter()).total == 2  # without private one
+        assert crud.search('капитан', 1, filter=crud.filter(edition_date=1836)).ids == [
+            books[0].id]
+        assert crud.search('', 1, pagelen=2, filter=crud.filter()).ids == [
+            books[0].id, books[2].id]
+
+        groups = crud.search('капитан', 1, filter=crud.filter(), groupedby=crud.facets()).groups
+        assert groups['authors'] == {'Пушкин': 1, 'Буссенар': 1, 'Другой': 1}
+        assert groups['edition_years'] == {(1900, 1910): 1}  # years before 1900 aren't counted
+
+        books[0].title = 'Дубровский'
+        db.delete(books[2])
+        new_book = models.Book(title='Капитан Немо', is_private=False)
+        db.add(new_book)
+        db.flush()
+        # search table is changed in the same transaction as rows
+        found = db.scalars(sqlalchemy.text('SELECT rowid FROM "BookSearch" '
+                                           'WHERE "BookSearch" MATCH \'"капитан"*\''))
+        assert set(found) == {books[1].id, new_book.id}
+        assert set(crud.search_ids('капитан')) == {book.id for book in books}
+        db.rollback()
+        assert set(crud.search_ids('капитан')) == {book.id for book in books}
+
+        books[0].title = 'Дубровский'
+        db.delete(books[2])
+        db.commit()
+        assert crud.search('капитан', 1, filter=crud.filter()).ids == []
+        assert crud.search_ids('дубровский') == [books[0].id]
+    with engine.begin() as connection:
+        for table in fts.TABLES:
+            fts.drop(connection, table)
@@ -1,10 +1,10 @@
-from core.db import get_db
+from core.db import SessionLocal
 from models import Rights, User
 from getpass import getpass
 from core.security import get_password_hash
 
 
-db = list(get_db())[0]
+db = SessionLocal()
 
 
 def main():
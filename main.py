@@ -1,9 +1,50 @@
 from auth.views import router as auth_router
 from users.views import router as users_router
 from books.views import router as books_router
+from auth.utils import get_token_user
+from auth.schemes import Principal
+from typing import Annotated
+import core.exceptions
+import core.validators
+import core.metrics
+import core.search.writers
+import core.search.reconcile
+import core.search.outbox
+from config import SEARCH_RECONCILE_INTERVAL
+import asyncio
+import contextlib
 import fastapi
 
-app = fastapi.FastAPI()
+
+@contextlib.asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    core.search.writers.start_all()
+    core.search.outbox.dispatcher.start()
+    reconcile_task = None
+    if SEARCH_RECONCILE_INTERVAL > 0:
+        reconcile_task = asyncio.create_task(
+            core.search.reconcile.reconcile_periodically(SEARCH_RECONCILE_INTERVAL))
+    yield
+    if reconcile_task is not None:
+        reconcile_task.cancel()
+    core.search.outbox.dispatcher.stop()
+    core.search.writers.stop_all()
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
 app.include_router(auth_router, prefix='/auth', tags=['auth'])
 app.include_router(users_router, prefix='/users', tags=['users'])
 app.include_router(books_router, prefix='/books', tags=['books'])
+
+
+@app.get(
+    '/metrics',
+    tags=['metrics'],
+    summary='Get internal metrics (caches, queues...)',
+    description='__Note:__ only _admin_ has access to this operation'
+)
+async def get_metrics(
+        current_user: Annotated[Principal, fastapi.Depends(get_token_user)]):
+    if await core.validators.is_admin(current_user):
+        return core.metrics.collect()
+    raise core.exceptions.NotEnoughRightsException()
@@ -23,6 +23,9 @@ BookCarriers = sqlalchemy.Table(
     sqlalchemy.Column('user_id',
                       sqlalchemy.Integer, sqlalchemy.ForeignKey('User.id')),
     sqlalchemy.Column('return_date', sqlalchemy.Date),
+    sqlalchemy.Index('ix_BookCarriers_book_id_user_id', 'book_id', 'user_id'),
+    sqlalchemy.Index('ix_BookCarriers_user_id_book_id', 'user_id', 'book_id'),
+    sqlalchemy.Index('ix_BookCarriers_return_date', 'return_date'),
 )
 
 
@@ -36,10 +39,15 @@ class Book(Base):
     description = sqlalchemy.Column(sqlalchemy.Text)
     edition_date = sqlalchemy.Column(sqlalchemy.Integer)
     amount = sqlalchemy.Column(sqlalchemy.Integer)
+    on_loan = sqlalchemy.Column(sqlalchemy.Integer, nullable=False,
+                                default=0, server_default='0')  # amount of given books
     is_private = sqlalchemy.Column(sqlalchemy.Boolean)
     image = sqlalchemy.Column(sqlalchemy.String)
 
     owners = sqlalchemy.orm.relationship('User', secondary=BookCarriers, back_populates='books')
+    # order of books in lists (expression index below)
+    sort_key = sqlalchemy.orm.column_property(
+        sqlalchemy.func.coalesce(title, sqlalchemy.literal_column("''")))
 
 
 class User(Base):
@@ -56,5 +64,46 @@ class User(Base):
     birthdate = sqlalchemy.Column(sqlalchemy.Date)
     year_of_study = sqlalchemy.Column(sqlalchemy.Integer)
     rights = sqlalchemy.Column(sqlalchemy.Enum(Rights))
+    token_version = sqlalchemy.Column(sqlalchemy.Integer, nullable=False,
+                                      default=0, server_default='0')
 
     books = sqlalchemy.orm.relationship('Book', secondary=BookCarriers, back_populates='owners')
+    # order of users in lists (expression index below)
+    sort_key = sqlalchemy.orm.column_property(
+        sqlalchemy.func.coalesce(surname, sqlalchemy.literal_column("''")))
+
+
+class PrincipalsVersion(Base):
+    """Counter of changes of users, cached authenticated users
+    of all processes are dropped when it changes (see auth.utils)"""
+    __tablename__ = 'PrincipalsVersion'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    version = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+
+
+class SearchOutbox(Base):
+    """Changes of search documents, written in the same transaction
+    as books and users (see core.search.outbox)"""
+    __tablename__ = 'SearchOutbox'
+    # seq mustn't be reused after old changes are removed
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    seq = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
+    index_name = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    doc_id = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    operation = sqlalchemy.Column(sqlalchemy.String, nullable=False)  # update / delete
+    document = sqlalchemy.Column(sqlalchemy.JSON)
+    created_at = sqlalchemy.Column(sqlalchemy.Float, nullable=False)  # unix time
+
+
+class SearchOutboxCursor(Base):
+    """The last change of outbox applied to search indexes"""
+    __tablename__ = 'SearchOutboxCursor'
+
+    name = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    seq = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+
+
+sqlalchemy.Index('ix_Book_sort_key_id', Book.sort_key.expression, Book.id)
+sqlalchemy.Index('ix_User_sort_key_id', User.sort_key.expression, User.id)
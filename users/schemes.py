@@ -18,3 +18,11 @@ class PageResponseModel(pydantic.BaseModel, typing.Generic[T]):
     total: int
     page: int
     results: typing.List[T]
+
+
+class CursorPageResponseModel(pydantic.BaseModel, typing.Generic[T]):
+    size: int
+    next_cursor: typing.Optional[str] = None
+    total: typing.Optional[int] = None
+    truncated: bool = False  # search found more items than are paged
+    results: typing.List[T]
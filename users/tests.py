@@ -3,13 +3,14 @@ from fastapi.testclient import TestClient
 import pytest
 from core.security import get_password_hash
 from models import User, Rights
-from core.test_db import Base, engine, override_get_db
+from core.test_db import Base, engine, override_get_db, SessionLocal
 from core.db import get_db
+from auth.utils import principal_cache
 import datetime as dt
 from core.search.cruds import UserCRUD
 
 app.dependency_overrides[get_db] = override_get_db
-db = next(override_get_db())
+db = SessionLocal()
 
 client = TestClient(app)
 
@@ -18,6 +19,7 @@ client = TestClient(app)
 def test_db():
     Base.metadata.create_all(bind=engine)
     yield
+    principal_cache.clear()
     for user in db.query(User).all():
         UserCRUD().delete(user.id)
     Base.metadata.drop_all(bind=engine)
@@ -150,3 +152,91 @@ def test_delete_user(test_db):
     r2 = client.delete(f'/users/delete/{user.id}', headers=resp.headers)
     assert r2.status_code == 200
     assert len(db.query(User).all()) == 1
+
+
+def test_deleted_user_token(test_db):
+    login, password, user = create_student()
+    admin_login, admin_password, admin = create_admin()
+
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
+    data = {
+        'username': login,
+        'password': password
+    }
+    student_resp = client.post('/auth/login', headers=headers, data=data)
+    assert client.get('/auth/whoami', headers=student_resp.headers).status_code == 200
+    cached = principal_cache.get(user.id)
+
+    data['username'] = admin_login
+    data['password'] = admin_password
+    admin_resp = client.post('/auth/login', headers=headers, data=data)
+    resp = client.delete(f'/users/delete/{user.id}', headers=admin_resp.headers)
+    assert resp.status_code == 200
+
+    resp = client.get('/auth/whoami', headers=student_resp.headers)
+    assert resp.status_code == 401  # cached user must be removed
+
+    principal_cache.set(user.id, cached)  # cache of another process, it isn't invalidated
+    resp = client.get('/auth/whoami', headers=student_resp.headers)
+    assert resp.status_code == 401
+
+
+def test_load_csv(test_db):
+    admin_login, admin_password, _ = create_admin()
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
+    data = {
+        'username': admin_login,
+        'password': admin_password
+    }
+    resp = client.post('/auth/login', headers=headers, data=data)
+
+    csv_file = (
+        'Name;Middlename;Surname;Birthdate;year_of_study\n'
+        'Иван;Иваныч;Иванов;2006-04-02;11\n'
+        'Акакий;Матвеевич;Братишкин;03.05.2006;10\n'
+    ).encode('utf-8')
+    load_resp = client.post(
+        '/users/load_csv',
+        headers={'Authorization': resp.headers['Authorization']},
+        files={'csv_file': ('users.csv', csv_file, 'text/csv')}
+    )
+    assert load_resp.status_code == 200
+
+    users = load_resp.json()['users']
+    assert [user['surname'] for user in users] == ['Иванов', 'Братишкин']
+    for user in users:
+        student = db.query(User).filter(User.login == user['login']).first()
+        assert student is not None
+        assert student.login.endswith(str(student.id))
+
+        data = {
+            'username': user['login'],
+            'password': user['password']
+        }
+        assert client.post('/auth/login', headers=headers, data=data).status_code == 200
+
+
+def test_search_by_cursor(test_db):
+    admin_login, admin_password, admin = create_admin()
+    _, _, student = create_student()
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
+    data = {
+        'username': admin_login,
+        'password': admin_password
+    }
+    resp = client.post('/auth/login', headers=headers, data=data)
+    headers = {'Authorization': resp.headers['Authorization']}
+
+    first = client.post('/users/search', headers=headers, params={'size': 1}).json()
+    assert len(first['results']) == 1
+    second = client.post('/users/search', headers=headers,
+                         params={'size': 1, 'cursor': first['next_cursor']}).json()
+    assert second['next_cursor'] is None
+    ids = {first['results'][0]['id'], second['results'][0]['id']}
+    assert ids == {admin.id, student.id}
@@ -1,21 +1,121 @@
 from . import schemes
-from config import ITEMS_PER_PAGE
-from sqlalchemy.orm import Session
-from auth.utils import create_user, get_max_user_id
+from config import (ITEMS_PER_PAGE, MAX_ITEMS_PER_PAGE, TOTAL_COUNT_CACHE_TTL, SEARCH_MAX_HITS,
+                    SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+from sqlalchemy.ext.asyncio import AsyncSession
+import sqlalchemy
 import datetime as dt
+import base64
+import json
+import fastapi
 from models import User
+from core.cache import TTLCache
+import core.metrics
 
+total_count_cache = TTLCache(256, TOTAL_COUNT_CACHE_TTL)
+core.metrics.register('total_count_cache', total_count_cache.stats)
+# ids found for search by cursor, so next pages of query don't run search again
+search_ids_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+core.metrics.register('search_ids_cache', search_ids_cache.stats)
 
-def paginate(page, query, scheme_converter):
-    paginated_query = query.offset((page - 1) * ITEMS_PER_PAGE).limit(ITEMS_PER_PAGE).all()
+
+async def paginate(page, query, scheme_converter, db: AsyncSession):
+    paginated_query = await db.scalars(
+        query.offset((page - 1) * ITEMS_PER_PAGE).limit(ITEMS_PER_PAGE))
+    total = await db.scalar(
+        sqlalchemy.select(sqlalchemy.func.count()).select_from(query.subquery()))
     return schemes.PageResponseModel(
-        total=query.count(),
+        total=total,
         page=page,
         size=ITEMS_PER_PAGE,
         results=list(map(lambda item: scheme_converter(item), paginated_query))
     )
 
 
+async def fetch_in_order(query, model, ids: list, db: AsyncSession):
+    """Loads rows found by search engine with one query keeping order of _ids_"""
+    items = (await db.scalars(query.where(model.id.in_(ids)))).all()
+    order = {id_: position for position, id_ in enumerate(ids)}
+    return sorted(items, key=lambda item: order[item.id])
+
+
+def normalize_query(query: str):
+    """Query as a part of cache keys"""
+    return ' '.join(query.lower().split()) if query else None
+
+
+def search_ids(crud, query: str, filter=None, key: tuple = ()):
+    """Returns ids found by search engine (not more than SEARCH_MAX_HITS) and True
+    if the rest of found items were cut off.
+    Result is cached for all pages of query, _key_ has everything else it depends on
+    """
+    cache_key = (type(crud).__name__, normalize_query(query), *key, crud.generation())
+    found = search_ids_cache.get(cache_key)
+    if found is None:
+        ids = crud.search_ids(query, limit=SEARCH_MAX_HITS + 1, filter=filter)
+        found = ids[:SEARCH_MAX_HITS], len(ids) > SEARCH_MAX_HITS
+        search_ids_cache.set(cache_key, found)
+    return found
+
+
+def encode_cursor(sort_key, id_):
+    return base64.urlsafe_b64encode(json.dumps([sort_key, id_]).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        sort_key, id_ = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(sort_key), int(id_)
+    except Exception:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail='Invalid cursor'
+        )
+
+
+async def get_cached_total(query, key: tuple, db: AsyncSession):
+    """_key_ has everything _query_ depends on (model, filters, search query...)"""
+    total = total_count_cache.get(key)
+    if total is None:
+        total = await db.scalar(
+            sqlalchemy.select(sqlalchemy.func.count()).select_from(query.subquery()))
+        total_count_cache.set(key, total)
+    return total
+
+
+async def keyset_paginate(query, model, scheme_converter, db: AsyncSession,
+                          cursor: str = None, size: int = None, with_total: bool = False,
+                          truncated: bool = False, total_key: tuple = ()):
+    """Paginates by (model.sort_key, model.id), so every page costs the same.
+    _cursor_ is taken from _next_cursor_ of previous page,
+    _total_ is counted only if it is asked (and is cached for a while by _total_key_),
+    _truncated_ tells that _query_ has only part of found items (see search_ids)
+    """
+    size = min(size or ITEMS_PER_PAGE, MAX_ITEMS_PER_PAGE)
+    paginated_query = query
+    if cursor:
+        sort_key, id_ = decode_cursor(cursor)
+        paginated_query = query.where(
+            model.sort_key >= sort_key,
+            sqlalchemy.or_(model.sort_key > sort_key, model.id > id_)
+        )
+    items = (await db.scalars(
+        paginated_query.order_by(model.sort_key, model.id).limit(size + 1))).all()
+
+    next_cursor = None
+    if len(items) > size:
+        items = items[:size]
+        next_cursor = encode_cursor(items[-1].sort_key, items[-1].id)
+
+    return schemes.CursorPageResponseModel(
+        size=size,
+        next_cursor=next_cursor,
+        total=await get_cached_total(query, (model.__name__, *total_key), db)
+        if with_total else None,
+        truncated=truncated,
+        results=list(map(lambda item: scheme_converter(item), items))
+    )
+
+
 def converter_user_search(user_model):
     return schemes.UserSearch(
         id=user_model.id,
@@ -26,14 +126,13 @@ def converter_user_search(user_model):
     )
 
 
-async def handle_users(line: list, db: Session, result: list):
-    max_id = await get_max_user_id(db)
+async def handle_users(line: list, rows: list):
     user = dict(zip(['name', 'middlename', 'surname', 'birthdate', 'year_of_study'], line))
     if '.' in user['birthdate']:
         user['birthdate'] = dt.datetime.strptime(user['birthdate'], '%d.%m.%Y').date()
     else:
         user['birthdate'] = dt.datetime.fromisoformat(user['birthdate']).date()
-    result.append(await create_user(user, db, max_id))
+    rows.append(user)
 
 
 async def user_write_func(user: User):
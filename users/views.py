@@ -1,16 +1,21 @@
 import fastapi
-from typing import Annotated
+from typing import Annotated, Optional
 import models
 from core.db import get_db
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+import sqlalchemy
 from auth import schemes as auth_schemes
-from auth.utils import get_current_user
+from auth.utils import get_token_user, create_users, revoke_tokens, invalidate_principal
+from auth.schemes import Principal
 import core.validators
-from .utils import paginate, converter_user_search, handle_users, user_write_func
+from .utils import (paginate, keyset_paginate, fetch_in_order, converter_user_search,
+                    handle_users, user_write_func, search_ids, normalize_query)
+from .schemes import PageResponseModel
+from config import MAX_ITEMS_PER_PAGE, SEARCH_MAX_HITS
 from books.utils import write_to_csv, remove_file
 import core.exceptions
 from books.utils import handle_csv
-from core.search.cruds import UserCRUD as UserSearchCRUD
+from core.search import UserCRUD as UserSearchCRUD
 
 router = fastapi.APIRouter()
 
@@ -22,10 +27,10 @@ router = fastapi.APIRouter()
     description='__Note:__ only _librarian_ and _admin_ have access to this operation'
 )
 async def get_user(user_id: int,
-                   current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
-                   db: Session = fastapi.Depends(get_db)):
+                   current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
+                   db: AsyncSession = fastapi.Depends(get_db)):
     if await core.validators.is_librarian(current_user) or user_id == current_user.id:
-        user = db.query(models.User).filter(models.User.id == user_id).first()
+        user = await db.scalar(sqlalchemy.select(models.User).where(models.User.id == user_id))
         if user is None:
             raise core.exceptions.UserDoesNotExistException()
 
@@ -45,12 +50,12 @@ async def get_user(user_id: int,
 **Note:** empty fields will not affect already existing data (you can't set null value)
 ''')
 async def edit_user(user_id: int,
-                    current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+                    current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
                     form: Annotated[auth_schemes.User, fastapi.Depends()],
-                    db: Session = fastapi.Depends(get_db)):
+                    db: AsyncSession = fastapi.Depends(get_db)):
 
     if await core.validators.is_admin(current_user):
-        user = db.query(models.User).filter(models.User.id == user_id).first()
+        user = await db.scalar(sqlalchemy.select(models.User).where(models.User.id == user_id))
         if user is None:
             raise core.exceptions.UserDoesNotExistException()
         user.name = form.name or user.name
@@ -58,17 +63,15 @@ async def edit_user(user_id: int,
         user.middlename = form.middlename or user.middlename
         user.birthdate = form.birthdate or user.birthdate
         user.year_of_study = form.year_of_study or user.year_of_study
+        rights_changed = form.rights is not None and form.rights != user.rights
         user.rights = form.rights or user.rights
         try:
             db.add(user)
-            db.commit()
-
-            UserSearchCRUD().update(user.id, {
-                'name': user.name,
-                'middlename': user.middlename,
-                'surname': user.surname,
-                'login': user.login,
-            })
+            if rights_changed:
+                await revoke_tokens(user, db)
+            else:
+                await invalidate_principal(user.id, db)
+            await db.commit()
             return fastapi.status.HTTP_200_OK
         except Exception as exc:
             raise core.exceptions.SomethingWentWrongException(exc)
@@ -81,26 +84,64 @@ async def edit_user(user_id: int,
 * You can set optional filter for _year_of_study_ to filter users
 * Empty _query_ parameter makes you get all users
 ''')
-async def search_user(current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+async def search_user(current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
                       page: int,
                       query: str = None,
                       year_of_study: int = None,
-                      db: Session = fastapi.Depends(get_db),
+                      db: AsyncSession = fastapi.Depends(get_db),
                       ):
     if await core.validators.is_librarian(current_user):
-        ids = []
-        users_query = db.query(models.User)
-        if query:
-            ids = list(map(lambda item: int(item['id']), UserSearchCRUD().search(query, page)))
-            if not ids:
-                users_query = users_query.filter(False)
-            else:
-                users_query = users_query.filter(models.User.id.in_(ids))
+        users_query = sqlalchemy.select(models.User)
+        if not query:
+            return await paginate(page, users_query, converter_user_search, db)
+
+        found = UserSearchCRUD().search(query, page)
+        if year_of_study:
+            users_query = users_query.where(models.User.year_of_study == year_of_study)
+        users = await fetch_in_order(users_query, models.User, found.ids, db)
+        return PageResponseModel(
+            total=found.total,
+            page=page,
+            results=list(map(converter_user_search, users))
+        )
+
+    raise core.exceptions.NotEnoughRightsException()
+
 
-            if year_of_study:
-                users_query = users_query.filter(models.User.year_of_study == year_of_study)
+@router.post('/search', description=f'''
+## Searches through indexed values and returns results by cursor
+Users are sorted by surname. To get next page send _next_cursor_ from previous page as _cursor_
+* You can set optional filter for _year_of_study_ to filter users
+* Empty _query_ parameter makes you get all users
+* _size_ is amount of users on page (max {MAX_ITEMS_PER_PAGE})
+* set _total_ to get total amount of found users (it may be cached for a while)
+* with _query_ only the best {SEARCH_MAX_HITS} found users are paged, _truncated_ is true
+if more users were found (refine query to see them)
+''')
+async def search_user_by_cursor(
+        current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
+        query: str = None,
+        year_of_study: int = None,
+        cursor: str = None,
+        size: Optional[int] = fastapi.Query(None, ge=1),
+        total: bool = False,
+        db: AsyncSession = fastapi.Depends(get_db),
+):
+    if await core.validators.is_librarian(current_user):
+        users_query = sqlalchemy.select(models.User)
+        truncated = False
+        key = (year_of_study,)
+        if query:
+            crud = UserSearchCRUD()
+            ids, truncated = search_ids(crud, query)
+            users_query = users_query.where(models.User.id.in_(ids))
+            key += (normalize_query(query), crud.generation())
+        if year_of_study:
+            users_query = users_query.where(models.User.year_of_study == year_of_study)
 
-        return paginate(page, users_query, converter_user_search)
+        return await keyset_paginate(users_query, models.User, converter_user_search, db,
+                                     cursor=cursor, size=size, with_total=total,
+                                     truncated=truncated, total_key=key)
 
     raise core.exceptions.NotEnoughRightsException()
 
@@ -114,25 +155,26 @@ You **can't** delete user if he hasn't returned **all** books
     '''
 )
 async def delete_user(user_id: int,
-                      current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
-                      db: Session = fastapi.Depends(get_db)):
+                      current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
+                      db: AsyncSession = fastapi.Depends(get_db)):
     if await core.validators.is_admin(current_user):
-        q = db.query(models.User).filter(models.User.id == user_id)
-        user = q.first()
+        user = await db.scalar(sqlalchemy.select(models.User).where(models.User.id == user_id))
         if user is None:
             raise fastapi.exceptions.HTTPException(
                 status_code=fastapi.status.HTTP_404_NOT_FOUND,
                 detail='User doesn\'t exist!'
             )
         try:
-            if len(user.books) != 0:
+            has_books = await db.scalar(sqlalchemy.select(sqlalchemy.exists().where(
+                models.BookCarriers.c.user_id == user_id)))
+            if has_books:
                 raise fastapi.exceptions.HTTPException(
                     status_code=fastapi.status.HTTP_422_UNPROCESSABLE_ENTITY,
                     detail='User hasn\'t returned all books!'
                 )
-            UserSearchCRUD().delete(user.id)
-            q.delete()
-            db.commit()
+            await db.delete(user)  # not by query: search outbox gets change from session
+            await invalidate_principal(user_id, db)
+            await db.commit()
             return fastapi.status.HTTP_200_OK
         except Exception as exc:
             raise core.exceptions.SomethingWentWrongException(exc)
@@ -161,14 +203,16 @@ __Note:__
 - _year of study_ field can be integer in range from 1 to 11
 - _rights_ field can be only one of available values (student/librarian/admin)
     ''')
-async def load_users_csv(current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+async def load_users_csv(current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
                          csv_file: fastapi.UploadFile,
-                         db: Session = fastapi.Depends(get_db)):
+                         db: AsyncSession = fastapi.Depends(get_db)):
     if await core.validators.is_admin(current_user):
         try:
-            result = []
-            await handle_csv(file=csv_file, handle_func=handle_users, db=db, result=result)
-            return {'users': result}
+            rows = []
+            await handle_csv(file=csv_file, handle_func=handle_users, rows=rows)
+            return {'users': await create_users(rows, db)}
+        except core.exceptions.ServerIsBusyException:
+            raise
         except Exception as exc:
             raise core.exceptions.SomethingWentWrongException(exc)
 
@@ -186,12 +230,12 @@ Example output:
 |  ...     | ...  |    ...     | ...     | ...          | ...           |
 ''')
 async def get_users_profiles(
-    current_user: Annotated[models.User, fastapi.Depends(get_current_user)],
+    current_user: Annotated[Principal, fastapi.Depends(get_token_user)],
     background_tasks: fastapi.BackgroundTasks,
-    db: Session = fastapi.Depends(get_db)
+    db: AsyncSession = fastapi.Depends(get_db)
 ):
     if await core.validators.is_admin(current_user):
-        users = db.query(models.User).all()
+        users = await db.scalars(sqlalchemy.select(models.User))
         header = ['login', 'Name', 'Middlename', 'Surname', 'Birthdate', 'Year_of_study']
         path = await write_to_csv(users, user_write_func, header)
         background_tasks.add_task(remove_file, path)